@@ -0,0 +1,1000 @@
+#!/usr/bin/env python
+""" Benchmarks of the EEMON42 software modules, run on the host with the emulated hardware modules.
+
+Usage: python bench.py
+
+The exit status is 1 if any check failed.
+"""
+import sys
+sys.pycache_prefix = "__pycache__"  # NOQA
+# add the EEMON42 application folder after this package so emulated modules will be loaded
+sys.path.append("../software")  # NOQA
+
+import asyncio
+from array import array
+import math
+import time
+import tracemalloc
+import importlib.util
+import socket
+import struct
+import binascii
+
+import micropython_time  # NOQA, adds time.ticks_ms() & co.
+import hashlib
+
+# CPython equivalents of the MicroPython modules imported by eemon42, as in main.py
+sys.modules['usocket'] = socket
+sys.modules['ustruct'] = struct
+sys.modules['ubinascii'] = binascii
+
+from machine import Pin
+from spi import SPI_with_CS
+from measurements import Measurements
+from waveform import Waveform
+from harmonics import Harmonics
+from events import EventLog
+from adaptive import AdaptiveIntegration
+import display
+from eemon42 import EEMON42
+
+
+def load_software_module(name):
+    """ Load the hardware version of a module that is shadowed by an emulated module of the same name in this folder.
+    """
+    spec = importlib.util.spec_from_file_location(f'{name}_hw', f'../software/{name}.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+ade7816 = load_software_module('ade7816')
+ssd1331 = load_software_module('ssd1331')
+button = load_software_module('button')
+rotary_encoder = load_software_module('rotary_encoder')
+
+
+class EmulatedFramebuf:
+    """ Pure-Python emulation of the part of the MicroPython framebuf module used by `Display`, to check the framebuf
+    drawing path on the host. As on the ESP32, the RGB565 pixels are stored in little-endian order.
+    """
+    RGB565 = 1
+
+    class FrameBuffer:
+        def __init__(self, buf, width, height, format, stride=None):
+            self.buf = buf
+            self.width = width
+            self.height = height
+            self.stride = stride or width
+
+        def pixel(self, x, y, c=None):
+            a = 2 * (x + y * self.stride)
+            if c is None:
+                return self.buf[a] | self.buf[a + 1] << 8
+            if 0 <= x < self.width and 0 <= y < self.height:
+                self.buf[a] = c & 0xFF
+                self.buf[a + 1] = c >> 8
+
+        def fill_rect(self, x, y, w, h, c):
+            for yy in range(max(y, 0), min(y + h, self.height)):
+                for xx in range(max(x, 0), min(x + w, self.width)):
+                    self.pixel(xx, yy, c)
+
+        def fill(self, c):
+            self.fill_rect(0, 0, self.width, self.height, c)
+
+        def hline(self, x, y, w, c):
+            self.fill_rect(x, y, w, 1, c)
+
+        def vline(self, x, y, h, c):
+            self.fill_rect(x, y, 1, h, c)
+
+        def rect(self, x, y, w, h, c, f=False):
+            if f:
+                self.fill_rect(x, y, w, h, c)
+            else:
+                self.hline(x, y, w, c)
+                self.hline(x, y + h - 1, w, c)
+                self.vline(x, y, h, c)
+                self.vline(x + w - 1, y, h, c)
+
+        def blit(self, src, x, y, key=-1):
+            for yy in range(src.height):
+                for xx in range(src.width):
+                    c = src.pixel(xx, yy)
+                    if c != key:
+                        self.pixel(x + xx, y + yy, c)
+
+
+class InputPin(Pin):
+    """ Pin driven by an emulated switch: `set()` changes its level and calls its interrupt handler, like a pin edge.
+    """
+    def irq(self, handler):
+        self.handler = handler
+
+    def set(self, level):
+        self._value = level
+        self.handler(self)
+
+
+class EmulatedClock:
+    """ Emulated microsecond clock, installed as ``time.ticks_us()`` while used as a context manager. It advances with
+    the emulated bus transfers (see `EmulatedADE7816Bus.clock`), and by `step_us` at each reading so busy-wait loops
+    end, so the measured times and the emulated waveforms don't depend on the host load.
+
+    Parameters:
+
+        step_us (int): time added at each reading of the clock, in us
+    """
+    def __init__(self, step_us=0):
+        self.t = 0
+        self.step_us = step_us
+
+    def ticks_us(self):
+        self.t += self.step_us
+        return self.t & ((1 << 30) - 1)
+
+    def elapse(self, us):
+        self.t += us
+
+    def __enter__(self):
+        self.saved = time.ticks_us
+        time.ticks_us = self.ticks_us
+        return self
+
+    def __exit__(self, *args):
+        time.ticks_us = self.saved
+
+
+class EmulatedADE7816Bus(SPI_with_CS):
+    """ SPI bus with emulated ADE7816 register files, one per chip select pin.
+
+    Registers that were never written read as plausible measurements for a 120 V, 60 Hz line (other registers read
+    as a pattern derived from their address, except the interrupt registers which read as 0), and STATUS0 always reports a LENERGY interrupt so every call to the IRQ
+    handler processes a full measurement. Energies are proportional to the LINECYC value at the start of the window. The instantaneous value registers follow a 60 Hz waveform with the
+    `WAVEFORM_HARMONICS` amplitudes, scaled by `WAVEFORM_DF_SCALE` for the current channels D-F when they are selected
+    with the CONFIG_CHANNEL_SEL bit.
+    """
+    WAVEFORM_HARMONICS = {1: 2000000, 3: 400000, 5: 100000}  # harmonic order: amplitude in register counts
+    WAVEFORM_DF_SCALE = 0.5  # amplitude of the channels D-F relative to the channels A-C
+    TRANSFER_OVERHEAD_US = 5  # chip select and driver time of each transfer, added to the bus time by `clock`
+    def __init__(self, cs_pins):
+        super().__init__(cs_inout_pins=cs_pins)
+        self.regs = {id(pin): {} for pin in cs_pins}
+        self.clock = None  # EmulatedClock advanced by the duration of each transfer at the baud rate
+
+    def elapse(self, n_bytes):
+        if self.clock:
+            self.clock.elapse(self.TRANSFER_OVERHEAD_US + n_bytes * 8000000 // self.baudrate)
+
+    @staticmethod
+    def default_value(addr, scale=1, t=None):
+        R = ade7816.Registers
+        if R.WATTHR[0].addr <= addr <= R.VARHR[-1].addr:
+            return 100 + (addr * 7919) % 2000  # energy of a 5 s line cycle window
+        if R.IRMS[0].addr <= addr <= R.IRMS[-1].addr:
+            return 20000 + (addr * 7919) % 500000
+        if addr == R.VRMS.addr:
+            return 2900000  # ~120 V
+        if addr == R.PERIOD.addr:
+            return 4267  # 60 Hz
+        if addr in (R.STATUS1.addr, R.MASK0.addr, R.MASK1.addr):
+            return 0  # reset values: no interrupt
+        if R.WAVEFORM[0].addr <= addr <= R.WAVEFORM[-1].addr:
+            if t is None:
+                t = time.perf_counter()
+            value = sum(a * math.sin(2 * math.pi * 256e3 / 4267 * h * t)
+                        for h, a in EmulatedADE7816Bus.WAVEFORM_HARMONICS.items())
+            return int(value * scale) & 0xFFFFFFFF
+        return (addr * 2654435761) & 0x7FFFFF
+
+    def exchange(self, cs_pin, data, read_buf=None):
+        if not self.context_active:
+            self.enable_spi()
+        self.emulate(cs_pin, data, read_buf)
+        self.elapse(len(data) + (len(read_buf) if read_buf is not None else 0))
+        if not self.context_active:
+            self.disable_spi()
+
+    def transfer(self, cs_pin, tx_buf, rx_buf=None):
+        if not self.context_active:
+            self.enable_spi()
+        self.emulate(cs_pin, tx_buf, None if rx_buf is None else memoryview(rx_buf)[3:])  # the reply follows the 3 command bytes
+        self.elapse(len(tx_buf))
+        if not self.context_active:
+            self.disable_spi()
+
+    def emulate(self, cs_pin, data, read_buf):
+        regs = self.regs.get(id(cs_pin))
+        if regs is None:  # not an ADE7816, e.g. the display
+            return
+        addr = (data[1] << 8) | data[2]
+        if data[0]:
+            n = len(read_buf)
+            value = regs.get(addr)
+            if value is None:
+                R = ade7816.Registers
+                df = (regs.get(R.CONFIG.addr, 0) & ade7816.ADE7816.CONFIG_CHANNEL_SEL and
+                      R.WAVEFORM[0].addr <= addr < R.VWV.addr)
+                value = self.default_value(addr, self.WAVEFORM_DF_SCALE if df else 1,
+                                           self.clock.t * 1e-6 if self.clock else None)
+            if addr == ade7816.Registers.STATUS0.addr:
+                value |= ade7816.ADE7816.STATUS0_LENERGY
+            elif ade7816.Registers.WATTHR[0].addr <= addr <= ade7816.Registers.VARHR[-1].addr:
+                value = value * regs.get('window', 600) // 600  # energy is proportional to the window length
+            read_buf[:] = value.to_bytes(4, 'big')[4 - n:]
+        elif addr in (ade7816.Registers.STATUS0.addr, ade7816.Registers.STATUS1.addr):
+            regs[addr] = regs.get(addr, 0) & ~int.from_bytes(data[3:], 'big')  # writing 1 clears the flag
+            if addr == ade7816.Registers.STATUS0.addr:
+                # a new window starts when the LENERGY flag is cleared, with the LINECYC value written before
+                regs['window'] = regs.get(ade7816.Registers.LINECYC.addr, 600)
+        else:
+            regs[addr] = int.from_bytes(data[3:], 'big')
+
+
+def emulated_emon(n_chips=1, index=0):
+    """ Return an `EmulatedADE7816Bus` and `n_chips` ADE7816 objects on it, with no handler on their interrupt line.
+
+    Parameters:
+
+        n_chips (int): number of chips, each with its own CS pin
+
+        index (int): index of the first chip
+
+    Returns:
+
+        tuple: (EmulatedADE7816Bus, list of ADE7816)
+    """
+    cs_pins = [Pin(i) for i in range(n_chips)]
+    spi = EmulatedADE7816Bus(cs_pins)
+    emons = [ade7816.ADE7816(spi=spi, cs_pin=pin, irq_pin=Pin(21), irq_wrapper=None, index=index + ix)
+             for ix, pin in enumerate(cs_pins)]
+    return (spi, emons)
+
+
+def legacy_read_reg(emon, name):
+    """ Register read as implemented before the precompiled register descriptors, kept as a benchmark reference.
+    """
+    (addr, fmt) = emon.REGS[name]
+    (byte_length, bit_length, signed) = emon.FORMATS[fmt]
+    cmd = emon.cmd
+    rx_buf = emon.rx_buf
+    cmd[0] = 1
+    cmd[1] = addr >> 8
+    cmd[2] = addr & 0xff
+    emon.spi.exchange(emon.cs_pin, memoryview(cmd)[:3], memoryview(rx_buf)[:byte_length])
+    value = int.from_bytes(rx_buf[:byte_length], 'big')
+    if signed and value & (1 << (bit_length - 1)):
+        value -= (1 << bit_length)
+    return value
+
+
+def rate(fn, n):
+    """ Return the number of calls per second of `fn`, estimated over `n` calls.
+    """
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return n / (time.perf_counter() - t0)
+
+
+def bench_registers(n=100000):
+    """ Compare the register access rate of the string-based and descriptor-based ADE7816 methods.
+    """
+    cs_pin = Pin(10)
+    spi = SPI_with_CS(cs_inout_pins=(cs_pin,))
+    emon = ade7816.ADE7816(spi=spi, cs_pin=cs_pin, irq_pin=Pin(21), irq_wrapper=None, index=0)
+    R = ade7816.Registers
+    c = 3
+    print(f'ADE7816 register access, {n} calls each (calls/s):')
+    with spi:
+        print(f"   legacy read_reg(f'I{{c}}RMS'): {rate(lambda: legacy_read_reg(emon, f'I{ade7816.ADE7816.CHANNELS[c]}RMS'), n):10.0f}")
+        print(f"   read_reg(f'I{{c}}RMS')       : {rate(lambda: emon.read_reg(f'I{ade7816.ADE7816.CHANNELS[c]}RMS'), n):10.0f}")
+        print(f"   read(R.IRMS[c])            : {rate(lambda: emon.read(R.IRMS[c]), n):10.0f}")
+        print(f"   write_reg('MASK0', v)      : {rate(lambda: emon.write_reg('MASK0', 0x20), n):10.0f}")
+        print(f"   _write(R.MASK0, v)         : {rate(lambda: emon._write(R.MASK0, 0x20), n):10.0f}")
+        print(f"   write(R.MASK0, v), cached  : {rate(lambda: emon.write(R.MASK0, 0x20), n):10.0f}")
+        print(f"   read(R.MASK0), cached      : {rate(lambda: emon.read(R.MASK0), n):10.0f}")
+
+
+def bench_snapshot(n=10000):
+    """ Compare reading the snapshot registers one at a time with `ADE7816.read_snapshot()`.
+    """
+    cs_pins = [Pin(i) for i in range(7)]
+    spi = SPI_with_CS(cs_inout_pins=cs_pins)
+    emon = ade7816.ADE7816(spi=spi, cs_pin=cs_pins[0], irq_pin=Pin(21), irq_wrapper=None, index=0)
+    snap = emon.new_snapshot()
+    regs = ade7816.Registers.SNAPSHOT
+
+    def read_one_by_one():
+        for i, reg in enumerate(regs):
+            snap[i] = emon.read(reg)
+
+    print(f'ADE7816 {len(regs)}-register snapshot, {n} calls each (snapshots/s):')
+    print(f'   individual read() calls    : {rate(read_one_by_one, n):10.0f}')
+    print(f'   read_snapshot()            : {rate(lambda: emon.read_snapshot(snap), n):10.0f}')
+
+
+def emulated_eemon(n_chips=7):
+    """ Return an EEMON42 instance with `n_chips` ADE7816 chips on an `EmulatedADE7816Bus`, with the attributes used by
+    its IRQ service path (`EEMON42.demux_emon_irq()` and `EEMON42.scan_emon()`). The EEMON42 constructor is not called
+    since it creates the display, inputs and configuration of the real board.
+
+    The IRQ line pin reads low, i.e. asserted, and the emulated chips always report a LENERGY interrupt, so
+    `scan_emon()` services every chip on each pass.
+    """
+    eemon = EEMON42.__new__(EEMON42)
+    (eemon.spi, eemon.emon) = emulated_emon(n_chips)
+    for emon in eemon.emon:
+        emon.write_config()  # enables the LENERGY interrupt
+    eemon.measurements = Measurements(n_chips)
+    eemon.integration = AdaptiveIntegration(eemon.emon, eemon.measurements)
+    eemon.accumulation_mode = ade7816.ADE7816.LINE_CYCLE
+    eemon.pin_cs6_irq = Pin(21)
+    eemon.irq_flag = asyncio.Event()
+    eemon.irq_ticks_us = 0
+    for name in ('irq_status', 'irq_pending_since', 'irq_count', 'irq_latency_us', 'irq_max_latency_us'):
+        setattr(eemon, name, array('i', [0] * n_chips))
+    return eemon
+
+
+def check_irq_allocations(n=1000):
+    """ Check that the steady-state IRQ service path of `EEMON42.scan_emon()`, from the IRQ demultiplexing to the
+    adaptive windows update, does not allocate memory.
+
+    The peak of the traced memory is measured over `n` service passes, so the memory allocated and freed within a
+    pass is also counted. The peak of the asyncio event loop running an idle task for as many iterations is
+    subtracted. On the host, the integers that don't fit the CPython small int cache (MicroPython small ints) can
+    still account for a few hundred bytes.
+
+    Returns:
+
+        int: peak memory allocated above the starting point during the `n` passes, less the event loop peak, in bytes
+    """
+    eemon = emulated_eemon()
+    count = eemon.irq_count
+    n_chips = len(eemon.emon)
+
+    async def idle():
+        while True:
+            await asyncio.sleep(0)
+
+    async def traced_peak(task_coro, done):
+        """ Runs a task until `done(iterations)` is True and returns the traced memory peak and the iterations. """
+        task = asyncio.create_task(task_coro)
+        for _ in range(10 * n_chips):  # warm up
+            await asyncio.sleep(0)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        i = 0
+        while not done(i):
+            await asyncio.sleep(0)
+            i += 1
+        peak = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        task.cancel()
+        return (peak, i)
+
+    async def measure():
+        serviced = []
+
+        def done(i):
+            """ True once `n` service passes per chip have run since the first iteration. """
+            if i == 0:
+                serviced.append(sum(count))
+            return sum(count) - serviced[0] >= n * n_chips
+
+        (peak, iterations) = await traced_peak(eemon.scan_emon(), done)
+        (idle_peak, _) = await traced_peak(idle(), lambda i: i >= iterations)
+        return (peak, idle_peak)
+
+    (peak, idle_peak) = asyncio.run(measure())
+    print(f'IRQ service path: {sum(count)} chips serviced by EEMON42.scan_emon(), peak allocation={peak - idle_peak} bytes '
+          f'({peak} bytes including the event loop)')
+    return peak - idle_peak
+
+
+def check_shadow_cache():
+    """ Check that unchanged configuration writes are skipped and that a chip reset is detected and repaired.
+
+    Returns:
+
+        bool: True if the configuration was restored after the emulated reset
+    """
+    (spi, (emon,)) = emulated_emon()
+    regs = spi.regs[id(emon.cs_pin)]
+    regs[ade7816.Registers.CHECKSUM.addr] = 0x1234  # emulated chips don't compute a checksum
+    emon.init(expected_checksum=0x1234)
+    emon.write_config()
+    print(f'ADE7816 shadow cache: {emon.skipped_writes} unchanged writes skipped when rewriting the configuration')
+    emon.set_integ_cycles(emon.integ_cycles // 2)  # configuration change right before the reset
+    regs.clear()  # emulate a chip reset
+    regs[ade7816.Registers.CHECKSUM.addr] = 0x5678
+    valid = emon.verify_config()
+    restored = regs.get(ade7816.Registers.LINECYC.addr) == emon.integ_cycles * 2
+    print(f'ADE7816 shadow cache: reset detected={not valid}, configuration restored={restored}')
+    return restored
+
+
+def bench_capture(n=2000, max_blackout_us=2000):
+    """ Capture waveform samples from the emulated chip and report the sample rate, jitter and SPI blackout time.
+
+    The capture runs on an `EmulatedClock` advanced by the emulated bus transfers, so the blackout time doesn't depend
+    on the host load.
+
+    Returns:
+
+        int: longest SPI blackout, in us
+    """
+    (spi, (emon,)) = emulated_emon()
+    wf = Waveform(n)
+    with EmulatedClock() as clock:
+        spi.clock = clock
+        emon.capture(wf, max_blackout_us=max_blackout_us)
+        spi.clock = None
+    (sample_rate, jitter) = wf.timing()
+    print(f'ADE7816 waveform capture: {wf.count} samples at {sample_rate:.0f} Hz, jitter={jitter} us, '
+          f'max blackout={wf.max_blackout_us} us (limit {max_blackout_us} us)')
+    return wf.max_blackout_us
+
+
+def check_harmonics():
+    """ Measure the harmonics of the emulated waveforms with the Goertzel filters and compare them with the expected
+    values, for the current channels A-C and D-F.
+
+    The sampling runs on an `EmulatedClock` that also drives the emulated waveforms, so the samples are taken at their
+    scheduled times whatever the host load.
+
+    Returns:
+
+        float: largest error, relative to the fundamental amplitude
+    """
+    (spi, (emon,)) = emulated_emon()
+    bank = Harmonics(n_signals=4, harmonics=Measurements.HARMONICS)
+    out = Measurements.new_record()[:4 * len(Measurements.HARMONICS)]
+    expected = EmulatedADE7816Bus.WAVEFORM_HARMONICS
+    fundamental = expected[1] / math.sqrt(2)
+    err = 0
+    for channels in ade7816.ADE7816.WAVEFORM_GROUPS:
+        with EmulatedClock(step_us=1) as clock:
+            spi.clock = clock
+            late = emon.measure_harmonics(bank, out, channels=channels)
+            spi.clock = None
+        scale = EmulatedADE7816Bus.WAVEFORM_DF_SCALE if channels[0] >= 3 else 1
+        err = max(err, max(abs(bank.rms(k, i) - (scale if k < 3 else 1) * expected.get(h, 0) / math.sqrt(2)) / fundamental
+                           for k in range(bank.n_signals) for i, h in enumerate(bank.harmonics)))
+        print(f'Harmonics of channels {channels}, {bank.n} samples at {bank.sample_rate:.0f} Hz ({late} late): ' +
+              ', '.join(f'H{h}={bank.rms(0, i):.0f}' for i, h in enumerate(bank.harmonics)) + ' counts RMS')
+    try:
+        emon.measure_harmonics(bank, out, channels=(0, 1, 5))
+        print('Harmonics of channels (0, 1, 5): ValueError expected')
+        return 1
+    except ValueError:
+        pass
+    print(f'Harmonics max error={err * 100:.2f}% of the fundamental')
+    return err
+
+
+def check_power_quality():
+    """ Emulate sag, overvoltage and overcurrent interrupts and check that they are logged with their chip and channel.
+
+    Returns:
+
+        list of tuples: logged events
+    """
+    (spi, (emon,)) = emulated_emon(index=3)
+    emon.event_log = EventLog(size=8)
+    emon.set_power_quality({'sag_level': 100, 'overvoltage': 135, 'overcurrent': 40})
+    emon.write_config()
+    regs = spi.regs[id(emon.cs_pin)]
+    R = ade7816.Registers
+    regs[R.STATUS1.addr] = emon.STATUS1_SAG | emon.STATUS1_OV | emon.STATUS1_OI
+    regs[R.CHSTATUS.addr] = 0b000100  # overcurrent on channel C
+    regs[R.IPEAK.addr] = 3000000
+    regs[R.VPEAK.addr] = 4500000
+    emon.irq_handler(None)
+    events = emon.event_log.since(0)
+    print(f'Power-quality events (MASK1={emon.read(R.MASK1):08X}): {events}')
+    return events
+
+
+def check_line_frequency():
+    """ Emulate a 50 Hz line and check that the frequency-dependent registers and the window duration follow.
+
+    Returns:
+
+        bool: True if the 50 Hz settings were applied
+    """
+    (spi, (emon,)) = emulated_emon()
+    emon.write_config()
+    regs = spi.regs[id(emon.cs_pin)]
+    R = ade7816.Registers
+    regs[R.PERIOD.addr] = 5120  # 50 Hz
+    f = emon.measure_line_frequency()
+    emon.set_line_frequency(f)
+    emon.irq_handler(None)
+    window = emon.record[Measurements.REC_WINDOW]
+    ok = (regs[R.PCF_COEFF[0].addr] == emon.PCF_COEFF[50] and regs[R.LINECYC.addr] == 500 and window == 5000000)
+    print(f'Line frequency detected: {f} Hz, PCF_A_COEFF={regs[R.PCF_COEFF[0].addr]:06X}, '
+          f'LINECYC={regs[R.LINECYC.addr]}, window={window} us, ok={ok}')
+    return ok
+
+
+def check_adaptive_integration(windows=8):
+    """ Emulate load steps on three chips and check the adaptive windows and the interrupt rate budget.
+
+    Returns:
+
+        list of int: number of line cycles of the windows of each chip after each emulated window
+    """
+    (spi, emons) = emulated_emon(7)
+    for emon in emons:
+        emon.write_config()  # enables the LENERGY interrupt
+    measurements = Measurements(len(emons))
+    integration = AdaptiveIntegration(emons, measurements, max_irq_rate=4)
+    R = ade7816.Registers
+    history = []
+    for w in range(windows):
+        for ix, emon in enumerate(emons):
+            if w == 2 and ix < 3:  # 3 appliances turn on
+                spi.regs[id(emon.cs_pin)][R.WATTHR[0].addr] = 20000
+            if emon.irq_handler(None):
+                measurements.update(ix, emon.record)
+                integration.update(ix)
+        history.append([e.integ_cycles for e in emons])
+    print(f'Adaptive windows (line cycles) of chips 0-2: {[h[:3] for h in history]}, '
+          f'{integration.denied} denied by the {integration.max_irq_rate} IRQ/s budget')
+    return history
+
+
+def check_continuous_mode():
+    """ Check that polling in continuous accumulation mode gives the same records as the line cycle interrupts.
+
+    Returns:
+
+        bool: True if the per-channel fields and the voltage of both records match
+    """
+    (spi, (irq_emon, poll_emon)) = emulated_emon(2)
+    irq_emon.write_config()
+    poll_emon.write_config()
+    poll_emon.set_accumulation_mode(poll_emon.CONTINUOUS)
+    irq_emon.irq_handler(None)
+    poll_emon.poll(time.ticks_add(poll_emon.last_poll_us, poll_emon.nominal_window_ms * 1000))
+    n = Measurements.REC_VRMS + 1
+    ok = list(irq_emon.record[:n]) == list(poll_emon.record[:n]) and not poll_emon.irq_handler(None)
+    print(f'Continuous accumulation mode: records match the line cycle mode: {ok}, '
+          f'LCYCMODE={poll_emon.read(ade7816.Registers.LCYCMODE):02X}, MASK0={poll_emon.read(ade7816.Registers.MASK0):08X}')
+    return ok
+
+
+def bench_transaction_queue(n=20000, max_window_us=2000):
+    """ Compare individual register reads, each switching the dual-function pins, with reads batched by the SPI scheduler,
+    then send a whole display frame with `SSD1331.flush()`, and check the SPI windows of the batches.
+
+    The batches are timed with an `EmulatedClock`, so their duration is the emulated bus time at the baud rate.
+
+    Returns:
+
+        int: duration of the longest batch, in us
+    """
+    (spi, emons) = emulated_emon(7)
+    emon = emons[0]
+    spi.max_window_us = max_window_us
+    oled = ssd1331.SSD1331(spi, Pin(7), Pin(8), Pin(9))
+    reg = ade7816.Registers.IRMS[0]
+
+    async def queued_reads():
+        scheduler = asyncio.create_task(spi.scheduler())
+        for _ in range(n - 1):
+            spi.submit(emon.read, reg)
+        await emon.read_async(reg)
+        scheduler.cancel()
+
+    async def display_frame():
+        scheduler = asyncio.create_task(spi.scheduler())
+        oled.mark_dirty(0, 0, oled.WIDTH - 1, oled.HEIGHT - 1)
+        await oled.flush()
+        scheduler.cancel()
+
+    t0 = time.perf_counter()
+    for _ in range(n):
+        emon.read(reg)
+    t1 = time.perf_counter()
+    with EmulatedClock() as clock:
+        spi.clock = clock
+        asyncio.run(queued_reads())
+        t2 = time.perf_counter()
+        reads_batch_us = spi.max_batch_us
+        batches = spi.batch_count
+        spi.max_batch_us = 0
+        asyncio.run(display_frame())
+        spi.clock = None
+    print(f'SPI transaction queue, {n} register reads (reads/s):')
+    print(f'   individual exchanges       : {n / (t1 - t0):10.0f}')
+    print(f'   queued, {batches:5d} batches     : {n / (t2 - t1):10.0f}, longest batch={reads_batch_us} us (limit {max_window_us} us)')
+    print(f'   display frame, {spi.batch_count - batches:2d} bands   : longest batch={spi.max_batch_us} us, '
+          f'{spi.batch_overruns} overruns in all the batches')
+    return max(reads_batch_us, spi.max_batch_us)
+
+
+def check_fixed_point():
+    """ Compare the ADE7816 fixed-point conversions with floating point conversions over the register ranges.
+
+    Returns:
+
+        float: maximum absolute error, in output units (mA, mV or mJ)
+    """
+    emon = ade7816.ADE7816(spi=None, cs_pin=None, irq_pin=None, irq_wrapper=None, index=0)
+    current_lsb = 0.5*0.707/4191910 / emon.ct_cal[0] * 1000
+    voltage_lsb = 0.5*0.707/4191910 / emon.v_gain / emon.vt_cal * 1000
+    energy_lsb = emon.energy_cal[0] * 1000
+    max_err = 0
+    for (name, lsb, mult, shift, values) in (
+            ('mA', current_lsb, emon.ma_mult[0], emon.ma_shift[0], range(1000, 4191910, 997)),
+            ('mV', voltage_lsb, emon.mv_mult, emon.mv_shift, range(1000, 4191910, 997)),
+            ('mJ', energy_lsb, emon.mj_mult[0], emon.mj_shift[0], range(-1000000, 1000000, 997))):
+        err = max(abs(ade7816.fx_scale(raw, mult, shift) - raw * lsb) for raw in values)
+        print(f'ADE7816 fixed-point {name} conversion: mult={mult}, shift={shift}, max error={err:.3f} {name}')
+        max_err = max(err, max_err)
+    return max_err
+
+
+def check_transfer_allocations(n=1000):
+    """ Check that the register writes of the ADE7816 and the commands of the SSD1331 don't allocate memory.
+
+    Returns:
+
+        tuple: peak number of bytes allocated during `n` ADE7816 register writes and during `n` SSD1331 commands
+    """
+    spi = SPI_with_CS(cs_inout_pins=[Pin(0)])
+    emon = ade7816.ADE7816(spi=spi, cs_pin=Pin(1), irq_pin=Pin(21), irq_wrapper=None, index=0)
+    oled = ssd1331.SSD1331(spi, Pin(2), Pin(3), Pin(4))
+    MASK0 = ade7816.Registers.MASK0
+    peaks = []
+    for transaction in (lambda: emon._write(MASK0, 0x20), lambda: oled.draw_line(0, 0, 95, 63)):
+        transaction()  # warm up
+        tracemalloc.start()
+        for _ in range(n):
+            transaction()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    print(f'SPI transfers: peak allocation {peaks[0]} bytes for {n} ADE7816 writes, {peaks[1]} bytes for {n} SSD1331 commands')
+    return tuple(peaks)
+
+
+def check_spi_stats(n=10000):
+    """ Check the SPI bus statistics and measure their overhead.
+
+    Returns:
+
+        bool: True if the transaction and byte counts match the exchanges that were made
+    """
+    spi = SPI_with_CS(cs_inout_pins=[Pin(0)])
+    emon = ade7816.ADE7816(spi=spi, cs_pin=Pin(1), irq_pin=Pin(21), irq_wrapper=None, index=0)
+    oled = ssd1331.SSD1331(spi, Pin(2), Pin(3), Pin(4))
+    R = ade7816.Registers
+    read = lambda: emon._read(R.VRMS)
+    plain = rate(read, n)
+    stats = spi.enable_stats({emon.cs_pin: 'emon0', oled.cs_pin: 'display'})
+    instrumented = rate(read, n)
+    stats.reset()
+    for _ in range(n):
+        emon._read(R.VRMS)  # 3 + 4 bytes out, 3 + 4 bytes in
+    with spi:
+        oled.write_frame_buffer(0, 63)  # window command + frame buffer
+    published = []
+    stats.hook = published.append
+    d = stats.publish()
+    ok = (d['devices']['emon0'] == {'count': n, 'bytes_out': 7 * n, 'bytes_in': 7 * n}
+          and d['devices']['display'] == {'count': 2, 'bytes_out': 6 + 96 * 64 * 2, 'bytes_in': 0}
+          and d['blackout_count'] == n + 1 and sum(d['histogram']) == n + 1 and published == [d]
+          and stats.blackout_count == 0)
+    print(f'SPI statistics: overhead {100 * (plain / instrumented - 1):.1f}% on register reads, '
+          f'max blackout={d["max_blackout_us"]} us, histogram={d["histogram"]}, ok={ok}')
+    return ok
+
+
+def check_blackout_inputs(detents=5):
+    """ Check that the encoder and button transitions that happen while the SPI pin interrupts are blocked are not lost.
+
+    The encoder is turned by `detents` detents clockwise, one phase change per SPI transaction, then by one more detent
+    whose phase changes happen while a blackout starts, right before the pin levels are sampled. A button is pressed
+    and released during transactions.
+
+    Returns:
+
+        bool: True if the encoder position and the button presses are right
+    """
+    pin_a, pin_b, pin_sw, pin_shift = (InputPin(i) for i in range(4))
+    for pin in (pin_a, pin_b, pin_sw, pin_shift):
+        pin._value = 1  # switches open
+    spi = SPI_with_CS(cs_inout_pins=[pin_a, pin_b, pin_sw, pin_shift])
+    sw = button.Button(pin_sw, irq_wrapper=spi.get_irq)
+    shift = button.Button(pin_shift, irq_wrapper=spi.get_irq)
+    encoder = rotary_encoder.RotaryEncoder(pin_a, pin_b, shift, irq_wrapper=spi.get_irq, verbose=0)
+    cs_pin = Pin(5)
+    gap_edges = []
+    sample_watched_pins = spi.sample_watched_pins
+
+    def sample_after_edge():
+        """ Samples the watched pins right after an edge of `gap_edges`, if any. """
+        if gap_edges:
+            (pin, level) = gap_edges.pop()
+            pin.set(level)
+        return sample_watched_pins()
+
+    spi.sample_watched_pins = sample_after_edge
+    clockwise = ((pin_a, 0), (pin_b, 0), (pin_a, 1), (pin_b, 1))  # sequence 11, 01, 00, 10, 11
+    for _ in range(detents):
+        for pin, level in clockwise:
+            with spi:
+                spi.transfer(cs_pin, b'\x00')
+                pin.set(level)  # the edge interrupt is blocked
+    for edge in clockwise:
+        gap_edges.append(edge)  # the edge happens as the blackout starts
+        with spi:
+            spi.transfer(cs_pin, b'\x00')
+    detents += 1
+    with spi:
+        pin_sw.set(0)  # pressed during a transaction
+    time.sleep(0.06)  # debounce delay
+    with spi:
+        pin_sw.set(1)
+    ok = encoder.value() == detents and encoder.invalid == 0 and sw._down == 1 and sw._up == 1
+    print(f'Inputs during SPI blackouts: encoder={encoder.value()} (expected {detents}), button down={sw._down} up={sw._up}, '
+          f'{spi.synthesized_count} blackouts with synthesized interrupts, ok={ok}')
+    return ok
+
+
+def bench_display_update(text='42.7', x=40, y=28, baudrate=2.5e6):
+    """ Compare the SPI traffic of a display update that sends the modified rectangle and one that sends whole lines.
+
+    Returns:
+
+        tuple: bytes sent to the display by the rectangle update and by the whole-lines update
+    """
+    spi = SPI_with_CS(cs_inout_pins=[Pin(0)])
+    oled = ssd1331.SSD1331(spi, Pin(2), Pin(3), Pin(4))
+    stats = spi.enable_stats({oled.cs_pin: 'display'})
+    results = []
+    for rect in (True, False):
+        oled.clear_dirty()
+        oled.print(text, x=x, y=y, update=False)
+        (y0, y1) = (oled.fb_y0, oled.fb_y1)
+        stats.reset()
+        oled.write_frame_buffer() if rect else oled.write_frame_buffer(y0, y1)
+        results.append(stats.bytes_out[0])
+    (rect_bytes, lines_bytes) = results
+    print(f'Display update of {text!r}: {rect_bytes} bytes ({rect_bytes * 8e6 / baudrate:.0f} us on the bus) for the modified rectangle, '
+          f'{lines_bytes} bytes ({lines_bytes * 8e6 / baudrate:.0f} us) for whole lines')
+    return (rect_bytes, lines_bytes)
+
+
+def bench_print(n=2000, text='1234.5 W'):
+    """ Measure the `Display.print()` throughput without the glyph cache, and with a cold and a warm cache, and check
+    that the cached glyphs draw the same pixels as the font bitmaps.
+
+    Returns:
+
+        bool: True if the frame buffers drawn with and without the cache are identical
+    """
+    spi = SPI_with_CS(cs_inout_pins=[Pin(0)])
+    oled = ssd1331.SSD1331(spi, Pin(2), Pin(3), Pin(4))
+    cache = oled.glyph_cache
+    ok = True
+    for font_size in (5, 8):
+        frames = []
+        for glyph_cache in (None, cache):
+            oled.glyph_cache = glyph_cache
+            oled.clear(update=False)
+            oled.print(text, x=3, y=10, fg=oled.YELLOW, bg=oled.BLUE, update=False, font_size=font_size)
+            frames.append(bytes(oled.fb))
+        ok = ok and frames[0] == frames[1]
+
+    def print_text():
+        oled.print(text, x=0, y=0, update=False)
+
+    def print_cold():
+        cache.clear()
+        oled.print(text, x=0, y=0, update=False)
+
+    oled.set_font(5)
+    oled.glyph_cache = None
+    uncached = rate(print_text, n)
+    oled.glyph_cache = cache
+    cold = rate(print_cold, n)
+    warm = rate(print_text, n)
+    warm_size = cache.size
+    # cycle through many colors: the palettes emptied by the evictions must be removed
+    for color in range(256):
+        oled.print(text, x=0, y=0, fg=color, update=False)
+    palettes_ok = all(cache.palettes.values())
+    print(f'Display.print({text!r}), {n} calls each (prints/s):')
+    print(f'   without glyph cache        : {uncached:10.0f}')
+    print(f'   cold glyph cache           : {cold:10.0f}')
+    print(f'   warm glyph cache           : {warm:10.0f}, {warm_size} bytes cached, same pixels={ok}')
+    print(f'   256 colors                 : {len(cache.palettes)} palettes, {cache.evictions} evictions, no empty palette={palettes_ok}')
+    return ok and palettes_ok
+
+
+def legacy_hline(disp, x0, x1, y, color):
+    """ Horizontal line as drawn before the slice-based primitives, one pixel at a time, kept as a benchmark reference.
+    """
+    fb = disp.fb
+    a = (x0 + y * disp.WIDTH) * disp.BYTES_PER_PIXEL
+    for i in range(x1 - x0):
+        fb[a] = color >> 8; a +=1
+        fb[a] = color & 0xFF; a +=1
+
+
+def legacy_vline(disp, x, y0, y1, color):
+    """ Vertical line as drawn before the slice-based primitives, kept as a benchmark reference.
+    """
+    fb = disp.fb
+    a = (x + y0 * disp.WIDTH) * disp.BYTES_PER_PIXEL
+    for i in range(y1 - y0):
+        fb[a] = color >> 8
+        fb[a+1] = color & 0xFF
+        a += disp.BYTES_PER_LINE
+
+
+def bench_fill_primitives(n=2000):
+    """ Measure the slice-based line and rectangle primitives against per-pixel loops, and check that they draw the
+    same pixels.
+
+    Returns:
+
+        bool: True if the primitives draw the same pixels as the per-pixel loops
+    """
+    spi = SPI_with_CS(cs_inout_pins=[Pin(0)])
+    (new, old) = (ssd1331.SSD1331(spi, Pin(2), Pin(3), Pin(4)) for _ in range(2))
+    color = new.GREEN
+    # list box frame of 6 items, as drawn by GUI.list_box() before and after the slice-based primitives
+    (x0, y0, x1, cp) = (10, 2, 60, 9)
+    y1 = y0 + 1 + 6 * cp
+    old.clear(update=False, color=old.BLUE)
+    legacy_vline(old, x0, y0, y1, color)
+    legacy_vline(old, x1, y0, y1, color)
+    for i in range(7):
+        legacy_hline(old, x0, x1, y0 + i * cp, color)
+    new.clear(update=False, color=new.BLUE)
+    new.rect(x0, y0, x1, y1 - 1, color)
+    for i in range(1, 6):
+        new.hline(x0 + 1, x1, y0 + i * cp, color)
+    ok = bytes(new.fb) == bytes(old.fb)
+    blue = bytes((new.BLUE >> 8, new.BLUE & 0xFF))
+    ok = ok and bytes(new.fb[:2]) == blue and bytes(new.fb[-2:]) == blue
+    w = new.WIDTH
+    h = new.HEIGHT
+    print(f'Display primitives, {n} calls each (calls/s):')
+    print(f'   per-pixel hline({w} px)     : {rate(lambda: legacy_hline(old, 0, w, 5, color), n):10.0f}')
+    print(f'   hline({w} px)               : {rate(lambda: new.hline(0, w, 5, color), n):10.0f}')
+    print(f'   per-pixel vline({h} px)     : {rate(lambda: legacy_vline(old, 5, 0, h, color), n):10.0f}')
+    print(f'   vline({h} px)               : {rate(lambda: new.vline(5, 0, h, color), n):10.0f}')
+    print(f'   fill_rect({w}x{h})           : {rate(lambda: new.fill_rect(0, 0, w - 1, h - 1, color), n):10.0f}, same pixels={ok}')
+    return ok
+
+
+def draw_golden_scene(disp):
+    """ Draws a scene using all the `Display` primitives, clipping, both fonts and asymmetric colors.
+    """
+    disp.clear(update=False, color=disp.BLUE)
+    disp.fill_rect(5, 5, 40, 20, disp.YELLOW)
+    disp.fill_rect(-3, 50, 10, 70, disp.GREEN)  # clipped
+    disp.rect(50, 3, 90, 30, disp.WHITE)
+    disp.hline(0, disp.WIDTH, 40, disp.GREEN)
+    disp.vline(45, 0, disp.HEIGHT, disp.WHITE)
+    disp.print('EEMON42', x=52, y=10, fg=disp.BLACK, bg=disp.YELLOW, update=False, font_size=5)
+    disp.print('123.4W', x=2, y=42, fg=disp.GREEN, bg=disp.BLACK, update=False, font_size=8)
+    disp.print('mixed 0x1F', x=0, y=56, fg=0x1234, bg=0xABCD, update=False, font_size=5)
+
+
+GOLDEN_SCENE_SHA1 = '32b9cbf3448214b7adfc3b1cd847369b6319465c'  # SHA1 of the frame buffer drawn by `draw_golden_scene()`
+
+
+def check_golden_image():
+    """ Check that the Python and framebuf drawing paths of `Display`, with and without the glyph cache, draw the golden
+    image. The framebuf path uses `EmulatedFramebuf`.
+
+    Returns:
+
+        bool: True if all the frame buffers match the golden image
+    """
+    spi = SPI_with_CS(cs_inout_pins=[Pin(0)])
+    digests = {}
+    for backend in ('python', 'framebuf'):
+        display.framebuf = EmulatedFramebuf if backend == 'framebuf' else None  # as detected at import time
+        try:
+            oled = ssd1331.SSD1331(spi, Pin(2), Pin(3), Pin(4))
+            cache = oled.glyph_cache
+            for cached in (False, True):
+                oled.glyph_cache = cache if cached else None
+                draw_golden_scene(oled)
+                digests[f'{backend}, {"cached" if cached else "uncached"} glyphs'] = hashlib.sha1(bytes(oled.fb)).hexdigest()
+        finally:
+            display.framebuf = None
+    ok = all(d == GOLDEN_SCENE_SHA1 for d in digests.values())
+    print(f'Display golden image: ok={ok}' + ''.join(f'\n   {k:26s}: {d}' for k, d in digests.items() if d != GOLDEN_SCENE_SHA1))
+    return ok
+
+
+def check_shadow_diff(items=('Power', 'Energy', 'Voltage', 'Harmonics', 'Events', 'Setup')):
+    """ Check that the display shadow copy only sends the changed lines when a list is redrawn with a new highlighted
+    item, as `GUI.list_box()` does on each encoder step.
+
+    Returns:
+
+        bool: True if only the lines of the two items whose highlight changed were sent, and the shadow copy matches
+            the frame buffer
+    """
+    spi = SPI_with_CS(cs_inout_pins=[Pin(0)])
+    oled = ssd1331.SSD1331(spi, Pin(2), Pin(3), Pin(4))
+    stats = spi.enable_stats({oled.cs_pin: 'display'})
+    oled.set_shadow(True)
+
+    def draw(cur_item):
+        for i, item in enumerate(items):
+            fg, bg = (oled.BLACK, oled.YELLOW) if i == cur_item else (oled.WHITE, oled.BLACK)
+            oled.print(f'{item:10s}', x=1, y=1 + 9 * i, fg=fg, bg=bg, update=False, font_size=8)
+
+    oled.clear(update=False)
+    draw(0)
+    oled.write_frame_buffer()  # first write: the whole display is sent
+    first = stats.bytes_out[0]
+    stats.reset()
+    draw(1)  # redraw all the items with the next one highlighted
+    dirty_bytes = (oled.fb_x1 - oled.fb_x0 + 1) * (oled.fb_y1 - oled.fb_y0 + 1) * 2
+    oled.write_frame_buffer()
+    sent = stats.bytes_out[0]
+    line_bytes = 10 * 8 * 2
+    ok = (sent == 2 * 6 + 2 * 8 * line_bytes  # a window command and 8 lines for each of items 0 and 1 (2 runs)
+          and oled.shadow_last_saved == dirty_bytes - 2 * 8 * line_bytes
+          and bytes(oled.shadow) == bytes(oled.fb))
+    print(f'Display shadow copy: first write {first} bytes, redraw {sent} bytes instead of {dirty_bytes} '
+          f'({oled.shadow_last_saved} pixel bytes saved), ok={ok}')
+    return ok
+
+
+# Limits of the checks run by `__main__`
+ALLOC_PEAK_LIMIT = 1024  # bytes. On the host, the emulated bus and the CPython int objects account for a few hundred bytes.
+HARMONICS_MAX_ERROR = 0.01  # relative to the fundamental
+FIXED_POINT_MAX_ERROR = 2  # output units (mA, mV or mJ)
+SPI_WINDOW_US = 2000  # budget of the queued SPI batches, in us
+POWER_QUALITY_EVENTS = {'sag', 'overvoltage', 'overcurrent'}
+
+
+if __name__ == "__main__":
+    failed = []
+
+    def check(name, passed):
+        if not passed:
+            failed.append(name)
+
+    bench_registers()
+    bench_snapshot()
+    check('check_irq_allocations', check_irq_allocations() < ALLOC_PEAK_LIMIT)
+    check('check_shadow_cache', check_shadow_cache())
+    check('bench_capture', bench_capture(max_blackout_us=SPI_WINDOW_US) <= SPI_WINDOW_US)
+    check('check_harmonics', check_harmonics() < HARMONICS_MAX_ERROR)
+    check('check_power_quality', {event[1] for event in check_power_quality()} == POWER_QUALITY_EVENTS)
+    check('check_line_frequency', check_line_frequency())
+    # chip 0 switches to short windows after the load step and back to long windows, chips 1 and 2 are denied
+    history = check_adaptive_integration()
+    check('check_adaptive_integration', history[2][:3] == [30, 300, 300] and history[-1][:3] == [300, 300, 300])
+    check('check_continuous_mode', check_continuous_mode())
+    check('bench_transaction_queue', bench_transaction_queue(max_window_us=SPI_WINDOW_US) <= SPI_WINDOW_US)
+    check('check_fixed_point', check_fixed_point() < FIXED_POINT_MAX_ERROR)
+    check('check_transfer_allocations', max(check_transfer_allocations()) < ALLOC_PEAK_LIMIT)
+    check('check_spi_stats', check_spi_stats())
+    check('check_blackout_inputs', check_blackout_inputs())
+    (rect_bytes, lines_bytes) = bench_display_update()
+    check('bench_display_update', rect_bytes < lines_bytes)
+    check('bench_print', bench_print())
+    check('bench_fill_primitives', bench_fill_primitives())
+    check('check_golden_image', check_golden_image())
+    check('check_shadow_diff', check_shadow_diff())
+    if failed:
+        print(f'FAILED: {", ".join(failed)}')
+        sys.exit(1)
+    print('All checks passed')
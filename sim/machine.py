@@ -30,6 +30,9 @@ class SPI:
 	def readinto(self, *args, **kwargs):
 		pass
 
+	def write_readinto(self, *args, **kwargs):
+		pass
+
 
 
 def unique_id():
@@ -11,6 +11,8 @@ import struct
 import binascii
 import asyncio
 
+import micropython_time  # NOQA, adds time.ticks_ms() & co.
+
 sys.modules['usocket'] = socket
 sys.modules['ustruct'] = struct
 sys.modules['ubinascii'] = binascii
@@ -0,0 +1,30 @@
+# Add the micropython-specific functions of the `time` module to the CPython `time` module
+import time
+
+_TICKS_PERIOD = 1 << 30  # micropython ticks wrap around at 2**30 on 32-bit ports
+_TICKS_HALFPERIOD = _TICKS_PERIOD // 2
+
+
+def ticks_ms():
+    return (time.monotonic_ns() // 1000000) & (_TICKS_PERIOD - 1)
+
+
+def ticks_us():
+    return (time.monotonic_ns() // 1000) & (_TICKS_PERIOD - 1)
+
+
+def ticks_cpu():
+    return ticks_us()
+
+
+def ticks_add(ticks, delta):
+    return (ticks + delta) & (_TICKS_PERIOD - 1)
+
+
+def ticks_diff(ticks1, ticks2):
+    return ((ticks1 - ticks2 + _TICKS_HALFPERIOD) & (_TICKS_PERIOD - 1)) - _TICKS_HALFPERIOD
+
+
+for _fn in (ticks_ms, ticks_us, ticks_cpu, ticks_add, ticks_diff):
+    if not hasattr(time, _fn.__name__):
+        setattr(time, _fn.__name__, _fn)
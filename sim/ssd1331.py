@@ -25,24 +25,29 @@ class SSD1331(display.Display):
         self.surface.fill((0, 0, 0), (x1, y1, x2, y2))
 
     def write_frame_buffer(self, y0=0, y1=HEIGHT-1):
+        if y0 is None and y1 is None: # update the modified rectangle
+            x0 = max(self.fb_x0, 0)
+            x1 = min(self.fb_x1, self.WIDTH - 1)
+        else:
+            x0 = 0
+            x1 = self.WIDTH - 1
         y0 = y0 if y0 is not None else self.fb_y0
         y1 = y1 if y1 is not None else self.fb_y1
-        if y1 < 0: # indicates that no refresh is necessary
+        if y1 < 0 or x1 < 0: # indicates that no refresh is necessary
             return
         br = self._sim_brightness
         if 1 or br<1:
             print(f'br={br}, self.brightness={self._sim_brightness}')
         for y in range(y0, y1 + 1):
-            a = y * self.BYTES_PER_LINE
-            for x in range(self.WIDTH):
+            a = y * self.BYTES_PER_LINE + x0 * self.BYTES_PER_PIXEL
+            for x in range(x0, x1 + 1):
                 r = self.fb[a] & 0b11111000
                 g = ((self.fb[a] & 0b111) << 5) | ((self.fb[a + 1] & 0b11100000) >> 3)
                 b = (self.fb[a + 1] & 0b11111) << 3
                 # print(f'({x},{y})=({r},{g},{b})')
                 self.surface.set_at((x, y), (r * br, g* br, b * br))
                 a += 2
-        self.fb_y0 = self.HEIGHT - 1
-        self.fb_y1 = -1 # -1 is faster to check than y0 > y1
+        self.clear_dirty()
 
     def _set_brightness(self, brightness):
         print(f'Sim _set_brightness({brightness})')
@@ -0,0 +1,119 @@
+from array import array
+
+
+class AdaptiveIntegration:
+    """ Adapts the line cycle window of each energy monitor chip to the load changes, within an interrupt rate budget.
+
+    Each chip normally uses long windows (`slow_period`), which give few interrupts and precise measurements. When the
+    power of one of its channels changes by more than `step` between two windows, e.g. when an appliance is turned on
+    or off, the chip is switched to short windows (`fast_period`) so the change is reported with a low latency. It is
+    switched back to long windows after `steady_windows` short windows without a power step.
+
+    The interrupt rate of the whole board, i.e. the sum of the window rates of all the chips, is kept below
+    `max_irq_rate` so the chips can't saturate the SPI bus: a chip is not switched to short windows if that would
+    exceed the budget.
+
+    Power steps are detected on the active energy of each window, against a threshold in mJ computed from `step` when
+    the window duration changes, so the checks in the IRQ path stay within MicroPython small integers. The window
+    following a duration change is not checked since its energies can't be compared with the previous window.
+
+    Call `update()` after the measurements of a chip were merged in the `Measurements` store.
+
+    Parameters:
+
+        emon (list of ADE7816): energy monitor chips
+
+        measurements (Measurements): board-wide measurements store
+
+        step (int): power change that switches a chip to short windows, in mW
+
+        fast_period (float): duration of the short windows, in s
+
+        slow_period (float): duration of the long windows, in s
+
+        steady_windows (int): number of short windows without a power step before switching back to long windows
+
+        max_irq_rate (float): maximum number of interrupts per second for the whole board
+    """
+    def __init__(self, emon, measurements, step=50000, fast_period=0.5, slow_period=5, steady_windows=4, max_irq_rate=6):
+        self.emon = emon
+        self.measurements = measurements
+        self.step = step
+        self.fast_period = fast_period
+        self.slow_period = slow_period
+        self.steady_windows = steady_windows
+        self.max_irq_rate = max_irq_rate
+        self.max_rate = int(max_irq_rate * 1000)  # interrupt rate budget, in interrupts per 1000 s
+        self.last_energy = array('i', [0] * measurements.n_channels)  # active energy of the previous window, in mJ
+        self.window_ms = array('i', [0] * len(emon))  # duration of the last window of each chip, in ms
+        self.step_mj = array('i', [0] * len(emon))  # `step` over the window of each chip, in mJ
+        self.fast = bytearray(len(emon))  # 1 if the chip uses short windows
+        self.steady = array('i', [0] * len(emon))  # number of short windows since the last power step
+        self.denied = 0  # number of times a chip was kept in long windows because of the interrupt rate budget
+        self.rate = 0  # interrupt rate of the whole board, in interrupts per 1000 s, see `set_integ_cycles()`
+        for e in emon:
+            self.rate += self.window_rate(e, e.integ_cycles)
+
+    @staticmethod
+    def window_rate(e, n):
+        """ Returns the number of interrupts per 1000 s of a chip with windows of `n` line cycles.
+        """
+        return e.line_frequency * 1000 // n
+
+    def irq_rate(self):
+        """ Returns the number of interrupts per second of the whole board with the current windows.
+        """
+        return self.rate / 1000
+
+    def set_integ_cycles(self, chip, n):
+        """ Changes the window of a chip and updates the board interrupt rate.
+
+        Parameters:
+
+            chip (int): chip number
+
+            n (int): number of line cycles
+        """
+        e = self.emon[chip]
+        self.rate += self.window_rate(e, n) - self.window_rate(e, e.integ_cycles)
+        e.set_integ_cycles(n)
+
+    def update(self, chip):
+        """ Checks the last measurements of a chip for power steps and adapts its window.
+
+        Parameters:
+
+            chip (int): chip number
+        """
+        m = self.measurements
+        last_energy = self.last_energy
+        active = m.active
+        # a new window duration (more than 1/8 off) also covers the first window, as window_ms starts at 0
+        w = m.window_us[chip] // 1000
+        checked = abs(w - self.window_ms[chip]) <= w >> 3
+        if not checked:
+            self.window_ms[chip] = w
+            self.step_mj[chip] = self.step * w // 1000
+        step_mj = self.step_mj[chip]
+        stepped = False
+        for k in m.slots[chip]:
+            energy = active[k]
+            if checked and abs(energy - last_energy[k]) > step_mj:
+                stepped = True
+            last_energy[k] = energy
+        e = self.emon[chip]
+        if stepped:
+            self.steady[chip] = 0
+            if not self.fast[chip]:
+                fast_cycles = max(1, int(self.fast_period * e.line_frequency))
+                rate = self.rate - self.window_rate(e, e.integ_cycles) + self.window_rate(e, fast_cycles)
+                if rate <= self.max_rate:
+                    self.set_integ_cycles(chip, fast_cycles)
+                    self.fast[chip] = 1
+                else:
+                    self.denied += 1
+        elif self.fast[chip]:
+            self.steady[chip] += 1
+            if self.steady[chip] >= self.steady_windows:
+                self.set_integ_cycles(chip, int(self.slow_period * e.line_frequency))
+                self.fast[chip] = 0
@@ -1,15 +1,133 @@
 import time
+from array import array
 
 # import pyftdi.spi
 from machine import Pin
 
+from measurements import Measurements
+
 def BIT(x):
     return 1 << x
 
+FX_LO_BITS = 10  # number of low bits of the raw value that are scaled separately by `fx_scale()`
+
+def fixed_point(scale, bits=17):
+    """ Return the fixed-point (multiplier, shift) pair that approximates a multiplication by `scale` in `fx_scale()`.
+
+    The multiplier is kept below ``2**bits`` (unless `scale` is large) so the partial products computed by
+    `fx_scale()` on 22-bit register values remain micropython small integers and don't allocate memory.
+
+    Parameters:
+
+        scale (float): scale factor, in output units per LSB
+
+        bits (int): maximum number of bits of the multiplier
+
+    Returns:
+
+        tuple: (mult, shift), with ``shift >= FX_LO_BITS``
+    """
+    shift = FX_LO_BITS
+    while round(scale * (1 << (shift + 1))) < (1 << bits):
+        shift += 1
+    return (round(scale * (1 << shift)), shift)
+
+def fx_scale(raw, mult, shift):
+    """ Return ``raw * mult >> shift`` computed in two parts so the intermediate products stay small integers.
+    """
+    return ((raw >> FX_LO_BITS) * mult >> (shift - FX_LO_BITS)) + ((raw & ((1 << FX_LO_BITS) - 1)) * mult >> shift)
+
+class Register:
+    """ Precompiled descriptor of an ADE7816 register.
+
+    Descriptors are built once at import time from the `ADE7816.REGS` and
+    `ADE7816.FORMATS` tables so the SPI fast paths (`ADE7816.read()` and
+    `ADE7816.write()`) don't have to perform any string lookup or compute the
+    command and sign extension parameters on every transaction.
+
+    Parameters:
+
+        name (str): register name
+
+        addr (int): 16-bit register address
+
+        fmt (str): register format, as a key of `ADE7816.FORMATS`
+
+        index (int): index of the register in the shadow register cache
+
+    """
+    def __init__(self, name, addr, fmt, index):
+        (byte_length, bit_length, signed) = ADE7816.FORMATS[fmt]
+        self.name = name
+        self.index = index
+        self.cached = name not in ADE7816.VOLATILE_REGS  # configuration registers are kept in the shadow cache
+        self.addr = addr
+        self.addr_hi = addr >> 8  # first address byte of the command
+        self.addr_lo = addr & 0xff  # second address byte of the command
+        self.fmt = fmt
+        self.byte_length = byte_length
+        self.bit_length = bit_length
+        self.sign_mask = (1 << (bit_length - 1)) if signed else 0  # 0 for unsigned registers: sign test always fails
+        self.span = 1 << bit_length  # value to subtract from negative numbers
+        self.msb_mask = (1 << (bit_length - 8 * (byte_length - 1))) - 1  # mask of the valid bits of the most significant byte
+
+    def normalize(self, value):
+        """ Return `value` as it would be read back from the register after being written.
+        """
+        value &= self.span - 1
+        if value & self.sign_mask:
+            value -= self.span
+        return value
+
+    def __repr__(self):
+        return f'<Register {self.name} @0x{self.addr:04X} {self.fmt}>'
+
+
+class ConfigContext:
+    """ SPI context of a batch of configuration register writes, see `ADE7816.config_context`.
+
+    Contexts can be nested. When the outermost context exits after configuration registers were written, the chip
+    CHECKSUM register is read in the same SPI context and becomes the reference of `ADE7816.verify_config()`, so a
+    chip reset that happens after the batch is detected.
+
+    Parameters:
+
+        emon (ADE7816): chip whose configuration is written
+    """
+    def __init__(self, emon):
+        self.emon = emon
+        self.depth = 0
+
+    def __enter__(self):
+        self.emon.spi.__enter__()
+        self.depth += 1
+
+    def __exit__(self, e1, e2, e3):
+        emon = self.emon
+        self.depth -= 1
+        try:
+            if not self.depth and emon.config_dirty and e1 is None:
+                emon.checksum = emon._read(Registers.CHECKSUM)
+                emon.config_dirty = False
+        finally:
+            emon.spi.__exit__(e1, e2, e3)
+
+
 class ADE7816:
     """ Class allowing operation of the ADE7816 split-phase 6-channel energy monitor chip through a SPI interface.
     """
     STATUS0_LENERGY = BIT(5)
+    # Power-quality interrupt flags of STATUS1 and MASK1
+    STATUS1_SAG = BIT(16)  # voltage sag
+    STATUS1_OI = BIT(17)  # overcurrent
+    STATUS1_OV = BIT(18)  # overvoltage
+    STATUS1_PKI = BIT(23)  # end of a current peak detection period
+    STATUS1_PKV = BIT(24)  # end of a voltage peak detection period
+    # CONFIG bit selecting the channels D-F instead of A-C in the IAWV_IDWV, IBWV_IEWV and ICWV_IFWV registers.
+    # The bit position is assumed from the ADE7816 register map and must be checked against the datasheet revision.
+    CONFIG_CHANNEL_SEL = BIT(9)
+    # Current channels of the instantaneous value registers, for each state of the CONFIG_CHANNEL_SEL bit
+    WAVEFORM_GROUPS = ((0, 1, 2), (3, 4, 5))
 
     REGS = {
         'VGAIN' : (0x4380, '32ZPSE'),  #0x000000 Voltage gain adjustment.
@@ -121,6 +239,14 @@ class ADE7816:
         'DUMMY' : (0xEBFF, '8U'),  # used For dummy writes at startup. has no effect.
     }   
 
+    # Registers that are changed by the chip or have side effects when written. They are not kept in the shadow cache.
+    VOLATILE_REGS = ('VRMS', 'IARMS', 'IBRMS', 'ICRMS', 'IDRMS', 'IERMS', 'IFRMS', 'RUN',
+                     'AWATTHR', 'BWATTHR', 'CWATTHR', 'DWATTHR', 'EWATTHR', 'FWATTHR',
+                     'AVARHR', 'BVARHR', 'CVARHR', 'DVARHR', 'EVARHR', 'FVARHR',
+                     'IPEAK', 'VPEAK', 'STATUS0', 'STATUS1', 'IAWV_IDWV', 'IBWV_IEWV', 'ICWV_IFWV', 'VWV',
+                     'CHECKSUM', 'CHSTATUS', 'ANGLE0', 'ANGLE1', 'ANGLE2', 'PERIOD', 'CHNOLOAD', 'CHSIGN', 'VERSION',
+                     'CONFIG2', 'DUMMY')
+
     FORMATS = {
         # name: (byte_length, bit_length, is_signed)
         '32U': (4, 32, False),  # unsigned 32-bit value
@@ -136,6 +262,56 @@ class ADE7816:
 
     CHANNELS = 'ABCDEF'
 
+    # Default calibration of each current channel. Keys can be overridden by `set_calibration()`.
+    CHANNEL_CALIBRATION = {
+        'ct_cal': 0.312/20,  # Vrms/Irms # SCT-013 = 1Vrms/20Irms,100 ohm burden, including divider network and its input impedance, Vout=0.436Vp/20Arms, 
+        'energy_cal': 0.519,  #1.22155 # J/lsb. Has to be recalibrated if ct_cal is changed.
+        'igain': 0,  # IxGAIN register: current gain adjustment
+        'irmsos': 0,  # IxRMSOS register: RMS current offset
+        'wgain': 0,  # xWGAIN register: active power gain adjustment
+        'wattos': 0,  # xWATTOS register: active power offset
+        'vargain': 0,  # xVARGAIN register: reactive power gain adjustment
+        'varos': 0,  # xVAROS register: reactive power offset
+        'pcf': None,  # PCF_x_COEFF register: phase calibration coefficient. None selects `PCF_COEFF` for the line frequency.
+        }
+
+    # Default phase calibration coefficients of each supported line frequency (Hz)
+    PCF_COEFF = {50: 0x400CA4, 60: 0x401235}
+
+    # Default calibration of the voltage channel. Keys can be overridden by `set_calibration()`.
+    CHIP_CALIBRATION = {
+        'v_gain': 499/(499+21500),  # voltage divider gain
+        'vt_cal': 10.8/120,  # output volts / input volts (use no-load output voltage value since we are far from full load)
+        'vgain': 0,  # VGAIN register: voltage gain adjustment
+        'vrmsos': 0,  # VRMSOS register: RMS voltage offset
+        }
+
+    # Energy accumulation modes, see `set_accumulation_mode()`
+    LINE_CYCLE = 'line_cycle'  # energies are accumulated over LINECYC half line cycles and the chip interrupts at the end of each window
+    CONTINUOUS = 'continuous'  # energies are accumulated continuously, and read and reset by `poll()`
+
+    # Default power-quality event detection settings. Keys can be overridden by `set_power_quality()`.
+    # Levels are in volts and amperes; a level of 0 disables the detection.
+    POWER_QUALITY = {
+        'sag_level': 0,  # RMS voltage below which a sag is detected, in V
+        'sag_cycles': 2,  # SAGCYC register: number of half line cycles below the sag level
+        'overvoltage': 0,  # RMS voltage above which an overvoltage is detected, in V. Compared with the voltage peaks.
+        'overcurrent': 0,  # RMS current above which an overcurrent is detected, in A. Compared with the current peaks.
+        'peak_cycles': 100,  # PEAKCYC register: number of half line cycles of the peak detection periods
+        'peak_voltage': 0,  # voltage peak of a detection period above which an event is logged, in V
+        'peak_current': 0,  # current peak of a detection period above which an event is logged, in A
+        }
+
+    # Layout of the measurement snapshot array filled by `read_snapshot()`. 
+    # Per-channel values are stored at <offset> + channel number (0-5).
+    SNAP_WATTHR = 0  # active energy of channels A-F
+    SNAP_VARHR = 6  # reactive energy of channels A-F
+    SNAP_IRMS = 12  # RMS current of channels A-F
+    SNAP_ANGLE = 18  # ANGLE0, ANGLE1, ANGLE2 time delays
+    SNAP_VRMS = 21  # RMS voltage
+    SNAP_PERIOD = 22  # line period
+    SNAP_SIZE = 23
+
     def __init__(self, spi, cs_pin, irq_pin, irq_wrapper, index):
         """ Create the energy monitor object, but don't initialize the hardware yet.
 
@@ -153,123 +329,931 @@ class ADE7816:
         self.irq_pin = irq_pin
         self.irq_wrapper = irq_wrapper
         self.cmd = bytearray(3+4)  # command & data bytes
-        self.rx_buf = bytearray(4) # reply word
+        self.rx_buf = bytearray(3+4) # full-duplex reply: 3 don't care bytes clocked in during the command, then the reply word
+        # Precompute the buffer views for every transfer length so transactions don't create new memoryviews
+        cmd_view = memoryview(self.cmd)
+        rx_view = memoryview(self.rx_buf)
+        self.cmd_views = tuple(cmd_view[:3 + n] for n in range(5))  # command + n data bytes
+        self.rx_views = tuple(rx_view[:3 + n] for n in range(5))  # whole transfer of command + n reply bytes
+        self.data_views = tuple(rx_view[3:3 + n] for n in range(5))  # n reply bytes
         self.index = index
-        self.line_frequency = 60 # in Hz
+        self.shadow = [None] * len(self.REGS)  # shadow cache of the configuration registers, indexed by Register.index. None if unknown.
+        self.config_dirty = False  # True if configuration registers were written since the last `checksum` update
+        self.config_context = ConfigContext(self)  # ``with`` context of the configuration writes, updates `checksum`
+        self.checksum = None  # CHECKSUM register value expected for the current configuration
+        self.skipped_writes = 0  # number of register writes skipped because the shadow cache showed no change
+        self.resync_count = 0  # number of times the configuration had to be restored
+        self.line_frequency = 60 # in Hz, see `set_line_frequency()`
         self.integ_cycles = self.line_frequency * 5 # amount of integration, in line cycles
-        self.ct_cal = 0.312/20 # Vrms/Irms # SCT-013 = 1Vrms/20Irms,100 ohm burden, including divider network and its input impedance, Vout=0.436Vp/20Arms, 
+        self.window_cycles = self.integ_cycles  # line cycles of the window being accumulated, see `set_integ_cycles()`
+        self.accumulation_mode = self.LINE_CYCLE
+        self.last_poll_us = time.ticks_us()  # time.ticks_us() of the last `poll()`
         # irq_handler = irq_wrapper(self.irq_handler) if irq_wrapper else self.irq_handler;
         # self.irq_pin.irq(trigger=Pin.IRQ_FALLING, handler=self.irq_handler) 
-        self.v_gain = 499/(499+21500)
-        self.vt_cal = 10.8/120 # output volts / input volts (use no-load output voltage value since we are far from full load)
         self.t0 = time.time_ns()
-        self.total_energy = 0
-        self.energy_cal = 0.519 #1.22155 # J/lsb
-        self.energy_count = 0
+        self.set_calibration()  # use default calibration until a calibration table is provided
+        self.snapshot = self.new_snapshot()  # raw registers values read by the IRQ handler
+        self.record = Measurements.new_record()  # latest measurements, updated in place by the IRQ handler
+        self.spurious_irq_count = 0  # number of times the IRQ handler was called without a LENERGY flag
+        self.power_quality = dict(self.POWER_QUALITY)  # power-quality event detection settings
+        self.peak_voltage_level = 0  # VPEAK value above which a peak voltage event is logged. 0 if disabled.
+        self.peak_current_level = 0  # IPEAK value above which a peak current event is logged. 0 if disabled.
+        self.status1 = 0  # pending STATUS1 flags enabled in MASK1, see `pending_irq()`
+        self.event_log = None  # EventLog receiving the power-quality events. Events are not logged if None.
+        self.debug_interval = 0  # minimum time between debug prints in ms. 0 disables the debug prints.
+        self.last_debug_ticks = 0
 
 
-    def init(self):
+    def init(self, expected_checksum=None, start=True):
         """ Initialize the energy monitor chip
+
+        The whole register programming sequence is performed in a single SPI context. If `expected_checksum` is
+        provided, the communication test is skipped and the configuration is instead verified by comparing the
+        chip's CHECKSUM register with the expected value. The full communication test and programming sequence is
+        performed only if the checksums don't match.
+
+        The initialization time is stored in `init_time_us`.
+
+        Parameters:
+
+            expected_checksum (int): CHECKSUM register value returned by a previous initialization with the same
+                configuration. If None, the full initialization is performed.
+
+            start (bool): start the DSP. Set to False to start the DSPs of several chips together later, so their line
+                cycle windows are synchronized.
+
+        Returns:
+
+            int: CHECKSUM register value of the configured chip. Can be stored and used as `expected_checksum` on
+                the next initialization.
         """
         print(f'Initializing ADE7816 Energy monitor {self.index}')
+        t0 = time.ticks_us()
+        fast = expected_checksum is not None
+        self.invalidate_shadow()  # we don't know the state of the chip
+        with self.config_context:
+            self.select_spi()
+            if not fast:
+                self.test_communication()
+            self.write_config()
+            checksum = self.read(Registers.CHECKSUM)
+            if fast and checksum != expected_checksum:
+                print(f'EMON{self.index}: checksum mismatch (expected {expected_checksum:08X}, read {checksum:08X}). Performing full initialization.')
+                fast = False
+                self.test_communication()
+                self.invalidate_shadow()
+                self.write_config()
+                checksum = self.read(Registers.CHECKSUM)
+            self.checksum = checksum
+            self.config_dirty = False
+            if start:
+                self.start_dsp()
+                self.start_dsp()
+                self.start_dsp()
+        self.t0 = time.time_ns()
+        self.init_time_us = time.ticks_diff(time.ticks_us(), t0)
+        print(f'EMON{self.index}: {"fast" if fast else "full"} initialization took {self.init_time_us/1000:.1f} ms, checksum={checksum:08X}')
+        return checksum
 
-
+    def select_spi(self):
+        """ Selects and locks the SPI interface of the chip.
+        """
         # make sure we are in SPI mode by issuing 3 dummy writes as recommended by datasheet. 
         # otherwise we will be in I2C mode
         for _ in range(3):
-            self.write_reg('DUMMY',0)
+            self._write(Registers.DUMMY, 0)
         # lock the SPI serial port choice by writing any value to CONFIG2
-        self.write_reg('CONFIG2', 0b00000000) # 
+        self._write(Registers.CONFIG2, 0b00000000) # 
 
+    def test_communication(self):
+        """ Test communications with the chip by writing and reading back values in a register
 
-        # Test communications with the chip by writing and reading back values in a register
+        Raises:
+
+            RuntimeError: if a value could not be read back.
+        """
         for v in (0x00000000, 0x10101010, 0x55555555, 0xDDDDDDDD, 0xFFFFFFFF, 0):
-                self.write_reg('MASK0', v) 
-                vv = self.read_reg('MASK0') 
+                self._write(Registers.MASK0, v) 
+                vv = self._read(Registers.MASK0) 
                 if v != vv:
                     # print(f'EMON{self.index}: SPI Communication error. Wrote {v:08X}, read {vv:08x}.')
                     raise RuntimeError(f'EMON{self.index}: SPI Communication error. Wrote {v:08X}, read {vv:08x}.')
-        # set active energy integration threshold
-        # A value should be 0x000002_000000 for standard operation. The update rate of the WATTHR rehister is then just below the max of 8 kHz for full scale.  
-        self.write_reg('WTHR1', 0x000002)
-        self.write_reg('WTHR0', 0x000000)
-        # set reactive energy integration threshold
-        self.write_reg('VARTHR1', 0x000000)
-        self.write_reg('VARTHR0', 0x400000)
-        self.write_reg('LINECYC', self.integ_cycles * 2) # integration perion in half cycles
-        self.write_reg('LCYCMODE', 0b00001011) # Enable zero crossing detector and line accumulation mode
-
-        self.write_reg('MASK0', self.STATUS0_LENERGY) 
-        self.write_reg('MASK1', 0 ) 
-        # Clear IRQ0
-        status0 = self.read_reg('STATUS0')        
-        self.write_reg('STATUS0', status0) 
-        # Clear IRQ1
-        status1 = self.read_reg('STATUS1')        
-        self.write_reg('STATUS1', status1) 
-
-        PCF_CAL_VALUE = 0x401235 # 0x401235 for 60 Hz, 0x 400ca4 for 50 Hz
-        for ch in self.CHANNELS:
-            self.write_reg(f'PCF_{ch}_COEFF', PCF_CAL_VALUE)  
-
-        # repeat last write to ensure the value propagates through the pipeline, as requested in the datasheet
-        for i in range(2):
-            self.write_reg(f'PCF_{self.CHANNELS[-1]}_COEFF', PCF_CAL_VALUE)
-
-        self.start_dsp()
-        self.start_dsp()
-        self.start_dsp()
-        self.t0 = time.time_ns()
-        
-    def irq_handler(self, pin):
-        status0 = self.read_reg('STATUS0')        
-        status1 = self.read_reg('STATUS1')        
-        lenergy_irq = bool(status0 & self.STATUS0_LENERGY)
-        dt = (time.time_ns() - self.t0) / 1e9
-        if lenergy_irq:
-            energy = self.read_reg('AWATTHR') * self.energy_cal
-            reactive_energy = self.read_reg('AVARHR') * self.energy_cal
-            angle = self.read_reg('ANGLE0')*360*60/256000
-            current = self.get_current(0)
-            voltage = self.get_voltage()
-            self.total_energy += energy 
-            self.energy_count += 1
-            dt = int(self.integ_cycles * 2) / 2 / self.line_frequency       
-            apparent_energy = current * voltage * dt
-            power_factor = energy / apparent_energy
-            print(f'{dt:.3f} EMON{self.index}: #{self.energy_count}, volt = {voltage:.3f} V, curr={current:.3f} A, '
-                  +f'app = {apparent_energy/dt} VA, act: {energy/dt:.3f} W, react: {reactive_energy/dt:.3f} VAr, angle={angle}, PF={power_factor:.2}, tot act= {self.total_energy/3600} Wh')
-            # print(f'{dt:.3f} IRQ={pin()} LENERGY={lenergy_irq} EMON{self.index}: status0={status0:024b}, status1={status1:016b}, AWATTHR={energy} W, tot = {self.total_energy/3600} kWh')
-            self.write_reg('STATUS0', self.STATUS0_LENERGY)
+        self.shadow[Registers.MASK0.index] = 0
+
+    def write_config(self):
+        """ Programs the energy accumulation, interrupt and calibration registers.
+        """
+        with self.config_context:
+            # set active energy integration threshold
+            # A value should be 0x000002_000000 for standard operation. The update rate of the WATTHR rehister is then just below the max of 8 kHz for full scale.  
+            self.write(Registers.WTHR1, 0x000002)
+            self.write(Registers.WTHR0, 0x000000)
+            # set reactive energy integration threshold
+            self.write(Registers.VARTHR1, 0x000000)
+            self.write(Registers.VARTHR0, 0x400000)
+            self.arm_line_cycle()
+
+            self.write(Registers.MASK0, self.STATUS0_LENERGY if self.accumulation_mode == self.LINE_CYCLE else 0) 
+            self.write_power_quality()
+            self.clear_irq()
+
+            self.write_calibration()
+
+    def arm_line_cycle(self):
+        """ Programs the accumulation mode and the number of line cycles of the accumulation window.
+
+        The window starts when the DSP is started (see `start_dsp()`).
+        """
+        with self.config_context:
+            self.write(Registers.LINECYC, self.integ_cycles * 2) # integration perion in half cycles
+            if self.accumulation_mode == self.LINE_CYCLE:
+                self.write(Registers.LCYCMODE, 0b00001011) # Enable zero crossing detector and line accumulation mode
+            else:
+                self.write(Registers.LCYCMODE, 0b01000000) # Continuous accumulation, energy registers reset on read (RSTREAD)
+
+    def set_accumulation_mode(self, mode):
+        """ Selects the energy accumulation mode.
+
+        In `LINE_CYCLE` mode, the chip interrupts at the end of each window and the measurements are processed by
+        `irq_handler()`. In `CONTINUOUS` mode, the LENERGY interrupt is disabled and the energies are read and reset
+        by `poll()`. Both produce the same measurement records.
+
+        Parameters:
+
+            mode (str): `LINE_CYCLE` or `CONTINUOUS`
+        """
+        if mode not in (self.LINE_CYCLE, self.CONTINUOUS):
+            raise ValueError(f'Unknown accumulation mode: {mode}')
+        self.accumulation_mode = mode
+        with self.config_context:
+            self.arm_line_cycle()
+            self.write(Registers.MASK0, self.STATUS0_LENERGY if mode == self.LINE_CYCLE else 0)
+            if mode == self.CONTINUOUS:
+                self.read_snapshot(self.snapshot)  # reset the energy registers
+                self.last_poll_us = time.ticks_us()
+            self._write(Registers.STATUS0, self.STATUS0_LENERGY)
+
+    def set_power_quality(self, settings=None):
+        """ Sets the power-quality event detection settings.
+
+        The registers are written to the chip by `write_power_quality()`, which is called by `init()`.
+
+        Parameters:
+
+            settings (dict): any of the `POWER_QUALITY` keys. Missing keys keep their current value.
+        """
+        self.power_quality.update(settings or {})
+
+    def write_power_quality(self):
+        """ Programs the sag, overvoltage, overcurrent and peak detection registers and enables their interrupts.
+
+        The levels are converted from volts and amperes with the current calibration. The chip compares the
+        instantaneous values with the levels, so RMS levels are converted to peak values. The overcurrent level is
+        common to all channels: the most sensitive channel calibration is used so no overcurrent is missed.
+        """
+        pq = self.power_quality
+        sqrt2 = 1.4142135623730951
+        # The instantaneous value registers have the same LSB as the RMS registers (see `measure_harmonics()`)
+        voltage_lsb = 0.5*0.707/4191910 / self.v_gain / self.vt_cal  # V/LSB
+        current_lsb = max(0.5*0.707/4191910 / ct_cal for ct_cal in self.ct_cal)  # A/LSB of the most sensitive channel
+        mask1 = 0
+        with self.config_context:
+            if pq['sag_level']:
+                self.write(Registers.SAGLVL, min(0xFFFFFF, int(pq['sag_level'] * sqrt2 / voltage_lsb)))
+                self.write(Registers.SAGCYC, pq['sag_cycles'])
+                mask1 |= self.STATUS1_SAG
+            else:
+                self.write(Registers.SAGLVL, 0)
+            if pq['overvoltage']:
+                self.write(Registers.OVLVL, min(0xFFFFFF, int(pq['overvoltage'] * sqrt2 / voltage_lsb)))
+                mask1 |= self.STATUS1_OV
+            else:
+                self.write(Registers.OVLVL, 0xFFFFFF)
+            if pq['overcurrent']:
+                self.write(Registers.OILVL, min(0xFFFFFF, int(pq['overcurrent'] * sqrt2 / current_lsb)))
+                mask1 |= self.STATUS1_OI
+            else:
+                self.write(Registers.OILVL, 0xFFFFFF)
+            self.peak_voltage_level = int(pq['peak_voltage'] / voltage_lsb)
+            self.peak_current_level = int(pq['peak_current'] / current_lsb)
+            if self.peak_voltage_level or self.peak_current_level:
+                self.write(Registers.PEAKCYC, pq['peak_cycles'])
+                mask1 |= (self.STATUS1_PKV if self.peak_voltage_level else 0) | (self.STATUS1_PKI if self.peak_current_level else 0)
+            self.write(Registers.MASK1, mask1)
+
+    def set_integ_cycles(self, n):
+        """ Changes the number of line cycles of the accumulation windows.
+
+        The chip applies the new LINECYC value from the next window; the conversion factors are updated by the IRQ
+        handler when the current window completes.
+
+        Parameters:
+
+            n (int): number of line cycles
+        """
+        self.integ_cycles = n
+        self.arm_line_cycle()
+
+    def clear_irq(self):
+        """ Clears all the pending interrupt flags, releasing the IRQ0 and IRQ1 lines.
+        """
+        with self.spi:
+            # Clear IRQ0
+            status0 = self._read(Registers.STATUS0)        
+            self._write(Registers.STATUS0, status0) 
+            # Clear IRQ1
+            status1 = self._read(Registers.STATUS1)        
+            self._write(Registers.STATUS1, status1) 
+
+    def pending_irq(self):
+        """ Returns the interrupt flags of the chip that are enabled in MASK0, i.e. the ones that assert the IRQ0 line.
+
+        Use this to find which chips are asserting an IRQ line shared by several chips. The MASK0 value comes from the
+        shadow cache, so this costs a single register read. If power-quality interrupts are enabled in MASK1,
+        STATUS1 is also read and its enabled flags are saved in `status1`.
+
+        Returns:
+
+            int: STATUS0 flags that are enabled in MASK0. 0 if the chip is not asserting its IRQ0 line, in which case
+                `status1` may still have pending power-quality interrupts.
+        """
+        mask1 = self.read(Registers.MASK1)
+        self.status1 = self._read(Registers.STATUS1) & mask1 if mask1 else 0
+        return self._read(Registers.STATUS0) & self.read(Registers.MASK0)
+
+    def power_quality_enabled(self):
+        """ Returns True if power-quality interrupts are enabled in MASK1. The MASK1 value comes from the shadow cache.
+        """
+        return bool(self.read(Registers.MASK1))
+
+    def irq_handler(self, pin, status0=None):
+        """ Processes the chip interrupt by updating the measurement record with the latest line cycle energy window.
+
+        The record (see `Measurements` for its layout) holds the energies, RMS current and power factor of all six
+        channels. This is called on every line cycle interrupt, so it does not allocate memory nor prints anything;
+        use `print_record()` or set `debug_interval` to see the measurements.
+
+        Parameters:
+
+            pin (machine.Pin): IRQ pin that caused the interrupt. Not used.
+
+            status0 (int): STATUS0 value if it was already read by `pending_irq()`. Read from the chip if None.
+
+        Returns:
+
+            bool: True if the record was updated with a new line cycle window.
+        """
+        if status0 is None:
+            status0 = self.pending_irq()
+        status1 = self.status1
+        if status1:
+            self.service_events(status1)
+            self.status1 = 0
+        if not status0 & self.STATUS0_LENERGY:
+            if not status1:
+                self.spurious_irq_count += 1
+            return False
+        snap = self.read_snapshot(self.snapshot)
+        self._write(Registers.STATUS0, self.STATUS0_LENERGY)
+        period = snap[22]  # SNAP_PERIOD
+        # The window duration is proportional to the line period. PERIOD is in 256 kHz ticks.
+        self.update_record(snap, period, self.nominal_period, self.window_cycles * period * 125 // 32)
+        if self.window_cycles != self.integ_cycles:
+            # LINECYC was changed during the window that just completed: the new value applies to the next one
+            self.window_cycles = self.integ_cycles
+            self.update_scale_factors()
+        if self.debug_interval:
+            self.print_record()
+        return True
+
+    def poll(self, t_us=None):
+        """ Reads and resets the energy registers in continuous accumulation mode and updates the measurement record.
+
+        The window of the record is the time since the previous poll. Poll all the chips in the same SPI context with
+        the same `t_us` to get synchronized measurements. This does not allocate memory.
+
+        Parameters:
+
+            t_us (int): time.ticks_us() of the poll. Default is the current time.
+        """
+        snap = self.read_snapshot(self.snapshot)
+        if t_us is None:
+            t_us = time.ticks_us()
+        window_us = time.ticks_diff(t_us, self.last_poll_us)
+        self.last_poll_us = t_us
+        self.update_record(snap, window_us // 1000, self.nominal_window_ms, window_us)
+        if self.debug_interval:
+            self.print_record()
+
+    def update_record(self, snap, window, nominal_window, window_us):
+        """ Converts a snapshot of the measurement registers into the measurement record.
+
+        Parameters:
+
+            snap (array): snapshot filled by `read_snapshot()`
+
+            window, nominal_window (int): ratio of the duration of the accumulation window to the nominal window
+                duration used by `update_scale_factors()`, as two integers in the same units. Used to scale the
+                apparent energy of the power factor.
+
+            window_us (int): duration of the accumulation window, in us
+        """
+        rec = self.record
+        ma_mult = self.ma_mult
+        ma_shift = self.ma_shift
+        mj_mult = self.mj_mult
+        mj_shift = self.mj_shift
+        apparent_div = self.apparent_div
+        vrms = snap[21]  # SNAP_VRMS
+        vrms8 = (vrms >> 8) * window // nominal_window
+        i = 0
+        # Conversions are inlined versions of fx_scale(), with FX_LO_BITS = 10
+        for ch in range(6):
+            active = snap[ch]  # SNAP_WATTHR
+            reactive = snap[ch + 6]  # SNAP_VARHR
+            irms = snap[ch + 12]  # SNAP_IRMS
+            # Apparent energy in WATTHR counts, with the RMS values reduced to 14 bits so the product stays a small int
+            apparent = ((irms >> 8) * vrms8) // apparent_div[ch]
+            m = mj_mult[ch]
+            sh = mj_shift[ch]
+            rec[i] = ((active >> 10) * m >> (sh - 10)) + ((active & 0x3FF) * m >> sh)  # REC_ACTIVE
+            rec[i + 1] = ((reactive >> 10) * m >> (sh - 10)) + ((reactive & 0x3FF) * m >> sh)  # REC_REACTIVE
+            m = ma_mult[ch]
+            sh = ma_shift[ch]
+            rec[i + 2] = ((irms >> 10) * m >> (sh - 10)) + ((irms & 0x3FF) * m >> sh)  # REC_IRMS
+            rec[i + 3] = active * 1000 // apparent if apparent else 0  # REC_PF
+            i += 4  # REC_FIELDS
+        m = self.mv_mult
+        sh = self.mv_shift
+        vrms = ((vrms >> 10) * m >> (sh - 10)) + ((vrms & 0x3FF) * m >> sh)
+        rec[i] = vrms  # REC_VRMS
+        rec[i + 1] = snap[22]  # REC_PERIOD = SNAP_PERIOD
+        rec[i + 2] += 1  # REC_COUNT
+        rec[i + 3] = time.ticks_ms()  # REC_TICKS
+        rec[i + 4] = window_us  # REC_WINDOW
+
+    def service_events(self, status1):
+        """ Logs the power-quality events flagged in STATUS1 to `event_log` and clears the flags.
+
+        The channel of overcurrent events is given by the CHSTATUS register, and the channel of current peaks by the
+        channel bits of IPEAK. This does not allocate memory.
+
+        Parameters:
+
+            status1 (int): STATUS1 flags to service
+        """
+        log = self.event_log
+        with self.spi:
+            self._write(Registers.STATUS1, status1)  # clear the flags
+            if log is None:
+                return
+            if status1 & (self.STATUS1_SAG | self.STATUS1_OV | self.STATUS1_PKV):
+                vpeak = self._read(Registers.VPEAK) & 0xFFFFFF
+                vpeak_mv = fx_scale(vpeak, self.mv_mult, self.mv_shift)
+                if status1 & self.STATUS1_SAG:
+                    log.add(log.SAG, self.index, -1, fx_scale(self._read(Registers.VRMS), self.mv_mult, self.mv_shift))
+                if status1 & self.STATUS1_OV:
+                    log.add(log.OVERVOLTAGE, self.index, -1, vpeak_mv)
+                if status1 & self.STATUS1_PKV and vpeak > self.peak_voltage_level:
+                    log.add(log.PEAK_VOLTAGE, self.index, -1, vpeak_mv)
+            if status1 & (self.STATUS1_OI | self.STATUS1_PKI):
+                ipeak = self._read(Registers.IPEAK)
+                if status1 & self.STATUS1_OI:
+                    chstatus = self._read(Registers.CHSTATUS)
+                    for ch in range(6):
+                        if chstatus & (1 << ch):  # overcurrent flag of channel ch
+                            log.add(log.OVERCURRENT, self.index, ch,
+                                    fx_scale(ipeak & 0xFFFFFF, self.ma_mult[ch], self.ma_shift[ch]))
+                if status1 & self.STATUS1_PKI and ipeak & 0xFFFFFF > self.peak_current_level:
+                    ch = -1
+                    for i in range(6):
+                        if ipeak & (1 << (24 + i)):  # channel that had the peak
+                            ch = i
+                    log.add(log.PEAK_CURRENT, self.index, ch,
+                            fx_scale(ipeak & 0xFFFFFF, self.ma_mult[max(ch, 0)], self.ma_shift[max(ch, 0)]))
+
+    def set_calibration(self, cal=None, defaults=None):
+        """ Sets the calibration of the chip and of its six channels, and updates the conversion factors.
+
+        The calibration registers values are written to the chip by `write_calibration()`, which is called by `init()`.
+
+        Parameters:
+
+            cal (dict): chip calibration. Can contain any `CHIP_CALIBRATION` key, and a 'channels' list with one dict
+                per channel (A to F), each containing any of the `CHANNEL_CALIBRATION` keys. Missing keys take their
+                default value.
+
+            defaults (dict): channel calibration values used instead of the `CHANNEL_CALIBRATION` defaults.
+        """
+        cal = cal or {}
+        channel_defaults = dict(self.CHANNEL_CALIBRATION)
+        channel_defaults.update(defaults or {})
+        channels_cal = cal.get('channels', ())
+        channels = []
+        for ch in range(6):
+            c = dict(channel_defaults)
+            if ch < len(channels_cal):
+                c.update(channels_cal[ch])
+            channels.append(c)
+        chip = dict(self.CHIP_CALIBRATION)
+        for (k, v) in cal.items():
+            if k != 'channels':
+                chip[k] = v
+
+        self.v_gain = chip['v_gain']
+        self.vt_cal = chip['vt_cal']
+        self.ct_cal = [c['ct_cal'] for c in channels]
+        self.energy_cal = [c['energy_cal'] for c in channels]
+        self.chip_cal = chip
+        self.channels_cal = channels
+        self.update_cal_regs()
+        self.update_scale_factors()
+
+    def update_cal_regs(self):
+        """ Builds the list of calibration (register, value) pairs written by `write_calibration()`.
+
+        Must be called after the calibration or the line frequency are changed.
+        """
+        R = Registers
+        chip = self.chip_cal
+        cal_regs = [(R.VGAIN, chip['vgain']), (R.VRMSOS, chip['vrmsos'])]
+        for ch, c in enumerate(self.channels_cal):
+            cal_regs += [
+                (R.IGAIN[ch], c['igain']),
+                (R.IRMSOS[ch], c['irmsos']),
+                (R.WGAIN[ch], c['wgain']),
+                (R.WATTOS[ch], c['wattos']),
+                (R.VARGAIN[ch], c['vargain']),
+                (R.VAROS[ch], c['varos']),
+                (R.PCF_COEFF[ch], self.PCF_COEFF[self.line_frequency] if c['pcf'] is None else c['pcf'])]
+        self.cal_regs = cal_regs
+
+    def measure_line_frequency(self):
+        """ Measures the line frequency with the PERIOD register and returns the matching nominal frequency.
+
+        The DSP must have been running for a few line cycles.
+
+        Returns:
+
+            int: nominal line frequency (one of the `PCF_COEFF` keys), or None if the measured frequency is not within
+                5% of a nominal frequency.
+        """
+        f = self.get_frequency()
+        for nominal in self.PCF_COEFF:
+            if abs(f - nominal) < nominal * 0.05:
+                return nominal
+        return None
+
+    def set_line_frequency(self, f):
+        """ Sets the nominal line frequency and updates the frequency-dependent settings.
+
+        The phase calibration coefficients, the number of line cycles of the accumulation window (keeping the same
+        duration) and the conversion factors are updated, and the changed registers are written to the chip. The DSP
+        should then be restarted so the new window starts on a line cycle boundary.
+
+        Parameters:
+
+            f (int): nominal line frequency, in Hz. One of the `PCF_COEFF` keys.
+
+        Returns:
+
+            bool: True if the line frequency was changed.
+        """
+        if f == self.line_frequency:
+            return False
+        if f not in self.PCF_COEFF:
+            raise ValueError(f'Unsupported line frequency: {f} Hz')
+        self.integ_cycles = self.integ_cycles * f // self.line_frequency
+        self.window_cycles = self.integ_cycles
+        self.line_frequency = f
+        self.update_cal_regs()
+        self.update_scale_factors()
+        with self.config_context:
+            self.write_calibration()
+            self.arm_line_cycle()
+        return True
+
+    def write_calibration(self):
+        """ Writes the calibration registers of the chip in a single SPI context.
+
+        The gain and offset corrections are then applied by the chip DSP instead of in Python.
+        """
+        with self.config_context:
+            for (reg, value) in self.cal_regs:
+                self.write(reg, value)
+            # repeat last write to ensure the value propagates through the pipeline, as requested in the datasheet
+            (reg, value) = self.cal_regs[-1]
+            for i in range(2):
+                self._write(reg, value)
+
+    def update_scale_factors(self):
+        """ Computes the fixed-point conversion factors from raw register values to mA, mV and mJ.
+
+        Must be called after the calibration constants or the integration period are changed.
+        """
+        # a value of 4191910 (0x3FF6A6) corresponds to a full scale analog voltage of 0.5Vp or 0.5*.707= 0.3535 Vrms. 
+        voltage_lsb = 0.5*0.707/4191910 / self.v_gain / self.vt_cal  # V/LSB
+        dt = self.window_cycles / self.line_frequency  # nominal integration time, in s
+        self.nominal_period = round(256000 / self.line_frequency)  # PERIOD value at the nominal line frequency
+        self.nominal_window_ms = round(dt * 1000)  # nominal window duration
+        (self.mv_mult, self.mv_shift) = fixed_point(voltage_lsb * 1000)
+        # Per-channel factors
+        self.ma_mult = array('i', [0] * 6)
+        self.ma_shift = array('i', [0] * 6)
+        self.mj_mult = array('i', [0] * 6)
+        self.mj_shift = array('i', [0] * 6)
+        # Divider giving the apparent energy of a nominal line cycle window in WATTHR counts from (IxRMS >> 8) * (VRMS >> 8)
+        self.apparent_div = array('i', [0] * 6)
+        for ch in range(6):
+            current_lsb = 0.5*0.707/4191910 / self.ct_cal[ch]  # A/LSB
+            (self.ma_mult[ch], self.ma_shift[ch]) = fixed_point(current_lsb * 1000)
+            (self.mj_mult[ch], self.mj_shift[ch]) = fixed_point(self.energy_cal[ch] * 1000)
+            self.apparent_div[ch] = max(1, round(self.energy_cal[ch] / (65536 * current_lsb * voltage_lsb * dt)))
+
+    def print_record(self, force=False):
+        """ Prints the measurement record in physical units, at most once every `debug_interval` ms.
+
+        This is a debugging tool: the conversion and formatting allocate memory and printing blocks on the console.
+
+        Parameters:
+
+            force (bool): print even if the last print was less than `debug_interval` ms ago.
+        """
+        t = time.ticks_ms()
+        if not force and time.ticks_diff(t, self.last_debug_ticks) < self.debug_interval:
+            return
+        self.last_debug_ticks = t
+        rec = self.record
+        dt = rec[Measurements.REC_WINDOW] / 1e6 or self.integ_cycles / self.line_frequency  # integration time, in s
+        voltage = rec[Measurements.REC_VRMS] / 1000
+        print(f'EMON{self.index}: #{rec[Measurements.REC_COUNT]}, volt = {voltage:.3f} V')
+        for ch, c in enumerate(self.CHANNELS):
+            i = ch * Measurements.REC_FIELDS
+            energy = rec[i + Measurements.REC_ACTIVE] / 1000
+            reactive_energy = rec[i + Measurements.REC_REACTIVE] / 1000
+            current = rec[i + Measurements.REC_IRMS] / 1000
+            power_factor = rec[i + Measurements.REC_PF] / 1000
+            print(f'   {c}: curr={current:.3f} A, app = {current * voltage:.3f} VA, act: {energy/dt:.3f} W, '
+                  + f'react: {reactive_energy/dt:.3f} VAr, PF={power_factor:.3f}')
+
+    @classmethod
+    def new_snapshot(cls):
+        """ Return a new zeroed array suitable for `read_snapshot()`.
+
+        Allocate it once and reuse it for every snapshot.
+        """
+        return array('i', [0] * cls.SNAP_SIZE)
+
+    def read_snapshot(self, out):
+        """ Reads the energy, RMS, angle, voltage and period registers of all six channels in a single SPI context.
+
+        The dual-function CS pins are switched to OUT mode only once for the whole snapshot instead of twice per register,
+        and the decoded values are stored in `out` without allocating any memory.
+
+        Parameters:
+
+            out (array): preallocated array of at least `SNAP_SIZE` signed 32-bit integers (see `new_snapshot()`).
+                Values are stored at the ``SNAP_*`` offsets.
+
+        Returns:
+
+            array: `out`
+        """
+        read = self._read  # the snapshot registers are never cached
+        i = 0
+        with self.spi:
+            for reg in Registers.SNAPSHOT:
+                out[i] = read(reg)
+                i += 1
+        return out
+
+    def capture(self, wf, n_samples=None, regs=None, max_blackout_us=2000):
+        """ Captures waveform samples from the instantaneous value registers into a `Waveform` ring buffer.
+
+        The registers are read in a tight loop and each sample is timestamped with time.ticks_us(). The sample rate is
+        limited by the SPI transactions, not by the 8 kHz update rate of the registers; use `Waveform.timing()` to
+        get the achieved sample rate and jitter.
+
+        The pin interrupts of the buttons and rotary encoder are blocked while the SPI port is active. To limit that
+        blackout, the SPI context is released every `max_blackout_us` to let the pending pin interrupts be
+        processed; the longest blackout is saved in `wf.max_blackout_us`.
+
+        Parameters:
+
+            wf (Waveform): buffer receiving the samples. Its number of signals must match the number of registers.
+
+            n_samples (int): number of samples to capture. Default is the capacity of the buffer.
+
+            regs (tuple of Register): registers to read in each sample. Default is ``Registers.WAVEFORM``.
+
+            max_blackout_us (int): maximum time the SPI port is held, in us
+
+        Returns:
+
+            Waveform: `wf`
+        """
+        regs = regs or Registers.WAVEFORM
+        if len(regs) != wf.n_signals:
+            raise ValueError(f'The waveform buffer has {wf.n_signals} signals but {len(regs)} registers are captured')
+        n = n_samples or wf.n_samples
+        read = self._read
+        spi = self.spi
+        ticks_us = time.ticks_us
+        ticks_diff = time.ticks_diff
+        data = wf.data
+        ticks = wf.ticks
+        size = wf.n_samples
+        head = wf.head
+        max_blackout = 0
+        sample_us = 0  # longest time to read a sample
+        done = 0
+        while done < n:
+            with spi:
+                t_start = t = ticks_us()
+                first = done
+                while done < n:
+                    # release the SPI port before a sample that would exceed the blackout limit if it took as long as
+                    # the longest one
+                    if done > first and ticks_diff(t, t_start) + sample_us > max_blackout_us:
+                        break
+                    ticks[head] = t
+                    j = head * len(regs)
+                    for reg in regs:
+                        data[j] = read(reg)
+                        j += 1
+                    head += 1
+                    if head == size:
+                        head = 0
+                    done += 1
+                    t_end = ticks_us()
+                    sample_us = max(sample_us, ticks_diff(t_end, t))
+                    t = t_end
+                max_blackout = max(max_blackout, ticks_diff(ticks_us(), t_start))
+        wf.head = head
+        wf.count = min(wf.count + n, size)
+        wf.max_blackout_us = max_blackout
+        return wf
+
+    def select_waveform_group(self, channels):
+        """ Selects the current channels sampled by the instantaneous value registers (``Registers.WAVEFORM``).
+
+        The CONFIG register is written only if the selection changes (see `write()`).
+
+        Parameters:
+
+            channels (tuple of int): one of `WAVEFORM_GROUPS`, (0, 1, 2) for A-C or (3, 4, 5) for D-F
+        """
+        config = self.read(Registers.CONFIG)
+        if channels == self.WAVEFORM_GROUPS[1]:
+            config |= self.CONFIG_CHANNEL_SEL
         else:
-            print(f'{dt:.3f} EMON{self.index}: LENERGY flag not set, ignoring')
+            config &= ~self.CONFIG_CHANNEL_SEL
+        with self.config_context:
+            self.write(Registers.CONFIG, config)
 
+    def measure_harmonics(self, bank, out, channels=(0, 1, 2), n_cycles=6, period_us=500, max_blackout_us=2000):
+        """ Measures the fundamental and harmonics of the currents and voltage with streaming Goertzel filters.
 
-    def read_reg(self, name):
-        """Reads a register
+        The instantaneous value registers (``Registers.WAVEFORM``) are sampled every `period_us` and each sample is fed
+        directly to the filters of `bank`, so no waveform buffer is needed. The filters are tuned to the line
+        frequency measured by `get_frequency()`, and `n_cycles` line cycles are analyzed.
+
+        The full scale of the instantaneous value registers is sqrt(2) times the full scale of the RMS registers, so
+        the harmonic RMS values are converted with the same scale factors as the RMS current and voltage.
+
+        As in `capture()`, the SPI context is released every `max_blackout_us` so pin interrupts are not blocked for
+        the whole measurement.
 
         Parameters:
 
-            name (str): name of register to read
+            bank (Harmonics): filters bank with 4 signals (3 currents and the voltage)
+
+            out (array): receives the RMS value of each harmonic of each signal, at ``<signal> * len(bank.harmonics) +
+                <harmonic index>``. Currents are in mA and the voltage is in mV.
+
+            channels (tuple of int): current channels to measure, (0, 1, 2) for A-C or (3, 4, 5) for D-F. The
+                matching group is selected in the waveform registers with the CONFIG_CHANNEL_SEL bit.
+
+            n_cycles (int): number of line cycles to analyze
+
+            period_us (int): sampling period, in us. Must be longer than the time needed to read and filter a sample.
+
+            max_blackout_us (int): maximum time the SPI port is held, in us
 
         Returns:
 
-            int: value that was read. Will be a signed or unsigned value depending on the register number format. 
+            int: number of samples that were taken late because the sampling period was too short
+        """
+        channels = tuple(channels)
+        if channels not in self.WAVEFORM_GROUPS:
+            raise ValueError(f'Channels {channels} are not a waveform group {self.WAVEFORM_GROUPS}')
+        self.select_waveform_group(channels)
+        f = self.get_frequency() or self.line_frequency
+        bank.tune(f, 1e6 / period_us)
+        n = int(n_cycles * 1e6 / period_us / f + 0.5)
+        regs = Registers.WAVEFORM
+        values = array('i', [0] * len(regs))
+        read = self._read
+        feed = bank.feed
+        spi = self.spi
+        ticks_us = time.ticks_us
+        ticks_diff = time.ticks_diff
+        late = 0
+        sample_us = 0  # longest time to read and filter a sample
+        done = 0
+        deadline = ticks_us()
+        while done < n:
+            with spi:
+                t_start = ticks_us()
+                first = done
+                while done < n:
+                    # release the SPI port before a sample that would exceed the blackout limit if it took as long as
+                    # the longest one. It starts at the deadline, or right away if the deadline is already passed.
+                    next_start = max(ticks_diff(deadline, t_start), ticks_diff(ticks_us(), t_start))
+                    if done > first and next_start + sample_us > max_blackout_us:
+                        break
+                    dt = ticks_diff(deadline, ticks_us())
+                    while dt > 0:
+                        dt = ticks_diff(deadline, ticks_us())
+                    if dt < -period_us // 2:
+                        late += 1
+                    deadline = time.ticks_add(deadline, period_us)
+                    t = ticks_us()
+                    for i in range(len(regs)):
+                        values[i] = read(regs[i])
+                    feed(values)
+                    done += 1
+                    sample_us = max(sample_us, ticks_diff(ticks_us(), t))
+        nh = len(bank.harmonics)
+        j = 0
+        for k in range(len(regs)):
+            if k < len(channels):
+                (mult, shift) = (self.ma_mult[channels[k]], self.ma_shift[channels[k]])
+            else:
+                (mult, shift) = (self.mv_mult, self.mv_shift)
+            for i in range(nh):
+                out[j] = fx_scale(int(bank.rms(k, i)), mult, shift)
+                j += 1
+        return late
+
+    def read(self, reg):
+        """Reads a register using its precompiled descriptor.
+
+        Configuration registers are read from the shadow cache if their value is known. Other registers are read from the chip.
+
+        Parameters:
+
+            reg (Register): descriptor of the register to read, e.g. ``Registers.STATUS0``
+
+        Returns:
+
+            int: value that was read. Will be a signed or unsigned value depending on the register number format.
+        """
+        if reg.cached:
+            value = self.shadow[reg.index]
+            if value is None:
+                value = self.shadow[reg.index] = self._read(reg)
+            return value
+        return self._read(reg)
+
+    def write(self, reg, value):
+        """Writes a register using its precompiled descriptor.
+
+        The SPI transaction is skipped if the shadow cache shows the configuration register already has that value.
+
+        Parameters:
+
+            reg (Register): descriptor of the register to write, e.g. ``Registers.MASK0``
+
+            value (int): value to write. Negative values are written in two's complement.
+        """
+        if reg.cached:
+            value = reg.normalize(value)
+            if self.shadow[reg.index] == value:
+                self.skipped_writes += 1
+                return
+            self.shadow[reg.index] = value
+            self.config_dirty = True
+            with self.config_context:  # reads the new CHECKSUM reference, unless in a larger batch
+                self._write(reg, value)
+            return
+        self._write(reg, value)
+
+    async def read_async(self, reg):
+        """ Reads a register through the SPI transaction queue, see `SPI_with_CS.call()`.
+
+        Use this from asyncio tasks that are not time critical so the read is batched with the other queued transactions.
+
+        Parameters:
+
+            reg (Register): descriptor of the register to read
+
+        Returns:
+
+            int: value that was read
+        """
+        return await self.spi.call(self.read, reg)
+
+    async def write_async(self, reg, value):
+        """ Writes a register through the SPI transaction queue, see `SPI_with_CS.call()`.
+
+        Parameters:
+
+            reg (Register): descriptor of the register to write
+
+            value (int): value to write
         """
+        await self.spi.call(self.write, reg, value)
+
+    def _read(self, reg):
+        """Reads a register from the chip, bypassing the shadow cache.
 
-        (addr, fmt) = self.REGS[name]
-        (byte_length, bit_length, signed) = self.FORMATS[fmt]
+        This is the fast path used by the measurement code: no string lookup and no memory allocation other than the returned integer.
+        The command and the reply are clocked in a single full-duplex transfer; the bytes sent after the address are don't care.
+        """
         cmd = self.cmd
-        rx_buf = self.rx_buf
+        n = reg.byte_length
         cmd[0] = 1
-        cmd[1] = addr >> 8
-        cmd[2] = addr & 0xff
-        self.spi.exchange(self.cs_pin, memoryview(cmd)[:3], memoryview(rx_buf)[:byte_length])
-        value = int.from_bytes(rx_buf[:byte_length], 'big')
-        if signed and value & (1 << (bit_length - 1)):
-            value -= (1 << bit_length)
+        cmd[1] = reg.addr_hi
+        cmd[2] = reg.addr_lo
+        self.spi.transfer(self.cs_pin, self.cmd_views[n], self.rx_views[n])
+        value = int.from_bytes(self.data_views[n], 'big')
+        if value & reg.sign_mask:
+            value -= reg.span
         return value
 
+    def _write(self, reg, value):
+        """Writes a register of the chip, bypassing the shadow cache.
+        """
+        cmd = self.cmd
+        n = reg.byte_length
+        cmd[0] = 0
+        cmd[1] = reg.addr_hi
+        cmd[2] = reg.addr_lo
+        i = 2 + n
+        while i > 2:  # fill the data bytes MSB first without creating a temporary bytes object
+            cmd[i] = value & 0xff
+            value >>= 8
+            i -= 1
+        cmd[3] &= reg.msb_mask  # zero-pad the sign extension of the shorter formats
+        self.spi.transfer(self.cs_pin, self.cmd_views[n])
+
+    def invalidate_shadow(self):
+        """ Marks all the shadow cache entries as unknown so the next reads and writes access the chip.
+        """
+        shadow = self.shadow
+        for i in range(len(shadow)):
+            shadow[i] = None
+
+    def verify_config(self):
+        """ Checks that the chip configuration still matches the shadow cache, and restores it if it does not.
+
+        The chip CHECKSUM register is compared with the value read in the SPI context of the last configuration change
+        (see `config_context`). A mismatch indicates that the chip lost its configuration (e.g. after a brown-out
+        reset), in which case all the cached registers are written back and the DSP is restarted.
+
+        Returns:
+
+            bool: True if the configuration was valid, False if it had to be restored.
+        """
+        if self.checksum is None:  # not configured yet
+            return True
+        checksum = self._read(Registers.CHECKSUM)
+        if checksum == self.checksum:
+            return True
+        print(f'EMON{self.index}: configuration checksum changed from {self.checksum:08X} to {checksum:08X}. Restoring configuration.')
+        self.resync_count += 1
+        with self.spi:
+            self.select_spi()
+            last_dsp_write = None
+            for (name, reg) in REGISTERS.items():
+                value = self.shadow[reg.index]
+                if value is not None:
+                    self._write(reg, value)
+                    if reg.addr < 0x43C0:  # DSP memory register (0x4380-0x43BF)
+                        last_dsp_write = (reg, value)
+            # repeat last DSP memory write to ensure the value propagates through the pipeline, as requested in the datasheet
+            if last_dsp_write:
+                for i in range(2):
+                    self._write(*last_dsp_write)
+            self.start_dsp()
+            self.checksum = self._read(Registers.CHECKSUM)
+        self.config_dirty = False
+        return False
+
+    def read_reg(self, name):
+        """Reads a register
+
+        Parameters:
+
+            name (str): name of register to read
+
+        Returns:
+
+            int: value that was read. Will be a signed or unsigned value depending on the register number format. 
+        """
+        return self.read(REGISTERS[name])
+
     def write_reg(self, name, value):
         """Writes a register
 
@@ -280,22 +1264,13 @@ class ADE7816:
             value (int): value to write
 
         """
-
-        (addr, fmt) = self.REGS[name]
-        (byte_length, bit_length, signed) = self.FORMATS[fmt]
-        # print(f"writing {bytes((0, (addr>>8) & 0xFF, addr & 0xFF)) + value.to_bytes(length, 'big')}")
-        cmd = self.cmd
-        cmd[0] = 0
-        cmd[1] = addr >> 8
-        cmd[2] = addr & 0xff
-        cmd[3:3+byte_length] = value.to_bytes(byte_length, 'big')
-        self.spi.exchange(self.cs_pin, memoryview(cmd)[:3+byte_length])
+        self.write(REGISTERS[name], value)
  
     def start_dsp(self):
-        self.write_reg('RUN', 1)
+        self._write(Registers.RUN, 1)
         
     def stop_dsp(self):
-        self.write_reg('RUN', 0)
+        self._write(Registers.RUN, 0)
 
     def get_frequency(self):
         """ Return the line frequency
@@ -304,7 +1279,7 @@ class ADE7816:
 
             float: line frequency in Hz. 0 If there is are transitions detected on the line.
         """
-        p = self.read_reg('PERIOD')
+        p = self._read(Registers.PERIOD)
         return 256e3/p if p else 0;
 
     def get_current(self, ch):
@@ -313,17 +1288,50 @@ class ADE7816:
         Parameters:
 
             ch (int): channel number (0-5)
+
+        Returns:
+
+            float: RMS current, in A
         """
-        c = self.CHANNELS[ch]
-        # a value of 4191910 (0x3FF6A6) corresponds to a full scale analog voltage of 0.5Vp or 0.5*.707= 0.3535 Vrms. 
-        return self.read_reg(f'I{c}RMS')/4191910*0.5*0.707 / self.ct_cal
+        return fx_scale(self._read(Registers.IRMS[ch]), self.ma_mult[ch], self.ma_shift[ch]) / 1000
 
     def get_voltage(self):
         """ Get instantaneous RMS voltage measurement 
 
+        Returns:
+
+            float: RMS voltage, in V
         """
-        # a value of 4191910 (0x3FF6A6) corresponds to a full scale analog voltage of 0.5Vp or 0.5*.707= 0.3535 Vrms. 
-        return self.read_reg(f'VRMS')/4191910*0.5*0.707 / self.v_gain / self.vt_cal
+        return fx_scale(self._read(Registers.VRMS), self.mv_mult, self.mv_shift) / 1000
+
+
+# Precompiled register descriptors, built once at import time
+REGISTERS = {name: Register(name, addr, fmt, ix) for ix, (name, (addr, fmt)) in enumerate(ADE7816.REGS.items())}
+
+class Registers:
+    """ Namespace giving attribute access to the precompiled register descriptors (e.g. ``Registers.AWATTHR``).
+
+    Per-channel registers are also grouped in tuples indexed by channel number (0-5 for channels A-F) so
+    the channel loops don't have to build register names.
+    """
+    IRMS = tuple(REGISTERS[f'I{c}RMS'] for c in ADE7816.CHANNELS)
+    IRMSOS = tuple(REGISTERS[f'I{c}RMSOS'] for c in ADE7816.CHANNELS)
+    IGAIN = tuple(REGISTERS[f'I{c}GAIN'] for c in ADE7816.CHANNELS)
+    WGAIN = tuple(REGISTERS[f'{c}WGAIN'] for c in ADE7816.CHANNELS)
+    WATTOS = tuple(REGISTERS[f'{c}WATTOS'] for c in ADE7816.CHANNELS)
+    VARGAIN = tuple(REGISTERS[f'{c}VARGAIN'] for c in ADE7816.CHANNELS)
+    VAROS = tuple(REGISTERS[f'{c}VAROS'] for c in ADE7816.CHANNELS)
+    WATTHR = tuple(REGISTERS[f'{c}WATTHR'] for c in ADE7816.CHANNELS)
+    VARHR = tuple(REGISTERS[f'{c}VARHR'] for c in ADE7816.CHANNELS)
+    PCF_COEFF = tuple(REGISTERS[f'PCF_{c}_COEFF'] for c in ADE7816.CHANNELS)
+    # Registers read by `ADE7816.read_snapshot()`, in the order of the ``ADE7816.SNAP_*`` offsets
+    SNAPSHOT = WATTHR + VARHR + IRMS + tuple(REGISTERS[name] for name in ('ANGLE0', 'ANGLE1', 'ANGLE2', 'VRMS', 'PERIOD'))
+    # Instantaneous value registers read by `ADE7816.capture()`: three current channels and the voltage
+    WAVEFORM = tuple(REGISTERS[name] for name in ('IAWV_IDWV', 'IBWV_IEWV', 'ICWV_IFWV', 'VWV'))
+
+for _name, _reg in REGISTERS.items():
+    setattr(Registers, _name, _reg)
+
 
 def test(N=0):
     from machine import Pin
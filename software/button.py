@@ -20,6 +20,7 @@ class Button:
       delay (int): debouncing delay, in ms
 
       irq_wrapper (func): Function that wraps the irq handler, typically to mask interrupts under some external conditions.
+        It is called with the handler and the pin, e.g. `SPI_with_CS.get_irq()`.
 
     Principle of operation:  When an IRQ occurs, we store the value of the pin
     in ``self.last_state``. If the value has changed, we store the time of the
@@ -35,7 +36,7 @@ class Button:
         self._up = 0
         self.last_state = 1
         if irq_wrapper:
-            self.sw.irq(irq_wrapper(self.process_irq))
+            self.sw.irq(irq_wrapper(self.process_irq, self.sw))
         else:
             self.sw.irq(self.process_irq)
 
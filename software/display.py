@@ -1,6 +1,12 @@
 import time
 
 import font
+from glyph_cache import GlyphCache
+
+try:
+    import framebuf  # C implementation of the drawing primitives, available on MicroPython
+except ImportError:
+    framebuf = None  # CPython and simulator: the primitives are drawn in Python
 
 
 class Display:
@@ -16,12 +22,23 @@ class Display:
     GREEN = 0b00000_111111_00000
     BLUE = 0b00000_000000_11111
 
+    GLYPH_CACHE_BYTES = 4096  # byte budget of the glyph cache used by `print()`. 0 disables the cache.
+    USE_FRAMEBUF = True  # draw the primitives and glyphs with the framebuf module when it is available
+
     def __init__(self):
         self.BYTES_PER_LINE = self.WIDTH * self.BYTES_PER_PIXEL
         self.fb = memoryview(bytearray(self.BYTES_PER_LINE * self.HEIGHT)) # frame buffer, 2 bytes per pixel
-        self.zeros = memoryview(bytearray(self.BYTES_PER_LINE)) # preallocate a line of zeros for efficiency
-
-
+        self.color_line = memoryview(bytearray(self.BYTES_PER_LINE)) # preallocated line of pixels of `color_line_color`, see `color_row()`
+        self.color_line_color = self.BLACK
+        # framebuf view of the frame buffer. framebuf stores the RGB565 pixels in the little-endian order of the CPU,
+        # but the display expects the high byte first: colors are byte-swapped before being passed to framebuf.
+        self.framebuf = None
+        if framebuf and self.USE_FRAMEBUF and self.BYTES_PER_PIXEL == 2:
+            self.framebuf = framebuf.FrameBuffer(self.fb, self.WIDTH, self.HEIGHT, framebuf.RGB565)
+
+        # Rectangle of the frame buffer modified since the last update, see `mark_dirty()`
+        self.fb_x0 = 0  # current lowest modified frame buffer column
+        self.fb_x1 = self.WIDTH-1  # current highest modified frame buffer column
         self.fb_y0 = 0  # current lowest modified frame buffer line
         self.fb_y1 = self.HEIGHT-1  # current highest modified frame buffer line
 
@@ -38,6 +55,7 @@ class Display:
         self.text_y = 0
         self.fg = self.WHITE
         self.bg = self.BLACK
+        self.glyph_cache = GlyphCache(self.GLYPH_CACHE_BYTES) if self.GLYPH_CACHE_BYTES else None  # pre-rendered glyphs
 
     def init(self):
         self.set_brightness(16)
@@ -62,14 +80,48 @@ class Display:
     def update(self, y0=None, y1=None):
         self.write_frame_buffer(y0=y0, y1=y1)
 
-    def clear(self, update=True):
-        addr = 0
-        fb = self.fb
-        for j in range(self.HEIGHT):
-            fb[addr: addr + self.BYTES_PER_LINE] = self.zeros
-            addr += self.BYTES_PER_LINE
-        self.fb_y0 = 0
-        self.fb_y1 = self.HEIGHT - 1
+    async def flush(self):
+        """ Sends the modified frame buffer rectangle to the hardware display from an asyncio task.
+
+            Hardware-specific subclasses can override this to release the SPI port during the transfer. This default
+            implementation sends the rectangle with `write_frame_buffer()`.
+        """
+        self.write_frame_buffer()
+
+    def mark_dirty(self, x0, y0, x1, y1):
+        """ Expands the modified frame buffer rectangle to include a rectangle, so it is sent at the next update.
+
+        Parameters:
+
+            x0, y0, x1, y1 (int): upper-left and lower-right corners of the rectangle, inclusive
+        """
+        if x0 < self.fb_x0:
+            self.fb_x0 = x0
+        if x1 > self.fb_x1:
+            self.fb_x1 = x1
+        if y0 < self.fb_y0:
+            self.fb_y0 = y0
+        if y1 > self.fb_y1:
+            self.fb_y1 = y1
+
+    def clear_dirty(self):
+        """ Empties the modified frame buffer rectangle. Called by `write_frame_buffer()` once the display is updated.
+        """
+        self.fb_x0 = self.WIDTH - 1
+        self.fb_x1 = -1 # -1 is faster to check than x0 > x1
+        self.fb_y0 = self.HEIGHT - 1
+        self.fb_y1 = -1
+
+    def clear(self, update=True, color=BLACK):
+        """ Fills the frame buffer with a color and moves the text cursor to the upper-left corner.
+
+        Parameters:
+
+            update (bool): if True, the frame buffer is sent to the display
+
+            color (int): fill color
+        """
+        self.fill_rect(0, 0, self.WIDTH - 1, self.HEIGHT - 1, color)
         self.text_x = self.text_y = 0
         if update:
             self.write_frame_buffer()
@@ -88,38 +140,111 @@ class Display:
         """ 
         return (r & 0b11111000) << 8 | (g & 0b11111100) << 3 | (b >> 3)
 
+    def color_row(self, color):
+        """ Returns a line of pixels of a color, to be copied in the frame buffer with slice assignments.
+
+        The line is filled by doubling copies and kept until another color is requested.
+
+        Parameters:
+
+            color (int): pixel color
+
+        Returns:
+
+            memoryview: `BYTES_PER_LINE` bytes
+        """
+        line = self.color_line
+        if color != self.color_line_color:
+            line[0] = color >> 8
+            line[1] = color & 0xFF
+            n = 2
+            size = len(line)
+            while n < size:
+                m = min(n, size - n)
+                line[n: n + m] = line[0: m]
+                n += m
+            self.color_line_color = color
+        return line
+
+    def _fill(self, x0, y0, x1, y1, color):
+        """ Fills a rectangle of the frame buffer, one slice assignment per line, without updating the modified
+        rectangle. The corners are inclusive and must be within the display.
+        """
+        if self.framebuf:
+            self.framebuf.fill_rect(x0, y0, x1 - x0 + 1, y1 - y0 + 1, ((color & 0xFF) << 8) | (color >> 8))
+            return
+        n = (x1 - x0 + 1) * self.BYTES_PER_PIXEL
+        fb = self.fb
+        bytes_per_line = self.BYTES_PER_LINE
+        a = (x0 + y0 * self.WIDTH) * self.BYTES_PER_PIXEL
+        if n == 2: # a single column is faster with byte stores than with 2-byte slices
+            hi = color >> 8
+            lo = color & 0xFF
+            for y in range(y0, y1 + 1):
+                fb[a] = hi
+                fb[a + 1] = lo
+                a += bytes_per_line
+            return
+        src = self.color_row(color)[:n]
+        for y in range(y0, y1 + 1):
+            fb[a: a + n] = src
+            a += bytes_per_line
+
+    def fill_rect(self, x0, y0, x1, y1, color=WHITE):
+        """ Fills a rectangle of the frame buffer. The rectangle is clipped to the display.
+
+        Parameters:
+
+            x0, y0, x1, y1 (int): upper-left and lower-right corners of the rectangle, inclusive
+
+            color (int): fill color
+        """
+        x0 = max(x0, 0)
+        y0 = max(y0, 0)
+        x1 = min(x1, self.WIDTH - 1)
+        y1 = min(y1, self.HEIGHT - 1)
+        if x1 < x0 or y1 < y0:
+            return
+        self._fill(x0, y0, x1, y1, color)
+        self.mark_dirty(x0, y0, x1, y1)
+
+    def rect(self, x0, y0, x1, y1, color=WHITE):
+        """ Draws the outline of a rectangle in the frame buffer. The rectangle must be within the display.
+
+        Parameters:
+
+            x0, y0, x1, y1 (int): upper-left and lower-right corners of the rectangle, inclusive
+
+            color (int): line color
+        """
+        if self.framebuf:
+            self.framebuf.rect(x0, y0, x1 - x0 + 1, y1 - y0 + 1, ((color & 0xFF) << 8) | (color >> 8))
+        else:
+            self._fill(x0, y0, x1, y0, color)
+            self._fill(x0, y1, x1, y1, color)
+            self._fill(x0, y0, x0, y1, color)
+            self._fill(x1, y0, x1, y1, color)
+        self.mark_dirty(x0, y0, x1, y1)
+
     def hline(self, x0, x1, y, color = WHITE):
         """ Draws an horizontal line in the frame buffer
 
         Parameters:
 
-            x0, x1, y (int): coordinates of the line. Line will be drawn between (x0,y) and (x1,y).
+            x0, x1, y (int): coordinates of the line. Line will be drawn between (x0,y) and (x1,y), (x1,y) excluded.
 
         """
-        fb = self.fb
-        a = (x0 + y * self.WIDTH) * self.BYTES_PER_PIXEL
-        for i in range(x1 - x0):
-            fb[a] = color >> 8; a +=1
-            fb[a] = color & 0xFF; a +=1
-        self.fb_y0 = min(self.fb_y0, y)  
-        self.fb_y1 = max(self.fb_y1, y) 
+        self.fill_rect(x0, y, x1 - 1, y, color)
 
     def vline(self, x, y0, y1, color = WHITE):
         """ Draws an vertical line in the frame buffer
 
         Parameters:
 
-            x, y0, y1 (int): coordinates of the line. Line will be drawn between (x,y0) and (x,y1).
+            x, y0, y1 (int): coordinates of the line. Line will be drawn between (x,y0) and (x,y1), (x,y1) excluded.
 
         """
-        fb = self.fb
-        a = (x + y0 * self.WIDTH) * self.BYTES_PER_PIXEL
-        for i in range(y1 - y0):
-            fb[a] = color >> 8
-            fb[a+1] = color & 0xFF
-            a += self.BYTES_PER_LINE
-        self.fb_y0 = min(self.fb_y0, y0)  
-        self.fb_y1 = max(self.fb_y1, y1) 
+        self.fill_rect(x, y0, x, y1 - 1, color)
 
     def draw_row_wise_mono_bitmap(self, x: int, y: int, data: list, width=8, height=8, fg=WHITE,  bg=BLACK) -> None:
         """ Writes a 8x8 monochrome bitmap in the frame buffer.
@@ -151,9 +276,8 @@ class Display:
                     fb[a] = bg & 0xFF; a +=1
             addr += self.BYTES_PER_LINE
 
-        # expand the refresh zone to include modified lines
-        self.fb_y0 = min(self.fb_y0, y)  
-        self.fb_y1 = max(self.fb_y1, y + height -1)  
+        # expand the refresh zone to include the bitmap
+        self.mark_dirty(x, y, x + width - 1, y + height - 1)
 
     def draw_col_wise_mono_bitmap(self, x: int, y: int, data: list, width=5, height=7, fg=WHITE, bg=BLACK) -> None:
         """ Writes a 5x7 monochrome bitmap in the frame buffer. Data bytes represent columns.
@@ -183,9 +307,89 @@ class Display:
                 a += self.BYTES_PER_LINE
             addr += self.BYTES_PER_PIXEL
 
-        # expand the refresh zone to include modified lines
-        self.fb_y0 = min(self.fb_y0, y)  
-        self.fb_y1 = max(self.fb_y1, y + height -1)  
+        # expand the refresh zone to include the bitmap
+        self.mark_dirty(x, y, x + width - 1, y + height - 1)
+
+    def render_glyph(self, c, fg, bg):
+        """ Renders a character of the current font as row-major RGB565 pixel bytes, for the glyph cache.
+
+        Parameters:
+
+            c (int): character code
+
+            fg, bg (int): foreground and background colors
+
+        Returns:
+
+            bytearray: pixel bytes, 2 per pixel
+        """
+        width = self.font_width
+        height = self.font_height
+        glyph = bytearray(width * height * 2)
+        fg_hi = fg >> 8
+        fg_lo = fg & 0xFF
+        bg_hi = bg >> 8
+        bg_lo = bg & 0xFF
+        if self.font_is_row_wise: # one byte per row, MSB first
+            data = self.font[c * height: c * height + height]
+            for row in range(height):
+                d = data[row]
+                a = row * width * 2
+                for col in range(width):
+                    on = d & (0x80 >> col)
+                    glyph[a] = fg_hi if on else bg_hi
+                    glyph[a + 1] = fg_lo if on else bg_lo
+                    a += 2
+        else: # one byte per column, LSB on top
+            data = self.font[c * width: c * width + width]
+            for col in range(width):
+                d = data[col]
+                a = col * 2
+                for row in range(height):
+                    on = d & (1 << row)
+                    glyph[a] = fg_hi if on else bg_hi
+                    glyph[a + 1] = fg_lo if on else bg_lo
+                    a += width * 2
+        return glyph
+
+    def wrap_glyph(self, data):
+        """ Returns the object stored in the glyph cache for rendered glyph pixels: a framebuf.FrameBuffer if the
+        framebuf module is used, or a memoryview.
+
+        Parameters:
+
+            data (bytearray): pixel bytes returned by `render_glyph()` for the current font
+        """
+        if self.framebuf:
+            return framebuf.FrameBuffer(data, self.font_width, self.font_height, framebuf.RGB565)
+        return memoryview(data)
+
+    def blit_glyph(self, x, y, glyph, width, height):
+        """ Copies a pre-rendered glyph in the frame buffer, with framebuf or one row per slice assignment.
+
+        framebuf copies the 16-bit pixels unchanged, so the glyph bytes keep the byte order of the display.
+
+        Parameters:
+
+            x, y (int): coordinate of the upper-left corner of the glyph
+
+            glyph (memoryview or framebuf.FrameBuffer): glyph pixels, see `wrap_glyph()`
+
+            width, height (int): size of the glyph, in pixels
+        """
+        if self.framebuf:
+            self.framebuf.blit(glyph, x, y)
+        else:
+            fb = self.fb
+            bytes_per_line = self.BYTES_PER_LINE
+            n = width * 2
+            a = (x + y * self.WIDTH) * 2
+            g = 0
+            for row in range(height):
+                fb[a: a + n] = glyph[g: g + n]
+                a += bytes_per_line
+                g += n
+        self.mark_dirty(x, y, x + width - 1, y + height - 1)
 
     def set_font(self, font_size):
         if font_size==8:
@@ -241,6 +445,9 @@ class Display:
         font_width = self.font_width
         font_height = self.font_height
         font_is_row_wise = self.font_is_row_wise 
+        cache = self.glyph_cache
+        if cache:
+            palette = cache.key(font_width, self.fg, self.bg)  # built once per call
 
         # print(f'Printing {text} at {self.text_x=}, {self.text_y=}')
         for c in text:
@@ -254,7 +461,14 @@ class Display:
                 self.text_x = 0
                 self.text_y += font_height
  
-            if font_is_row_wise: # implied 8x8 font with row-wise encoding
+            if cache: # copy the pre-rendered glyph
+                code = ord(c)
+                glyph = cache.get(palette, code)
+                if glyph is None:
+                    data = self.render_glyph(code, self.fg, self.bg)
+                    glyph = cache.add(palette, code, self.wrap_glyph(data), len(data))
+                self.blit_glyph(self.text_x, self.text_y, glyph, font_width, font_height)
+            elif font_is_row_wise: # implied 8x8 font with row-wise encoding
                 cc = ord(c) * self.font_height # x8
                 bitmap = font[cc: cc + font_height]
                 self.draw_row_wise_mono_bitmap(self.text_x, self.text_y, bitmap, width=font_width, height=font_height, fg=self.fg, bg=self.bg)
@@ -8,6 +8,7 @@ import machine
 import network
 # import esp
 import json
+from array import array
 
 import sys
 if sys.implementation.name == 'micropython':
@@ -24,6 +25,10 @@ from button import Button
 from spi import SPI_with_CS
 from rotary_encoder import RotaryEncoder
 from gui import GUI
+from measurements import Measurements
+from harmonics import Harmonics
+from events import EventLog
+from adaptive import AdaptiveIntegration
 
 
 
@@ -33,6 +38,8 @@ class EEMON42:
 
     topic_sub = b'notification'
     topic_pub = b'home/sensor1/infojson'
+    topic_harmonics = b'home/sensor1/harmonics'
+    topic_spi_stats = b'home/sensor1/spi_stats'
 
 
 
@@ -116,8 +123,32 @@ class EEMON42:
         self.emon = [ADE7816(spi=self.spi, cs_pin=cs_pin, irq_pin=self.pin_cs6_irq, irq_wrapper=self.spi.get_irq, index=ix) 
                      for ix, cs_pin in enumerate(emon_cs_pins)]
 
+        # Board-wide store of the measurements of all the energy monitor channels
+        self.measurements = Measurements(len(self.emon))
+
+        # Shared IRQ line demultiplexing and statistics, indexed by chip number
+        n = len(self.emon)
+        self.irq_ticks_us = 0  # time.ticks_us() of the last IRQ line assertion
+        self.irq_status = array('i', [0] * n)  # pending STATUS0 flags of each chip, see `demux_emon_irq()`
+        self.irq_pending_since = array('i', [0] * n)  # time.ticks_us() of the IRQ line assertion for each pending chip
+        self.irq_count = array('i', [0] * n)  # number of interrupts serviced
+        self.irq_latency_us = array('i', [0] * n)  # time from the IRQ line assertion to the service of the last interrupt, in us
+        self.irq_max_latency_us = array('i', [0] * n)  # maximum of `irq_latency_us`
+        self.emon_skew_ms = 0  # spread of the line cycle window ends of the chips, see `align_emon()`
+        self.realign_count = 0  # number of times the line cycle windows had to be re-aligned
+
+        # Power-quality events of all the chips, logged by the energy monitor interrupt handlers
+        self.event_log = EventLog(size=64)
+        for e in self.emon:
+            e.event_log = self.event_log
+
+        # Harmonics analysis
+        self.harmonics = Harmonics(n_signals=4, harmonics=Measurements.HARMONICS)  # Goertzel filters shared by all the chips
+        self.harmonics_values = array('i', [0] * (4 * len(Measurements.HARMONICS)))  # last chip harmonics, see `ADE7816.measure_harmonics()`
+        self.harmonics_updated = []  # chips with new harmonics to publish
+
         # Setup the ADE7816 IRQ line interrupt handler
-        self.pin_cs6_irq.irq(handler=self.spi.get_irq(self.emon_irq_handler));
+        self.pin_cs6_irq.irq(handler=self.spi.get_irq(self.emon_irq_handler, self.pin_cs6_irq));
          
 
 
@@ -128,11 +159,30 @@ class EEMON42:
         print('   Loading configuration file')
         if not self.load_config():
             raise RuntimeError("Unable to load the configuration file")
+        for e in self.emon:
+            e.set_power_quality(self.config.get('power_quality'))
+        # Adaptive line cycle windows. The 'adaptive_integration' configuration can override the `AdaptiveIntegration` parameters.
+        self.integration = AdaptiveIntegration(self.emon, self.measurements, **self.config.get('adaptive_integration', {}))
+        self.accumulation_mode = self.config.get('accumulation_mode', ADE7816.LINE_CYCLE)  # see `set_accumulation_mode()`
+        self.poll_interval = self.config.get('poll_interval', 1)  # time between energy polls in continuous mode, in s
+        for e in self.emon:
+            e.accumulation_mode = self.accumulation_mode
+        # SPI bus statistics, cheap enough to be left enabled. Print them from the REPL with `eemon.spi.stats.print()`.
+        if self.config.get('spi_stats', True):
+            names = {pin: f'emon{ix}' for ix, pin in enumerate(emon_cs_pins)}
+            names[self.pin_cs7_disp] = 'display'
+            self.spi.enable_stats(names)
+        # Shadow copy of the display content, so redrawn screens only send their changed lines
+        self.display.set_shadow(self.config.get('display_shadow', True))
+        print('   Loading calibration table')
+        if not self.load_calibration():
+            print('   Using default calibration.')
         print('   Instantiation complete')
 
 
     def emon_irq_handler(self, pin):
         if not pin.value():
+            self.irq_ticks_us = time.ticks_us()
             self.irq_flag.set()
         # pass
 
@@ -146,10 +196,14 @@ class EEMON42:
         self.display.init()
         self.display.print("EEMON42\r\nis\r\nthe\r\nbest\nof\nall", fg=self.display.YELLOW, font_size=5)
 
-        # Initialize Energy Monitor ICs
-
-        for e in self.emon:
-            e.init()
+        # Initialize Energy Monitor ICs. Use the fast initialization if we know the checksums of their configuration. 
+        checksums = self.load_checksums()
+        new_checksums = [e.init(expected_checksum=checksums[ix] if ix < len(checksums) else None, start=False) for ix, e in enumerate(self.emon)]
+        self.start_all_dsps()
+        self.detect_line_frequency()
+        print('   Energy monitors initialization times (ms):', ', '.join(f'{e.init_time_us/1000:.1f}' for e in self.emon))
+        if new_checksums != checksums:
+            self.save_checksums(new_checksums)
         # time.sleep(1)
         # self.display.clear()
 
@@ -216,6 +270,8 @@ class EEMON42:
             print('Connected to %s MQTT broker, subscribed to %s topic' %
                   (config['mqtt_server'], topic_sub))
             self.client = client  # Store MQTT client object, which also indicates it is fully ready 
+            if self.spi.stats:
+                self.spi.stats.hook = lambda stats: client.publish(self.topic_spi_stats, json.dumps(stats))
         except Exception as e:
             print(f'Error while connecting to MQTT server: {repr(e)}')
             # self.fatal_error = True
@@ -232,6 +288,11 @@ class EEMON42:
                     self.client.check_msg()  # what does that do? messages from server?
                     msg = json.dumps({"counter": counter})
                     self.client.publish(self.topic_pub, msg)
+                    while self.harmonics_updated:
+                        chip = self.harmonics_updated.pop(0)
+                        self.client.publish(self.topic_harmonics, json.dumps(self.measurements.harmonics_dict(chip)))
+                    if self.spi.stats:
+                        self.spi.stats.publish()  # statistics of the last message interval
                 await asyncio.sleep(self.message_interval)
             except OSError as e:
                 self.fatal_error = True
@@ -250,6 +311,55 @@ class EEMON42:
         except:
             return False
         return True
+
+    def load_checksums(self, filename='checksums.json'):
+        """ Return the list of the energy monitor configuration checksums saved by the last initialization, or an empty list.
+        """
+        try:
+            with open(filename) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return []
+
+    def save_checksums(self, checksums, filename='checksums.json'):
+        """ Saves the energy monitor configuration checksums so the next boot can use the fast initialization.
+
+        Nothing is saved if a checksum is missing (None), e.g. when a chip did not respond.
+        """
+        if None in checksums:
+            print('Energy monitor checksums not saved: missing checksum')
+            return
+        try:
+            with open(filename, 'w') as json_file:
+                json.dump(checksums, json_file)
+        except OSError as e:
+            print(f'Unable to save the energy monitor checksums: {e}')
+
+    def load_calibration(self, filename='calibration.json'):
+        """ Loads the calibration table of the 42 channels and applies it to the energy monitor objects.
+
+        The calibration registers are written to the chips by `init()`.
+
+        The table has a 'defaults' dict of channel calibration values applied to all channels, and a 'chips' list
+        with one entry per energy monitor chip (see ``ADE7816.set_calibration()``), e.g.::
+
+            {"defaults": {"ct_cal": 0.0156},
+             "chips": [{"vt_cal": 0.09, "channels": [{"igain": -1200}, {}, {}, {}, {}, {"ct_cal": 0.0312}]}]}
+
+        Returns:
+
+            bool: True if the calibration file was loaded
+        """
+        try:
+            with open(filename) as json_file:
+                cal = json.load(json_file)
+        except (OSError, ValueError) as e:
+            print(f'   Unable to load the calibration table {filename}: {e}')
+            return False
+        chips = cal.get('chips', [])
+        for ix, e in enumerate(self.emon):
+            e.set_calibration(chips[ix] if ix < len(chips) else None, defaults=cal.get('defaults'))
+        return True
  
     def dispose(self):
         self.display.clear()
@@ -282,40 +392,292 @@ class EEMON42:
                 self.restart_and_reconnect()
             await asyncio.sleep(1)
 
-    async def scan_emon(self):
-        dev = 0  # current energy monitor device number
+    async def verify_emon(self, interval=60):
+        """ Periodically checks that the energy monitor chips kept their configuration, and restores it if they did not.
+
+        Parameters:
+
+            interval (int): time between checks, in seconds
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for e in self.emon:
+                try:
+                    await self.spi.call(e.verify_config)
+                except Exception as ex:
+                    print(f'verify_emon exception on EMON{e.index}: {ex}')
+
+    def start_all_dsps(self):
+        """ Starts the DSPs of all the energy monitor chips together so their line cycle windows are synchronized.
+
+        The DSPs are stopped, the line cycle accumulation is armed and the pending interrupts are cleared on every chip,
+        then the DSPs are started back to back in the same SPI context. All the chips then complete their accumulation
+        windows on the same line cycle and can be serviced in the same IRQ pass. The energy accumulated in the current
+        window is lost.
+        """
+        emon = self.emon
+        with self.spi:
+            for e in emon:
+                e.stop_dsp()
+            for e in emon:
+                e.arm_line_cycle()
+                e.clear_irq()
+            for _ in range(3):  # RUN is written three times, as in ADE7816.init()
+                for e in emon:
+                    e.start_dsp()
+
+    def set_accumulation_mode(self, mode):
+        """ Selects the energy accumulation mode of all the energy monitor chips at runtime.
+
+        In line cycle mode (``ADE7816.LINE_CYCLE``), the measurements are processed by `scan_emon()` when the chips
+        interrupt at the end of their windows. In continuous mode (``ADE7816.CONTINUOUS``), they are polled by
+        `poll_emon()` every `poll_interval`, independently of the IRQ line.
+
+        Parameters:
+
+            mode (str): ``ADE7816.LINE_CYCLE`` or ``ADE7816.CONTINUOUS``
+        """
+        with self.spi:
+            for e in self.emon:
+                e.set_accumulation_mode(mode)
+        self.accumulation_mode = mode
+        if mode == ADE7816.LINE_CYCLE:
+            self.start_all_dsps()  # restart synchronized windows
+        self.irq_flag.set()  # wakes `scan_emon()` so it waits for the interrupts of the new mode
+
+    def detect_line_frequency(self, settle_time=0.1):
+        """ Detects the line frequency (50 or 60 Hz) and reconfigures the energy monitor chips if it changed.
+
+        Parameters:
+
+            settle_time (float): time to let the chips measure the line period after their DSP was started, in s
+        """
+        time.sleep(settle_time)
+        changed = False
+        for e in self.emon:
+            f = e.measure_line_frequency()
+            if f is None:
+                print(f'EMON{e.index}: unable to detect the line frequency, keeping {e.line_frequency} Hz')
+            elif e.set_line_frequency(f):
+                print(f'EMON{e.index}: line frequency set to {f} Hz')
+                changed = True
+        if changed:
+            self.start_all_dsps()  # start the new windows on the same line cycle
+
+    def demux_emon_irq(self, pending, t_irq):
+        """ Finds which energy monitor chips are asserting the shared IRQ line.
+
+        The interrupt flags of all the chips are read in a single SPI context and saved in `irq_status` (STATUS0) and
+        in the `status1` attribute of the chips (power-quality interrupts). Chips that
+        were not already pending are timestamped with `t_irq` in `irq_pending_since`.
+
+        Parameters:
+
+            pending (int): bitmask of the chips already known to have a pending interrupt (bit n for chip n)
+
+            t_irq (int): time.ticks_us() of the IRQ line assertion
+
+        Returns:
+
+            int: bitmask of the chips with a pending interrupt
+        """
+        emon = self.emon
+        status = self.irq_status
+        since = self.irq_pending_since
+        with self.spi:
+            for dev in range(len(emon)):
+                s = emon[dev].pending_irq()
+                status[dev] = s
+                bit = 1 << dev
+                if not s and not emon[dev].status1:
+                    pending &= ~bit
+                elif not pending & bit:
+                    since[dev] = t_irq
+                    pending |= bit
+        return pending
+
+    def poll_all(self):
+        """ Polls all the energy monitor chips in a single SPI context with the same timestamp.
+        """
+        with self.spi:
+            t_us = time.ticks_us()
+            for e in self.emon:
+                e.poll(t_us)
+
+    async def poll_emon(self):
+        """ Polls the energy monitor chips in continuous accumulation mode.
+
+        Every `poll_interval`, the energy registers of all the chips are read and reset in a single SPI context with
+        the same timestamp through the SPI transaction queue, and the records are merged in `measurements`. Polls are scheduled on a fixed time grid so
+        the sampling instants don't drift. Nothing is done in line cycle mode.
+        """
+        emon = self.emon
+        measurements = self.measurements
+        t_next = time.ticks_ms()
+        while True:
+            t_next = time.ticks_add(t_next, int(self.poll_interval * 1000))
+            dt = time.ticks_diff(t_next, time.ticks_ms())
+            if dt < 0:  # late, e.g. after a blocking operation: skip the missed polls
+                t_next = time.ticks_ms()
+                dt = 0
+            await asyncio.sleep(dt / 1000)
+            if self.accumulation_mode != ADE7816.CONTINUOUS:
+                continue
+            try:
+                await self.spi.call(self.poll_all)
+                for dev in range(len(emon)):
+                    measurements.update(dev, emon[dev].record)
+            except Exception as e:
+                print(f'poll_emon exception {e}')
+
+    async def analyze_harmonics(self, interval=10):
+        """ Measures the harmonics of the energy monitor chips, one channel group per interval, and stores them in `measurements`.
+
+        The current channels A-C and D-F of each chip are measured in turn (see `ADE7816.WAVEFORM_GROUPS`). Each
+        measurement blocks the event loop for a few line cycles (see `ADE7816.measure_harmonics()`). The chips with new
+        harmonics are queued in `harmonics_updated` to be published on MQTT.
+
+        Parameters:
+
+            interval (int or float): time between two measurements, in seconds
+        """
+        groups = ADE7816.WAVEFORM_GROUPS
+        dev = 0
+        group = 0
+        while True:
+            await asyncio.sleep(interval)
+            channels = groups[group]
+            try:
+                late = self.emon[dev].measure_harmonics(self.harmonics, self.harmonics_values, channels=channels)
+                if late:
+                    print(f'EMON{dev}: {late} late samples during the harmonics measurement')
+                self.measurements.update_harmonics(dev, channels, self.harmonics_values)
+                if dev not in self.harmonics_updated:
+                    self.harmonics_updated.append(dev)
+            except Exception as e:
+                print(f'analyze_harmonics exception on EMON{dev}: {e}')
+            group += 1
+            if group == len(groups):
+                group = 0
+                dev = (dev + 1) % len(self.emon)
+
+    async def align_emon(self, interval=60, max_skew_ms=50):
+        """ Monitors the alignment of the line cycle windows of the chips and re-synchronizes them if they drifted apart.
+
+        The windows can become misaligned when a chip is restarted on its own, e.g. by `ADE7816.verify_config()`. The
+        skew is the spread of the times at which the chips were last found with a pending interrupt, modulo the window
+        duration. It is evaluated only when every chip was serviced during the last interval, and when all the chips use
+        the same window (see `AdaptiveIntegration`).
+
+        Parameters:
+
+            interval (int): time between checks, in seconds
+
+            max_skew_ms (int): maximum skew before the windows are re-aligned by `start_all_dsps()`, in ms
+        """
+        n = len(self.emon)
+        count = self.irq_count
+        since = self.irq_pending_since
+        last_count = array('i', count)
+        while True:
+            await asyncio.sleep(interval)
+            e = self.emon[0]
+            window_us = e.integ_cycles * 1000000 // e.line_frequency
+            serviced = True
+            for i in range(n):
+                if count[i] == last_count[i]:
+                    serviced = False
+                last_count[i] = count[i]
+            if not serviced or any(e.integ_cycles != x.integ_cycles for x in self.emon):
+                continue
+            d_min = d_max = 0
+            for i in range(1, n):
+                # window end of chip i relative to chip 0, folded to +/- half a window
+                d = (time.ticks_diff(since[i], since[0]) + window_us // 2) % window_us - window_us // 2
+                d_min = min(d, d_min)
+                d_max = max(d, d_max)
+            self.emon_skew_ms = (d_max - d_min) // 1000
+            if self.emon_skew_ms > max_skew_ms:
+                print(f'Energy monitor windows skew is {self.emon_skew_ms} ms. Re-aligning.')
+                self.realign_count += 1
+                self.start_all_dsps()
+
+    async def scan_emon(self, timeout=13):
+        """ Services the energy monitor interrupts.
+
+        In continuous accumulation mode, only the power-quality interrupts are serviced here; the measurements are
+        polled by `poll_emon()`. The IRQ line is then waited for without timeout, and the task stays parked if no
+        power-quality interrupt is enabled, until `set_accumulation_mode()` wakes it.
+
+        All the chips share the same IRQ line. When it is asserted, the status of every chip is read in one pass by
+        `demux_emon_irq()` and only the chips with a pending interrupt are serviced, oldest first. The number of
+        interrupts and the latency from the IRQ line assertion to the service are kept per chip in `irq_count`,
+        `irq_latency_us` and `irq_max_latency_us`.
+
+        Parameters:
+
+            timeout (int or float): time to wait for the IRQ line in line cycle mode, in seconds. The chips are polled
+                anyways after the timeout in case the IRQ line went low without the interrupt being processed.
+        """
         n_dev = len(self.emon) # total number of energy monitor devices
+        pending = 0  # bitmask of the chips with a pending interrupt
 
         # define local variables for faster access
         emon = self.emon
         irq_pin = self.pin_cs6_irq  
         irq_flag = self.irq_flag
         spi = self.spi
+        measurements = self.measurements
+        integration = self.integration
+        status = self.irq_status
+        since = self.irq_pending_since
+        count = self.irq_count
+        latency = self.irq_latency_us
+        max_latency = self.irq_max_latency_us
 
         while True:
             try:
-                # If there is not already an IRQ, wait for the IRQ flag to be set by the pin interrupt, 
-                # but continue anyways after a timeout in case the IRQ pin went low without the interrupt being processed
-                if irq_pin():
+                if irq_pin() and not pending and self.accumulation_mode != ADE7816.LINE_CYCLE:
+                    # continuous mode: no line cycle interrupt is expected, so the chips are not polled on a timeout
+                    await irq_flag.wait()
+                    irq_flag.clear()
+                    t_irq = self.irq_ticks_us
+                    if self.accumulation_mode != ADE7816.LINE_CYCLE and not any(e.power_quality_enabled() for e in emon):
+                        continue  # woken by `set_accumulation_mode()`: stay parked
+                elif irq_pin() and not pending:
+                    # wait for the IRQ flag to be set by the pin interrupt
                     try:
-                        await asyncio.wait_for(irq_flag.wait(), 13)
+                        await asyncio.wait_for(irq_flag.wait(), timeout)
                         irq_flag.clear()
+                        t_irq = self.irq_ticks_us
                     except asyncio.TimeoutError:
-                        print(f'Timout while waiting for IRQ, {dev=}, IRQ={irq_pin()}')
-
-                scanned_dev = 0
-                while not irq_pin() and not spi.spi_active and scanned_dev < n_dev:
-                    emon[dev].irq_handler(irq_pin)
-                    dev += 1
-                    if dev >= n_dev: 
-                        dev = 0
-                    scanned_dev += 1
+                        print(f'Timout while waiting for IRQ, IRQ={irq_pin()}')
+                        t_irq = time.ticks_us()
+                else:
+                    t_irq = time.ticks_us()  # the line is still asserted: the edge was missed or chips are left to service
+
+                pending = self.demux_emon_irq(pending, t_irq)
+                while pending and not spi.spi_active:
+                    # service the chip that has been waiting the longest
+                    dev = -1
+                    for i in range(n_dev):
+                        if pending & (1 << i) and (dev < 0 or time.ticks_diff(since[i], since[dev]) < 0):
+                            dev = i
+                    if emon[dev].irq_handler(irq_pin, status[dev]):
+                        measurements.update(dev, emon[dev].record)
+                        integration.update(dev)
+                    pending &= ~(1 << dev)
+                    count[dev] += 1
+                    dt = time.ticks_diff(time.ticks_us(), since[dev])
+                    latency[dev] = dt
+                    if dt > max_latency[dev]:
+                        max_latency[dev] = dt
                     await asyncio.sleep(0)  # be a good neighbor and give back control to the event loop to let the UI respond to user actions 
-                # print('---')
-                # await asyncio.sleep(0.1)
+                await asyncio.sleep(0)
             except Exception as e:
                 print(f'scan_emon exception {e}')
                 raise
+
     async def main_loop(self):
 
         self.init()
@@ -325,8 +687,13 @@ class EEMON42:
         # Start background tasks
         print('Starting background tasks')
         task_list = (
+            self.spi.scheduler(), # runs the queued SPI transactions
             self.screen_saver(timeout=10), # turn off the display after `timeout`
             self.scan_emon(),
+            self.poll_emon(), # reads the energy monitors in continuous accumulation mode
+            self.verify_emon(interval=60), # restores the energy monitor configuration if a chip was reset
+            self.align_emon(interval=60), # keeps the line cycle windows of the energy monitors synchronized
+            self.analyze_harmonics(interval=10), # measures the current and voltage harmonics
             # self.watchdog(), # reboots if there is a fatal error
             # self.start_wifi_client(), # connect wifi
             # self.mqtt_connect_and_subscribe(), # connects MQTT client when wifi is up
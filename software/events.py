@@ -0,0 +1,85 @@
+from array import array
+import time
+
+
+class EventLog:
+    """ Fixed-size ring buffer of timestamped power-quality events.
+
+    Events are logged by the energy monitor interrupt handlers with `add()`, which does not allocate memory. Each
+    event records its time.ticks_ms() time, its type (one of the ``EventLog`` type constants), the chip and channel
+    that caused it, and a value in mV or mA. When the buffer is full, new events overwrite the oldest ones.
+
+    Parameters:
+
+        size (int): number of events kept in the buffer
+    """
+    # Event types
+    SAG = 0  # voltage sag. Value is the RMS voltage in mV.
+    OVERVOLTAGE = 1  # overvoltage. Value is the voltage peak in mV.
+    OVERCURRENT = 2  # overcurrent. Value is the current peak in mA.
+    PEAK_CURRENT = 3  # current peak above the peak current level. Value is the current peak in mA.
+    PEAK_VOLTAGE = 4  # voltage peak above the peak voltage level. Value is the voltage peak in mV.
+    NAMES = ('sag', 'overvoltage', 'overcurrent', 'peak_current', 'peak_voltage')
+
+    def __init__(self, size=64):
+        self.size = size
+        self.ticks = array('i', [0] * size)  # time.ticks_ms() of the event
+        self.kind = array('b', [0] * size)  # event type
+        self.chip = array('b', [0] * size)  # chip number
+        self.channel = array('b', [0] * size)  # channel (0-5), or -1 for chip-wide (voltage) events
+        self.value = array('i', [0] * size)  # value, in mV or mA
+        self.count = 0  # number of events logged since startup
+
+    def add(self, kind, chip, channel, value):
+        """ Logs an event.
+
+        Parameters:
+
+            kind (int): event type
+
+            chip (int): chip number
+
+            channel (int): channel number (0-5), or -1 for a chip-wide event
+
+            value (int): event value, in mV or mA
+        """
+        i = self.count % self.size
+        self.ticks[i] = time.ticks_ms()
+        self.kind[i] = kind
+        self.chip[i] = chip
+        self.channel[i] = channel
+        self.value[i] = value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def get(self, n):
+        """ Returns an event as a tuple.
+
+        Parameters:
+
+            n (int): event sequence number, from 0 for the first event logged since startup. Only the last `size`
+                events are available.
+
+        Returns:
+
+            tuple: (ticks_ms, type name, chip, channel, value)
+        """
+        if not self.count - len(self) <= n < self.count:
+            raise IndexError(f'Event {n} is not in the log')
+        i = n % self.size
+        return (self.ticks[i], self.NAMES[self.kind[i]], self.chip[i], self.channel[i], self.value[i])
+
+    def since(self, n):
+        """ Returns the events logged since an event, e.g. to publish only the new events.
+
+        Parameters:
+
+            n (int): sequence number of the first event to return. Older events that were overwritten are skipped.
+
+        Returns:
+
+            list of tuples: events, as returned by `get()`
+        """
+        return [self.get(i) for i in range(max(n, self.count - len(self)), self.count)]
@@ -0,0 +1,124 @@
+class GlyphCache:
+    """ Cache of pre-rendered text glyphs, in the RGB565 format of the frame buffer.
+
+    Each glyph is stored as its row-major pixel bytes (2 bytes per pixel, big endian), so it can be copied in the frame
+    buffer one row at a time with slice assignments instead of testing each bit of the font bitmap. When the framebuf
+    module is used, the pixel bytes are wrapped in a framebuf.FrameBuffer so they are copied with `blit()`.
+
+    The glyphs are grouped by palette, i.e. by font and foreground and background colors, and are indexed by character
+    code within their palette. The palette key (see `key()`) is built once per `Display.print()` call so looking up a
+    character does not allocate memory. Palettes are removed when their last glyph is evicted, so the cache doesn't
+    accumulate the palettes of colors that are no longer used.
+
+    When adding a glyph would exceed `max_bytes`, the least recently used glyphs are evicted.
+
+    Parameters:
+
+        max_bytes (int): maximum number of glyph bytes in the cache
+    """
+    def __init__(self, max_bytes=4096):
+        self.max_bytes = max_bytes
+        self.palettes = {}  # glyphs by character code, indexed by (font width, fg, bg)
+        self.size = 0  # number of glyph bytes in the cache
+        self.clock = 0  # incremented at each glyph use, to find the least recently used glyphs
+        self.hits = 0  # number of glyphs found in the cache
+        self.misses = 0  # number of glyphs added to the cache
+        self.evictions = 0  # number of glyphs evicted from the cache
+
+    def clear(self):
+        """ Removes all the glyphs.
+        """
+        self.palettes = {}
+        self.size = 0
+
+    @staticmethod
+    def key(font_width, fg, bg):
+        """ Returns the key of the palette of a font and colors, to be used with `get()` and `add()`.
+
+        Parameters:
+
+            font_width (int): width of the font, which identifies it
+
+            fg, bg (int): foreground and background colors
+
+        Returns:
+
+            tuple: palette key
+        """
+        return (font_width, fg, bg)
+
+    def get(self, key, code):
+        """ Returns a glyph from the cache.
+
+        Parameters:
+
+            key (tuple): palette key returned by `key()`
+
+            code (int): character code
+
+        Returns:
+
+            memoryview or framebuf.FrameBuffer: glyph pixels, or None if it is not in the cache
+        """
+        glyphs = self.palettes.get(key)
+        if glyphs is None:
+            return None
+        entry = glyphs.get(code)
+        if entry is None:
+            return None
+        self.clock += 1
+        entry[1] = self.clock
+        self.hits += 1
+        return entry[0]
+
+    def add(self, key, code, glyph, size):
+        """ Adds a glyph to the cache, evicting the least recently used glyphs if needed.
+
+        Parameters:
+
+            key (tuple): palette key returned by `key()`
+
+            code (int): character code
+
+            glyph (memoryview or framebuf.FrameBuffer): glyph pixels, see `Display.wrap_glyph()`
+
+            size (int): number of pixel bytes of the glyph
+
+        Returns:
+
+            the glyph
+        """
+        while self.size + size > self.max_bytes and self.evict():
+            pass
+        # looked up after the evictions, which may have removed the palette
+        glyphs = self.palettes.get(key)
+        if glyphs is None:
+            glyphs = self.palettes[key] = {}
+        self.clock += 1
+        glyphs[code] = [glyph, self.clock, size]
+        self.size += size
+        self.misses += 1
+        return glyph
+
+    def evict(self):
+        """ Removes the least recently used glyph.
+
+        Returns:
+
+            bool: False if the cache was empty
+        """
+        lru = None
+        for key, glyphs in self.palettes.items():
+            for code, entry in glyphs.items():
+                if lru is None or entry[1] < lru[2][1]:
+                    lru = (key, code, entry)
+        if lru is None:
+            return False
+        (key, code, entry) = lru
+        glyphs = self.palettes[key]
+        del glyphs[code]
+        if not glyphs:
+            del self.palettes[key]
+        self.size -= entry[2]
+        self.evictions += 1
+        return True
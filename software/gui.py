@@ -90,20 +90,21 @@ class GUI:
         bg = disp.BLACK
 
 
+        # The draw functions only modify the frame buffer: it is sent to the display by `flush()` once per loop
         def draw_char():
             nonlocal xx
-            self.display.print(char, x=xx, y=y, fg=fg, bg=bg)
+            self.display.print(char, x=xx, y=y, fg=fg, bg=bg, update=False)
         def draw_inv_char():
             nonlocal xx
-            disp.print(char, x=xx, y=y, fg=bg, bg=fg)
+            disp.print(char, x=xx, y=y, fg=bg, bg=fg, update=False)
         def draw_line():
             nonlocal xx
-            self.display.print(text, x=x, y=y, fg=fg, bg=bg)
-            self.display.print(empty[len(text):], x=xx, y=y, fg=fg, bg=bg)
+            self.display.print(text, x=x, y=y, fg=fg, bg=bg, update=False)
+            self.display.print(empty[len(text):], x=xx, y=y, fg=fg, bg=bg, update=False)
             xx = len(text) * disp.font_width
             draw_inv_char()
 
-        disp.print(empty, x=x, y=y)  # clear editing zone
+        disp.print(empty, x=x, y=y, update=False)  # clear editing zone
         draw_char()
         while True:
             # Remove current character when SHIFT (here: BACKSPACE) button is released
@@ -154,7 +155,9 @@ class GUI:
                 # print(f'encoder={rot_enc_value}, incr={incr}')
                 char = chr(min(max(ord(char) + incr, 32), 127))
                 draw_char()
+            await disp.flush()
             await asyncio.sleep(0.1)
+        await disp.flush()
         # insert display cleanup
         return text
 
@@ -170,28 +173,26 @@ class GUI:
         cur_item = 0
         disp.set_fg_color(fg)
         disp.set_bg_color(bg)
-        # Print the items
-        def draw(i, update=True):
+        x1 = x0 + len(items[0] * disp.font_width) + 1
+        # Print the items in the frame buffer, sent to the display by `flush()`
+        def draw(i):
             yy = y0 + 1
             while yy + cp < disp.HEIGHT and i < n_items:
                 _fg = Display.BLACK if i == cur_item else fg 
                 _bg = Display.YELLOW if i == cur_item else bg 
                 # print(f'print {items[i]} @ ({x0+1},{yy}) th={th}')
                 disp.print(items[i], x=x0 + 1, y=yy, fg=_fg, bg=_bg, update=False)
+                disp.fill_rect(x0 + 1 + len(items[i]) * disp.font_width, yy, x1 - 1, yy + th - 1, _bg) # extend the bar of short items to the border
                 yy += cp
                 i += 1
-            if update:
-                disp.update()
             return i
 
-        x1 = x0 + len(items[0] * disp.font_width) + 1
-        disp_items = draw(top_item, update=False) # Number of displayed items
-        y1 = y0 + 1 + disp_items * cp
-        disp.vline(x0, y0, y1)
-        disp.vline(x1, y0, y1)
-        for i in range(disp_items + 1):
-            disp.hline(x0, x1, y0 + i * cp)
-        disp.update()
+        disp_items = draw(top_item) # Number of displayed items
+        y1 = y0 + disp_items * cp
+        disp.rect(x0, y0, x1, y1)
+        for i in range(1, disp_items):
+            disp.hline(x0 + 1, x1, y0 + i * cp)
+        await disp.flush()
 
         while True:
             # Return selected item number button is pressed
@@ -222,14 +223,14 @@ class GUI:
                     if cur_item >= top_item + disp_items:
                         top_item = cur_item - disp_items + 1
                     draw(top_item)
-                    disp.update()
+                    await disp.flush()
                 elif incr < 0:
                     cur_item += incr
                     cur_item = max(cur_item, 0)
                     if cur_item < top_item:
                         top_item = cur_item
                     draw(top_item)
-                    disp.update()
+                    await disp.flush()
             await asyncio.sleep(0.1)
 
         return cur_item
@@ -0,0 +1,88 @@
+import math
+
+
+class Harmonics:
+    """ Bank of streaming Goertzel filters measuring the fundamental and harmonics of several waveform signals.
+
+    Samples are fed one at a time with `feed()`, so the analysis runs in constant memory without a sample buffer.
+    Each signal has one filter per harmonic; the filter state is stored at ``<signal> * len(harmonics) + <harmonic
+    index>``. The filters are tuned to the measured line frequency with `tune()` before each analysis.
+
+    Samples are fed by `ADE7816.measure_harmonics()`.
+
+    Parameters:
+
+        n_signals (int): number of signals in each sample
+
+        harmonics (tuple of int): harmonic orders to measure, 1 being the fundamental
+    """
+    def __init__(self, n_signals=4, harmonics=(1, 3, 5, 7)):
+        self.n_signals = n_signals
+        self.harmonics = tuple(harmonics)
+        n = n_signals * len(self.harmonics)
+        self.coeff = [0.0] * len(self.harmonics)  # Goertzel coefficients 2*cos(2*pi*f/fs), one per harmonic
+        self.s1 = [0.0] * n  # filter states
+        self.s2 = [0.0] * n
+        self.n = 0  # number of samples fed since the last `tune()`
+        self.line_frequency = 0  # line frequency the filters are tuned to, in Hz
+        self.sample_rate = 0  # sample rate the filters are tuned to, in Hz
+
+    def tune(self, line_frequency, sample_rate):
+        """ Tunes the filters to the harmonics of the line frequency and resets their states.
+
+        Parameters:
+
+            line_frequency (float): line frequency, in Hz
+
+            sample_rate (float): rate at which the samples will be fed, in Hz
+        """
+        self.line_frequency = line_frequency
+        self.sample_rate = sample_rate
+        for i, h in enumerate(self.harmonics):
+            self.coeff[i] = 2 * math.cos(2 * math.pi * h * line_frequency / sample_rate)
+        for j in range(len(self.s1)):
+            self.s1[j] = 0.0
+            self.s2[j] = 0.0
+        self.n = 0
+
+    def feed(self, values):
+        """ Feeds one sample to the filters.
+
+        Parameters:
+
+            values (sequence of int): value of each signal
+        """
+        coeff = self.coeff
+        s1 = self.s1
+        s2 = self.s2
+        j = 0
+        for x in values:
+            for c in coeff:
+                s = x + c * s1[j] - s2[j]
+                s2[j] = s1[j]
+                s1[j] = s
+                j += 1
+        self.n += 1
+
+    def rms(self, k, i):
+        """ Returns the RMS value of a harmonic of a signal, in the units of the samples.
+
+        Parameters:
+
+            k (int): signal number
+
+            i (int): harmonic index in `harmonics`
+
+        Returns:
+
+            float: RMS value. 0 if no sample was fed.
+        """
+        n = self.n
+        if not n:
+            return 0
+        j = k * len(self.harmonics) + i
+        a = self.s1[j]
+        b = self.s2[j]
+        power = a * a + b * b - self.coeff[i] * a * b
+        # The DFT magnitude is N/2 times the amplitude of the sine, which is sqrt(2) times its RMS value
+        return math.sqrt(max(power, 0)) * 1.4142135623730951 / n
@@ -0,0 +1,194 @@
+from array import array
+import time
+
+
+class Measurements:
+    """ Board-wide store of the latest measurements of all the energy monitor channels.
+
+    Each energy monitor chip fills a per-chip measurement record (see `new_record()` and the ``REC_*`` offsets) and
+    the record is merged in this store with `update()`. The store keeps the per-channel values in flat arrays indexed
+    by board channel number, so the whole board can be scanned without any table lookup or memory allocation.
+
+    The active energy of each channel is also accumulated in a running total split in two 32-bit words
+    (`total_hi`, `total_lo`) so the total never grows into a micropython long integer (which would allocate
+    memory on every update). Use `total_active()` to get the total as a single integer.
+
+    All values are integers in fixed units (mA, mV, mJ, thousandths); convert them to floats only when formatting.
+
+    Parameters:
+
+        n_chips (int): number of energy monitor chips on the board
+
+        channel_table (list of tuples): (chip, channel) of every board channel. The board channel number is the
+            index in the table. If not specified, the board channels are numbered chip by chip.
+    """
+
+    CHANNELS_PER_CHIP = 6
+
+    # Layout of the per-chip measurement records.
+    # Per-channel fields are stored at <channel number> * REC_FIELDS + <field offset>
+    REC_ACTIVE = 0  # active energy accumulated during the last line cycle window, in mJ
+    REC_REACTIVE = 1  # reactive energy accumulated during the last line cycle window, in mVAR.s
+    REC_IRMS = 2  # RMS current, in mA
+    REC_PF = 3  # power factor, in thousandths
+    REC_FIELDS = 4  # number of fields per channel
+    # Chip-wide fields follow the per-channel fields
+    REC_VRMS = CHANNELS_PER_CHIP * REC_FIELDS  # RMS voltage, in mV
+    REC_PERIOD = REC_VRMS + 1  # line period, raw PERIOD value
+    REC_COUNT = REC_VRMS + 2  # number of line cycle windows processed so far
+    REC_TICKS = REC_VRMS + 3  # time.ticks_ms() of the last update
+    REC_WINDOW = REC_VRMS + 4  # measured duration of the line cycle window, in us
+    REC_SIZE = REC_VRMS + 5
+
+    TOTAL_LO_BITS = 24  # number of bits kept in the low word of the energy totals
+
+    HARMONICS = (1, 3, 5, 7)  # harmonic orders stored by `update_harmonics()`, 1 being the fundamental
+
+    def __init__(self, n_chips, channel_table=None):
+        n = n_chips * self.CHANNELS_PER_CHIP
+        self.n_chips = n_chips
+        self.n_channels = n
+
+        if channel_table is None:
+            channel_table = [(chip, ch) for chip in range(n_chips) for ch in range(self.CHANNELS_PER_CHIP)]
+        if sorted(channel_table) != [(chip, ch) for chip in range(n_chips) for ch in range(self.CHANNELS_PER_CHIP)]:
+            raise ValueError('The channel table must list every (chip, channel) pair exactly once')
+        self.channel_table = tuple(channel_table)  # (chip, channel) of each board channel
+
+        # Board channel number of each chip channel, indexed by [chip][channel]
+        slots = [[0] * self.CHANNELS_PER_CHIP for _ in range(n_chips)]
+        for i, (chip, ch) in enumerate(self.channel_table):
+            slots[chip][ch] = i
+        self.slots = tuple(tuple(s) for s in slots)
+
+        # Per-channel values, indexed by board channel number
+        self.active = array('i', [0] * n)
+        self.reactive = array('i', [0] * n)
+        self.irms = array('i', [0] * n)
+        self.pf = array('i', [0] * n)
+        self.total_hi = array('i', [0] * n)  # active energy total, bits 24 and up
+        self.total_lo = array('i', [0] * n)  # active energy total, bits 0-23. Always positive.
+
+        # Per-chip values, indexed by chip number
+        self.vrms = array('i', [0] * n_chips)
+        self.period = array('i', [0] * n_chips)
+        self.count = array('i', [0] * n_chips)
+        self.ticks = array('i', [0] * n_chips)
+        self.window_us = array('i', [0] * n_chips)  # measured duration of the last line cycle window
+
+        # Harmonics RMS values, at <board channel or chip number> * len(HARMONICS) + <harmonic index>
+        nh = len(self.HARMONICS)
+        self.i_harmonics = array('i', [0] * (n * nh))  # current harmonics, in mA
+        self.v_harmonics = array('i', [0] * (n_chips * nh))  # voltage harmonics, in mV
+        self.harmonics_ticks = array('i', [0] * n_chips)  # time.ticks_ms() of the last harmonics update
+
+    @classmethod
+    def new_record(cls):
+        """ Return a new zeroed per-chip measurement record.
+        """
+        return array('i', [0] * cls.REC_SIZE)
+
+    def update(self, chip, rec):
+        """ Merge the measurement record of a chip in the board-wide store and accumulate the energy totals.
+
+        This does not allocate memory and can be called on every line cycle interrupt.
+
+        Parameters:
+
+            chip (int): chip number
+
+            rec (array): measurement record of the chip, as described by the ``REC_*`` offsets.
+        """
+        slots = self.slots[chip]
+        active = self.active
+        reactive = self.reactive
+        irms = self.irms
+        pf = self.pf
+        total_lo = self.total_lo
+        i = 0
+        for ch in range(6):  # CHANNELS_PER_CHIP
+            k = slots[ch]
+            e = rec[i]  # REC_ACTIVE
+            active[k] = e
+            reactive[k] = rec[i + 1]  # REC_REACTIVE
+            irms[k] = rec[i + 2]  # REC_IRMS
+            pf[k] = rec[i + 3]  # REC_PF
+            t = total_lo[k] + e
+            if t >> 24:  # TOTAL_LO_BITS. Carry negative and overflowing values into the high word
+                self.total_hi[k] += t >> 24
+                t &= 0xFFFFFF
+            total_lo[k] = t
+            i += 4  # REC_FIELDS
+        self.vrms[chip] = rec[i]  # REC_VRMS
+        self.period[chip] = rec[i + 1]  # REC_PERIOD
+        self.count[chip] = rec[i + 2]  # REC_COUNT
+        self.ticks[chip] = rec[i + 3]  # REC_TICKS
+        self.window_us[chip] = rec[i + 4]  # REC_WINDOW
+
+    def update_harmonics(self, chip, channels, values):
+        """ Stores the harmonics measured on some channels of a chip.
+
+        Parameters:
+
+            chip (int): chip number
+
+            channels (tuple of int): chip channels (0-5) of the measured currents
+
+            values (array): harmonics RMS values of the currents (mA) followed by the voltage (mV), at
+                ``<signal> * len(HARMONICS) + <harmonic index>``, as filled by `ADE7816.measure_harmonics()`.
+        """
+        nh = len(self.HARMONICS)
+        j = 0
+        for ch in channels:
+            k = self.slots[chip][ch] * nh
+            for i in range(nh):
+                self.i_harmonics[k + i] = values[j + i]
+            j += nh
+        for i in range(nh):
+            self.v_harmonics[chip * nh + i] = values[j + i]
+        self.harmonics_ticks[chip] = time.ticks_ms()
+
+    def harmonics_dict(self, chip):
+        """ Returns the harmonics of a chip and of its channels as a dict, e.g. to be published in JSON.
+
+        Parameters:
+
+            chip (int): chip number
+
+        Returns:
+
+            dict: 'harmonics' orders, voltage harmonics 'v' in mV, and current harmonics 'i' in mA keyed by board channel number.
+        """
+        nh = len(self.HARMONICS)
+        return {
+            'chip': chip,
+            'harmonics': self.HARMONICS,
+            'v': list(self.v_harmonics[chip * nh:(chip + 1) * nh]),
+            'i': {k: list(self.i_harmonics[k * nh:(k + 1) * nh]) for k in self.slots[chip]},
+        }
+
+    def power(self, k):
+        """ Return the average active power of a board channel over the last line cycle window, in mW.
+
+        The power is computed with the measured window duration, so it is right whatever the line frequency.
+
+        Parameters:
+
+            k (int): board channel number
+        """
+        window_us = self.window_us[self.channel_table[k][0]]
+        return self.active[k] * 1000000 // window_us if window_us else 0
+
+    def total_active(self, k):
+        """ Return the active energy accumulated on a board channel since startup, in mJ.
+
+        Parameters:
+
+            k (int): board channel number
+        """
+        return (self.total_hi[k] << self.TOTAL_LO_BITS) + self.total_lo[k]
+
+    def chip_channel(self, k):
+        """ Return the (chip, channel) tuple of a board channel.
+        """
+        return self.channel_table[k]
@@ -29,7 +29,8 @@ class RotaryEncoder():
             These pins must already have been configured properly.
 
         irq_wrapper (fn): If specified, wraps the Pin interrupt handler that tracks
-            encoder movements. 
+            encoder movements. It is called with the handler and the two encoder pins, e.g.
+            `SPI_with_CS.get_irq()`.
 
         verbose (int): verbose level for testing
 
@@ -55,7 +56,7 @@ class RotaryEncoder():
         # Set rotary encoder pins IRQ callback to the encoder handler so it can keep track of pin level changes. 
         # Use process_state() unless a custom handler is provided 
 
-        irq_handler = irq_wrapper(self.process_state) if irq_wrapper else self.process_state;
+        irq_handler = irq_wrapper(self.process_state, (pin_a, pin_b)) if irq_wrapper else self.process_state;
         self.pin_a.irq(irq_handler) 
         self.pin_b.irq(irq_handler)
         # self.last_time = time.time()
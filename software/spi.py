@@ -1,6 +1,182 @@
 from machine import Pin, SPI
+from array import array
 import time
 
+import sys
+if sys.implementation.name == 'micropython':
+    import uasyncio as asyncio
+else:
+    import asyncio
+
+
+class SPITransaction:
+    """ SPI transaction queued on a `SPI_with_CS` bus: a function performing SPI exchanges, and its outcome.
+
+    Parameters:
+
+        fn (callable): function performing the SPI exchanges. It is called in an SPI context.
+
+        args (tuple): arguments of `fn`
+    """
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.result = None  # value returned by `fn`
+        self.error = None  # exception raised by `fn`
+        self.done = None  # asyncio.Event set when the transaction was run, for awaiting callers
+
+class SPIStats:
+    """ Usage statistics of a `SPI_with_CS` bus, enabled with `SPI_with_CS.enable_stats()`.
+
+    The statistics are updated by every exchange without allocating memory, so they can be left enabled:
+
+        - per device (chip select pin): number of transactions and bytes written and read
+        - blackouts, i.e. the times the dual-function pins are in the OUT mode and their interrupts are blocked (a
+          ``with spi:`` context, or a single exchange outside a context): number, cumulative and maximum duration,
+          and a histogram of the durations in log2 bins. Bin ``b`` counts the blackouts of 2**b to 2**(b+1) - 1 us
+          (bin 0 also counts the 0 us blackouts and the last bin counts all the longer ones).
+
+    The counters are 32-bit integers: use `publish()` periodically to report and reset them. From the REPL, use
+    `print()`.
+
+    Parameters:
+
+        names (dict): names of the devices, indexed by chip select pin. Other devices are added as they are seen.
+
+        max_devices (int): maximum number of devices with statistics
+
+        n_bins (int): number of bins of the blackout histogram
+
+        hook (callable): function called by `publish()` with the statistics dict, e.g. to send them on MQTT
+    """
+    def __init__(self, names=None, max_devices=8, n_bins=16, hook=None):
+        self.devices = {}  # device index, by chip select pin
+        self.names = []  # device names, by device index
+        self.max_devices = max_devices
+        self.count = array('i', [0] * max_devices)  # number of transactions, by device index
+        self.bytes_out = array('i', [0] * max_devices)  # number of bytes written, by device index
+        self.bytes_in = array('i', [0] * max_devices)  # number of bytes read, by device index
+        self.histogram = array('i', [0] * n_bins)  # number of blackouts, by log2 of their duration in us
+        self.hook = hook
+        self.t_enable = 0  # time.ticks_us() at the start of the current blackout
+        self.reset()
+        for pin, name in (names or {}).items():
+            self.add_device(pin, name)
+
+    def reset(self):
+        """ Resets the counters. The devices are kept.
+        """
+        for a in (self.count, self.bytes_out, self.bytes_in, self.histogram):
+            for i in range(len(a)):
+                a[i] = 0
+        self.blackout_count = 0  # number of blackouts
+        self.blackout_us = 0  # cumulative duration of the blackouts, in us
+        self.max_blackout_us = 0  # duration of the longest blackout, in us
+        self.t_reset = time.ticks_ms()  # time.ticks_ms() of the last reset
+
+    def add_device(self, cs_pin, name=None):
+        """ Adds a device to the statistics.
+
+        Parameters:
+
+            cs_pin (machine.Pin): chip select pin of the device
+
+            name (str): name of the device. Default is the pin representation.
+
+        Returns:
+
+            int: device index, or None if there are already `max_devices` devices
+        """
+        if len(self.names) >= self.max_devices:
+            return None
+        ix = len(self.names)
+        self.devices[cs_pin] = ix
+        self.names.append(name or str(cs_pin))
+        return ix
+
+    def transaction(self, cs_pin, n_out, n_in):
+        """ Counts a transaction. Called by the `SPI_with_CS` exchanges.
+
+        Parameters:
+
+            cs_pin (machine.Pin): chip select pin of the device
+
+            n_out (int): number of bytes written
+
+            n_in (int): number of bytes read
+        """
+        ix = self.devices.get(cs_pin)
+        if ix is None:
+            ix = self.add_device(cs_pin)  # allocates only the first time a device is seen
+            if ix is None:
+                return
+        self.count[ix] += 1
+        self.bytes_out[ix] += n_out
+        self.bytes_in[ix] += n_in
+
+    def blackout(self, dt):
+        """ Counts a blackout. Called by `SPI_with_CS.disable_spi()`.
+
+        Parameters:
+
+            dt (int): duration of the blackout, in us
+        """
+        self.blackout_count += 1
+        self.blackout_us += dt
+        if dt > self.max_blackout_us:
+            self.max_blackout_us = dt
+        b = 0
+        last = len(self.histogram) - 1
+        while dt > 1 and b < last:
+            dt >>= 1
+            b += 1
+        self.histogram[b] += 1
+
+    def as_dict(self):
+        """ Returns the statistics as a dict, e.g. to convert them to JSON. Allocates memory.
+        """
+        return {
+            'interval_ms': time.ticks_diff(time.ticks_ms(), self.t_reset),
+            'devices': {name: {'count': self.count[ix], 'bytes_out': self.bytes_out[ix], 'bytes_in': self.bytes_in[ix]}
+                        for ix, name in enumerate(self.names)},
+            'blackout_count': self.blackout_count,
+            'blackout_us': self.blackout_us,
+            'max_blackout_us': self.max_blackout_us,
+            'histogram': list(self.histogram),
+        }
+
+    def publish(self, reset=True):
+        """ Passes the statistics to the `hook` function, if any, and resets them.
+
+        Parameters:
+
+            reset (bool): if True, resets the counters so the next statistics cover the time since this call
+
+        Returns:
+
+            dict: statistics, see `as_dict()`
+        """
+        stats = self.as_dict()
+        if self.hook:
+            self.hook(stats)
+        if reset:
+            self.reset()
+        return stats
+
+    def print(self):
+        """ Prints the statistics, e.g. from the REPL.
+        """
+        dt = time.ticks_diff(time.ticks_ms(), self.t_reset)
+        print(f'SPI statistics over the last {dt / 1000:.1f} s:')
+        for ix, name in enumerate(self.names):
+            print(f'   {name:12s}: {self.count[ix]:8d} transactions, {self.bytes_out[ix]:9d} bytes out, {self.bytes_in[ix]:9d} bytes in')
+        mean = self.blackout_us // self.blackout_count if self.blackout_count else 0
+        print(f'   blackouts   : {self.blackout_count:8d}, total {self.blackout_us} us, mean {mean} us, max {self.max_blackout_us} us')
+        for b, n in enumerate(self.histogram):
+            if n:
+                print(f'   {1 << b:7d} us  : {n:8d}')
+
+
 class SPI_with_CS(SPI):
     """ Hardware SPI interface with dual-function chip-select (CS) pin handling.
 
@@ -36,12 +212,33 @@ class SPI_with_CS(SPI):
             user.
 
 
+        max_window_us (int): maximum duration of the SPI context in which the queued transactions are run, in us.
+            See `run_batch()`.
+
         kwargs: all other keywords arguments are passed to the machine.SPI class
 
+    Transaction queue:
+
+        Functions performing SPI exchanges can be queued with `submit()`, or with the awaitable `call()` from asyncio
+        tasks. The `scheduler()` task runs them in batches, each in a single ``with spi:`` context, so the dual-function
+        pins are switched once per batch instead of once per exchange. A batch ends when its duration reaches
+        `max_window_us`, so the button and encoder interrupts are never blocked for longer than that (plus the duration
+        of the last transaction, which is never split).
+
+    Pin interrupts:
+
+        The interrupts of the dual-function pins are blocked during the SPI transactions. Handlers obtained with
+        `get_irq()` for watched pins are called after the transactions for the pins whose level changed.
+
+    Statistics:
+
+        `enable_stats()` counts the transactions and bytes of each device and the durations of the pin interrupt
+        blackouts in `stats`, see `SPIStats`.
     """
-    def __init__(self, baudrate=2.5e6, sck=None, mosi=None, miso=None, cs_out_pins=tuple(), cs_inout_pins=tuple()):
+    def __init__(self, baudrate=2.5e6, sck=None, mosi=None, miso=None, cs_out_pins=tuple(), cs_inout_pins=tuple(), max_window_us=2000):
         SPI(1).deinit() # need to deinitialize so we can initialize again
         super().__init__(1, int(baudrate))
+        self.baudrate = int(baudrate)  # in bps, used to estimate the duration of the transfers
         # self.init(baudrate=int(baudrate), sck=sck, mosi=mosi, miso=miso)
         self.cs_inout_pins = cs_inout_pins  # list of input-output (dual function) CS pins
  
@@ -55,8 +252,43 @@ class SPI_with_CS(SPI):
 
         self.spi_active = False
         self.context_active = False
+        self.context_depth = 0  # number of nested ``with spi:`` contexts
+
+        self.max_window_us = max_window_us
+        self.queue = []  # queued SPITransaction objects
+        self.queue_event = asyncio.Event()  # set when transactions are queued
+        self.batch_count = 0  # number of batches run
+        self.transaction_count = 0  # number of queued transactions run
+        self.max_batch_us = 0  # duration of the longest batch
+        self.batch_overruns = 0  # number of batches that exceeded their budget, e.g. when a transaction ran longer than the previous ones
+        self.stats = None  # SPIStats, see `enable_stats()`
+        self.watch_pins = []  # pins whose levels are sampled around the blackout windows, see `get_irq()`
+        self.watch_handlers = []  # interrupt handler of each watched pin
+        self.watch_levels = 0  # levels of the watched pins before the current blackout
+        self.synthesized_count = 0  # number of blackouts after which interrupts were synthesized
+
+    def enable_stats(self, names=None, **kwargs):
+        """ Enables the bus statistics.
+
+        Parameters:
+
+            names (dict): names of the devices, indexed by chip select pin
 
-    def get_irq(self, irq_handler):
+            kwargs: all other keyword arguments are passed to `SPIStats`
+
+        Returns:
+
+            SPIStats: statistics, also available in `stats`
+        """
+        self.stats = SPIStats(names, **kwargs)
+        return self.stats
+
+    def disable_stats(self):
+        """ Disables the bus statistics.
+        """
+        self.stats = None
+
+    def get_irq(self, irq_handler, pins=None):
         """ Return a Pin interrupt handler that will call `irq_handler` 
         only if the SPI port is not active.
 
@@ -64,16 +296,26 @@ class SPI_with_CS(SPI):
         CS lines should be obtained through this method to prevent unwanted
         interrupts to be caused by SPI transactions. 
 
-        Parameters:
+        The interrupts of the pins are blocked during the SPI transactions, so their edges are lost. If `pins` are
+        given, their levels are sampled right before and right after each blackout window, and `irq_handler` is called
+        for each pin whose level changed, as if its interrupt had occurred when the window ended. The handler must read
+        the pin levels itself (as the `Button` and `RotaryEncoder` handlers do): a pulse that starts and ends during
+        the window can't be seen.
 
-            cs_pin (machine.Pin): One or multiple pins for which the
-                interrupt routine should be applied.
+        Parameters:
 
             irq_handler (fn): Interrupt routine that will be called on changes
                 on the specified pins, only when the SPI port is inactive.
 
-            kwargs: Additional arguments passed to the Pin.irq() call.
+            pins (machine.Pin or tuple of machine.Pin): pins that trigger `irq_handler`, to be watched during the
+                blackout windows. Default is to not watch any pin.
         """
+        if pins is not None:
+            for pin in (pins if isinstance(pins, (tuple, list)) else (pins,)):
+                self.watch_pins.append(pin)
+                self.watch_handlers.append(irq_handler)
+                self.watch_levels = self.sample_watched_pins()
+
         def wrapped_irq_handler(pin):
             """ Calls the IRQ handler only if SPI is not active"""
             if not self.spi_active:
@@ -83,8 +325,25 @@ class SPI_with_CS(SPI):
  
         return wrapped_irq_handler
 
+    def sample_watched_pins(self):
+        """ Returns the levels of the watched pins (see `get_irq()`) as a bit mask, bit n being the level of the nth pin.
+        """
+        levels = 0
+        bit = 1
+        for pin in self.watch_pins:
+            if pin.value():
+                levels |= bit
+            bit <<= 1
+        return levels
+
     def enable_spi(self):
+        if self.watch_pins:
+            # levels before the blackout, sampled while the pin interrupts still run so an edge can't fall between the
+            # two and be lost
+            self.watch_levels = self.sample_watched_pins()
         self.spi_active = True  # block pin interrupts
+        if self.stats is not None:
+            self.stats.t_enable = time.ticks_us()
         # put dual-function pins in OUT mode to prevent CS lines from being activated by their dual-function devices (e.g. switches)
         # print('settint to OUT')
         for pin in self.cs_inout_pins:
@@ -97,15 +356,133 @@ class SPI_with_CS(SPI):
 
         # print('enabling irq')
         time.sleep(0) # let the interrupt thread process the pending pin interrupts
+        if self.watch_pins:
+            # Synthesize the interrupts of the watched pins that changed during the blackout. This is done before enabling
+            # the pin interrupts so the handlers are not interrupted by the real ones.
+            changed = self.sample_watched_pins() ^ self.watch_levels
+            if changed:
+                handlers = self.watch_handlers
+                i = 0
+                for pin in self.watch_pins:
+                    if changed & (1 << i):
+                        handlers[i](pin)
+                    i += 1
+                self.synthesized_count += 1
         self.spi_active = False # enable pin interrupts
+        stats = self.stats
+        if stats is not None:
+            stats.blackout(time.ticks_diff(time.ticks_us(), stats.t_enable))
         # time.sleep(.00005)
         # print()
     def __enter__(self):
-        self.context_active = True
-        self.enable_spi()
+        # Contexts can be nested: only the outermost one switches the pin modes
+        if not self.context_depth:
+            self.context_active = True
+            self.enable_spi()
+        self.context_depth += 1
     def __exit__(self, e1,e2,e3):
-        self.disable_spi()
-        self.context_active = False
+        self.context_depth -= 1
+        if not self.context_depth:
+            self.disable_spi()
+            self.context_active = False
+
+    def submit(self, fn, *args):
+        """ Queues a function performing SPI exchanges, to be run by the scheduler.
+
+        The function should be short (a few transactions): it is never split between two batches.
+
+        Parameters:
+
+            fn (callable): function performing the SPI exchanges, e.g. ``emon.read``
+
+            args: arguments of `fn`
+
+        Returns:
+
+            SPITransaction: queued transaction. Its `result` and `error` are set when it has run.
+        """
+        tr = SPITransaction(fn, args)
+        self.queue.append(tr)
+        self.queue_event.set()
+        return tr
+
+    async def call(self, fn, *args):
+        """ Queues a function performing SPI exchanges and waits until the scheduler has run it.
+
+        Parameters:
+
+            fn (callable): function performing the SPI exchanges
+
+            args: arguments of `fn`
+
+        Returns:
+
+            the value returned by `fn`. Exceptions raised by `fn` are raised again.
+        """
+        tr = self.submit(fn, *args)
+        tr.done = asyncio.Event()
+        await tr.done.wait()
+        if tr.error:
+            raise tr.error
+        return tr.result
+
+    def run_batch(self, max_window_us=None):
+        """ Runs queued transactions in a single SPI context, until the queue is empty or the window budget is used.
+
+        Parameters:
+
+            max_window_us (int): maximum duration of the SPI context, in us. Default is `max_window_us`. The batch stops
+                before a transaction that would exceed it if it took as long as the longest one of the batch, but it always
+                runs at least one transaction.
+
+        Returns:
+
+            int: number of transactions that were run
+        """
+        budget = max_window_us or self.max_window_us
+        queue = self.queue
+        n = 0
+        longest = 0  # duration of the longest transaction of the batch, in us
+        with self:
+            t0 = t = time.ticks_us()
+            while queue:
+                tr = queue.pop(0)
+                try:
+                    tr.result = tr.fn(*tr.args)
+                except Exception as e:
+                    tr.error = e
+                if tr.done:
+                    tr.done.set()
+                n += 1
+                # stop before the next transaction would exceed the budget, assuming it takes as long as the longest one
+                t_last = t
+                t = time.ticks_us()
+                d = time.ticks_diff(t, t_last)
+                if d > longest:
+                    longest = d
+                if time.ticks_diff(t, t0) + longest > budget:
+                    break
+            dt = time.ticks_diff(time.ticks_us(), t0)
+        self.batch_count += 1
+        self.transaction_count += n
+        if dt > self.max_batch_us:
+            self.max_batch_us = dt
+        if dt > budget:
+            self.batch_overruns += 1
+        return n
+
+    async def scheduler(self):
+        """ Runs the queued transactions in batches. Add this task to the event loop to use the transaction queue.
+
+        The pins are released and the event loop runs between two batches, so pin interrupts and other tasks are
+        processed.
+        """
+        while True:
+            await self.queue_event.wait()
+            self.queue_event.clear()
+            while self.queue:
+                self.run_batch()
+                await asyncio.sleep(0)
 
     def exchange(self, cs_pin, data, read_buf=None):
         """ Writes `data` to the SPI port and then read bytes into `read_buf`while the chip select pin `cs_pin` is activated
@@ -142,9 +519,46 @@ class SPI_with_CS(SPI):
         self.write(data) # perform SPI transaction
         self.readinto(read_buf) if read_buf else [] # perform SPI transaction
         cs_pin.value(1) # disable target CS line
+        if self.stats is not None:
+            self.stats.transaction(cs_pin, len(data), len(read_buf) if read_buf else 0)
         if not self.context_active:
             self.disable_spi()
         # return din
 
+    def transfer(self, cs_pin, tx_buf, rx_buf=None):
+        """ Sends `tx_buf` and simultaneously reads the same number of bytes into `rx_buf` in a single full-duplex
+        ``write_readinto()`` call while the chip select pin `cs_pin` is activated. If `rx_buf` is `None`, only sends
+        `tx_buf`.
+
+        Unlike `exchange()`, the command and the reply are clocked in one call instead of a write followed by a read,
+        which halves the driver calls of a register read. The reply bytes clocked in while the command is sent are
+        don't care and end up at the start of `rx_buf`.
+
+        Drivers call it with views of buffers preallocated per device (one view per transfer length), so a
+        transaction doesn't allocate memory.
+
+        Parameters:
+            cs_pin (machine.Pin): chip-select pin to be activated (LOW) during the transaction
+
+            tx_buf (buffer): bytes to send
+
+            rx_buf (buffer): buffer of the same length as `tx_buf` that receives the reply, or `None`
+
+        Returns:
+            None
+        """
+        if not self.context_active:
+            self.enable_spi()
+        cs_pin.value(0)
+        if rx_buf is None:
+            self.write(tx_buf)
+        else:
+            self.write_readinto(tx_buf, rx_buf)
+        cs_pin.value(1)
+        if self.stats is not None:
+            self.stats.transaction(cs_pin, len(tx_buf), 0 if rx_buf is None else len(rx_buf))
+        if not self.context_active:
+            self.disable_spi()
+
     # def write(self, cs_pin, data):
     #     self.exchange(cs_pin, data)  # write method just calls exchange
@@ -24,6 +24,7 @@ class SSD1331(Display):
     WIDTH = 96
     HEIGHT = 64
     BYTES_PER_PIXEL = 2
+    BAND_OVERHEAD_US = 150  # window command and pin switching of each band sent by `flush()`, in us
 
     def __init__(self, spi, cs_pin, cd_pin, res_pin):
 
@@ -33,6 +34,16 @@ class SSD1331(Display):
         self.cd_pin = cd_pin
         self.rst_pin = res_pin
         self.cmd = bytearray((0x15, 0, 95, 0x75, 0, 63)) # command bytes. The last two bytes are updated as needed
+        self.tx_buf = bytearray(16)  # preallocated buffer for write_command() and write_data()
+        tx_view = memoryview(self.tx_buf)
+        self.tx_views = tuple(tx_view[:n] for n in range(len(self.tx_buf) + 1))  # one view per transfer length
+
+        # Shadow copy of the pixels shown by the display, see `set_shadow()`
+        self.shadow = None  # memoryview of the shadow frame buffer, or None if disabled
+        self.shadow_valid = False  # False if the display content is unknown, e.g. after a hardware drawing command
+        self.shadow_flushes = 0  # number of frame buffer writes compared with the shadow copy
+        self.shadow_bytes_saved = 0  # number of pixel bytes not sent because their line was unchanged
+        self.shadow_last_saved = 0  # number of pixel bytes not sent by the last frame buffer write
         
 
     def init(self):
@@ -72,8 +83,8 @@ class SSD1331(Display):
         self.rst_pin(1)
         time.sleep(0.01)
         # All the display needs to be refreshed
-        self.fb_y0 = 0
-        self.fb_y1 = 63
+        self.mark_dirty(0, 0, self.WIDTH - 1, self.HEIGHT - 1)
+        self.shadow_valid = False
 
     def write_command(self, data):
         """ Writes data bytes
@@ -86,7 +97,7 @@ class SSD1331(Display):
 
         """
         self.cd_pin(0)
-        self.spi.exchange(self.cs_pin, bytearray(data))
+        self.spi.transfer(self.cs_pin, self._tx(data))
 
     def _write_command(self, data):
         """ Writes data bytes
@@ -96,37 +107,68 @@ class SSD1331(Display):
             data (bytes, bytearray or memoryview): bytes to send to the display.
         """
         self.cd_pin(0)
-        self.spi.exchange(self.cs_pin, data)
+        self.spi.transfer(self.cs_pin, data)
 
     def write_data(self, data):
         self.cd_pin(1)
-        self.spi.exchange(self.cs_pin, bytearray(data))
+        self.spi.transfer(self.cs_pin, self._tx(data))
 
     def _write_data(self, data):
         """ Assumes data is already a bytearray or buffer"""
         self.cd_pin(1)
-        self.spi.exchange(self.cs_pin, data)
+        self.spi.transfer(self.cs_pin, data)
+
+    def _tx(self, data):
+        """ Copies `data` in the preallocated transmit buffer and returns the view of its length, so commands don't
+        allocate a new bytearray. Data longer than the buffer is copied in a new bytearray.
+
+        Parameters:
+
+            data (list of int or bytes): bytes to send to the display.
+        """
+        n = len(data)
+        if n >= len(self.tx_views):
+            return bytearray(data)
+        buf = self.tx_buf
+        for i in range(n):
+            buf[i] = data[i]
+        return self.tx_views[n]
 
     def write_frame_buffer(self, y0=None, y1=None):
         """ Sends the specified lines of the frame buffer to the hardware display. 
 
-        If no lines are specified, only the block of lines that were modified since the last call are updated. 
+        If no lines are specified, only the rectangle that was modified since the last call is updated: the column
+        and row windows of the display are set to the rectangle and only its pixels are sent.
 
         Parameters:
 
-            y0, y1 (int): first and last line of the block to be updated. If None, the higest/lowest line modified since the last call is used.  
+            y0, y1 (int): first and last line of the block to be updated. Whole lines are sent. If None, the
+                higest/lowest line modified since the last call is used, and only the modified columns are sent.
 
         """
-        # sets the window
-        self.cmd[4] = y0 = y0 if y0 is not None else self.fb_y0
-        self.cmd[5] = y1 = y1 if y1 is not None else self.fb_y1
-        if y1 < 0:
+        if y0 is None and y1 is None:
+            x0 = self.fb_x0
+            x1 = self.fb_x1
+        else:
+            x0 = 0
+            x1 = self.WIDTH - 1
+        y0 = y0 if y0 is not None else self.fb_y0
+        y1 = y1 if y1 is not None else self.fb_y1
+        if y1 < 0 or x1 < 0:
             return
-        with self.spi:
-            self._write_command(self.cmd) # send the window command
-            self._write_data(self.fb[y0 * self.BYTES_PER_LINE: (y1+1) * self.BYTES_PER_LINE]) # fb is a memoryview, indexing does not allocate new memory
-        self.fb_y0 = self.HEIGHT - 1
-        self.fb_y1 = -1 # -1 is faster to check than y0 > y1
+        x0 = max(x0, 0)
+        y0 = max(y0, 0)
+        x1 = min(x1, self.WIDTH - 1)
+        y1 = min(y1, self.HEIGHT - 1)
+        if self.shadow is None:
+            self._write_rect(x0, y0, x1, y1)
+        else:
+            if not self.shadow_valid: # the whole display must be sent to know its content
+                (x0, y0, x1, y1) = (0, 0, self.WIDTH - 1, self.HEIGHT - 1)
+            with self.spi: # a single SPI context for all the runs
+                for (r0, r1) in self._changed_runs(x0, y0, x1, y1):
+                    self._write_rect(x0, r0, x1, r1)
+        self.clear_dirty()
 
         # tb = time.ticks_cpu()
         # t1 = time.ticks_ms()
@@ -134,6 +176,141 @@ class SSD1331(Display):
         # t2= time.ticks_ms()
         # print(f'draw={t1-t0} ms, refresh={t2-t1} ms, buf access={tb-ta} cycles')
 
+    def _write_rect(self, x0, y0, x1, y1):
+        """ Sends a rectangle of the frame buffer to the display, without changing the modified rectangle.
+
+        The display fills its column and row windows line by line, so the lines of the rectangle can be sent one after
+        the other. Whole lines are contiguous in the frame buffer and are sent in a single transfer.
+
+        Parameters:
+
+            x0, y0, x1, y1 (int): upper-left and lower-right corners of the rectangle, inclusive
+        """
+        # sets the window
+        cmd = self.cmd
+        cmd[1] = x0
+        cmd[2] = x1
+        cmd[4] = y0
+        cmd[5] = y1
+        fb = self.fb # fb is a memoryview, slicing does not copy the frame buffer
+        bytes_per_line = self.BYTES_PER_LINE
+        with self.spi:
+            self._write_command(cmd) # send the window command
+            if x0 == 0 and x1 == self.WIDTH - 1:
+                self._write_data(fb[y0 * bytes_per_line: (y1+1) * bytes_per_line])
+            else:
+                self.cd_pin(1)
+                transfer = self.spi.transfer
+                cs_pin = self.cs_pin
+                a = y0 * bytes_per_line + x0 * self.BYTES_PER_PIXEL
+                n = (x1 - x0 + 1) * self.BYTES_PER_PIXEL
+                for y in range(y0, y1 + 1):
+                    transfer(cs_pin, fb[a: a + n])
+                    a += bytes_per_line
+
+    def set_shadow(self, enable=True):
+        """ Enables or disables the shadow copy of the display content.
+
+        When enabled, the frame buffer writes compare each line of the modified rectangle with the shadow copy of what
+        the display currently shows, and only send the runs of consecutive changed lines. This saves SPI transfers when
+        whole screens are redrawn with mostly the same pixels, at the cost of a second frame buffer in memory.
+
+        The statistics are in `shadow_flushes`, `shadow_bytes_saved` and `shadow_last_saved`.
+
+        Parameters:
+
+            enable (bool): True to enable the shadow copy
+        """
+        if enable and self.shadow is None:
+            self.shadow = memoryview(bytearray(len(self.fb)))
+            self.shadow_valid = False
+        elif not enable:
+            self.shadow = None
+
+    def _changed_runs(self, x0, y0, x1, y1):
+        """ Compares the lines of a rectangle of the frame buffer with the shadow copy, copies the changed lines to the
+        shadow copy, and returns the runs of consecutive changed lines. All the lines are changed if the shadow copy is
+        not valid.
+
+        Parameters:
+
+            x0, y0, x1, y1 (int): upper-left and lower-right corners of the rectangle, inclusive
+
+        Returns:
+
+            list of tuples: (first line, last line) of each run
+        """
+        fb = self.fb
+        shadow = self.shadow
+        valid = self.shadow_valid
+        bytes_per_line = self.BYTES_PER_LINE
+        n = (x1 - x0 + 1) * self.BYTES_PER_PIXEL
+        a = y0 * bytes_per_line + x0 * self.BYTES_PER_PIXEL
+        runs = []
+        start = -1
+        skipped = 0
+        for y in range(y0, y1 + 1):
+            if valid and fb[a: a + n] == shadow[a: a + n]: # compared in C, like memcmp()
+                skipped += 1
+                if start >= 0:
+                    runs.append((start, y - 1))
+                    start = -1
+            else:
+                shadow[a: a + n] = fb[a: a + n]
+                if start < 0:
+                    start = y
+            a += bytes_per_line
+        if start >= 0:
+            runs.append((start, y1))
+        self.shadow_valid = True
+        self.shadow_flushes += 1
+        self.shadow_last_saved = skipped * n
+        self.shadow_bytes_saved += skipped * n
+        return runs
+
+    async def flush(self, lines_per_transaction=None):
+        """ Sends the rectangle modified since the last update through the SPI transaction queue. With the shadow copy
+        (see `set_shadow()`), only the changed lines are sent.
+
+        The rectangle is sent in bands of `lines_per_transaction` lines, so the SPI scheduler can release the
+        dual-function pins between two bands and the button interrupts are not blocked during the whole frame buffer
+        transfer. Requires the `SPI_with_CS.scheduler()` task.
+
+        Parameters:
+
+            lines_per_transaction (int): number of lines sent in each queued transaction. Default is the number of
+                lines that fit the `SPI_with_CS.max_window_us` budget at the SPI baud rate, e.g. 3 whole lines (about
+                1.8 ms) in 2 ms at 2.5 MHz.
+        """
+        x0 = max(self.fb_x0, 0)
+        x1 = min(self.fb_x1, self.WIDTH - 1)
+        y0 = max(self.fb_y0, 0)
+        y1 = min(self.fb_y1, self.HEIGHT - 1)
+        if y1 < 0 or x1 < 0:
+            return
+        self.clear_dirty()
+        if self.shadow is None:
+            runs = ((y0, y1),)
+        else:
+            if not self.shadow_valid:
+                (x0, y0, x1, y1) = (0, 0, self.WIDTH - 1, self.HEIGHT - 1)
+            runs = self._changed_runs(x0, y0, x1, y1)
+            if not runs:
+                return
+        n = lines_per_transaction
+        if not n:
+            spi = self.spi
+            line_us = (x1 - x0 + 1) * self.BYTES_PER_PIXEL * 8000000 // spi.baudrate
+            n = max(1, (spi.max_window_us - self.BAND_OVERHEAD_US) // line_us)
+        bands = []
+        for (r0, r1) in runs:
+            for y in range(r0, r1 + 1, n):
+                bands.append((y, min(y + n - 1, r1)))
+        for (ya, yb) in bands[:-1]:
+            self.spi.submit(self._write_rect, x0, ya, x1, yb)
+        (ya, yb) = bands[-1]
+        await self.spi.call(self._write_rect, x0, ya, x1, yb)  # the transactions are run in order: the last band completes the update
+
     def display_on(self):
         self.write_command((0xAF,))
 
@@ -151,6 +328,7 @@ class SSD1331(Display):
         self.write_command((0x15, x1, x2, 0x75, y1, y2))
 
     def draw_color_bitmap(self, x, y, width, height, data):
+        self.shadow_valid = False # the display content is changed by the display controller
         self.set_window(x, y, x + width - 1, y + height - 1)
         for d in data:
             r = (d >> 11) & 0b11111
@@ -183,15 +361,18 @@ class SSD1331(Display):
 
 
     def draw_line(self, x1, y1, x2, y2, r=255, g=255, b=255):
+        self.shadow_valid = False # the display content is changed by the display controller
         self.write_command((0x21, x1, y1, x2, y2, r, g, b))
         time.sleep(0.001)
 
     def draw_rect(self, x1, y1, x2, y2, line_r=255, line_g=255, line_b=255, fill_r=0, fill_g=0, fill_b=0):
+        self.shadow_valid = False # the display content is changed by the display controller
         self.write_command((0x22, x1, y1, x2, y2, line_r,
                            line_g, line_b, fill_r, fill_g, fill_b))
         time.sleep(0.001)
 
     def copy(self, src_x1, src_y1, src_x2, src_y2, dest_x, dest_y):
+        self.shadow_valid = False # the display content is changed by the display controller
         self.write_command(
             (0x23, src_x1, src_y1, src_x2, src_y2, dest_x, dest_y))
         time.sleep(0.001)
@@ -199,6 +380,7 @@ class SSD1331(Display):
     def dim_rect(self, x1=0, y1=0, x2=95, y2=63):
         """ Reduce the intensity of the pixels in the specified rectangle. Subsequent calls have no effect.
         """
+        self.shadow_valid = False # the display content is changed by the display controller
         self.write_command((0x24, x1, y1, x2, y2))
         time.sleep(0.001)
 
@@ -232,8 +414,8 @@ class SSD1331(Display):
         self.write_command((0x25, x1, y1, x2, y2))
         time.sleep(0.001)
         # All the display needs to be refreshed
-        self.fb_y0 = 0
-        self.fb_y1 = 63
+        self.mark_dirty(0, 0, self.WIDTH - 1, self.HEIGHT - 1)
+        self.shadow_valid = False
 
     def set_fill(self, ena, rev_copy=False):
         a = 0x00
@@ -255,4 +437,5 @@ class SSD1331(Display):
         self.write_command((0x2E,))
 
     def start_scroll(self):
+        self.shadow_valid = False # the display content is changed by the display controller
         self.write_command((0x2F,))
@@ -0,0 +1,81 @@
+from array import array
+import time
+
+
+class Waveform:
+    """ Ring buffer of waveform samples captured from the instantaneous value registers of an energy monitor chip.
+
+    Each sample holds the values of `n_signals` signals (e.g. three currents and the voltage), stored interleaved in
+    `data`, and the time.ticks_us() time at which the sample was taken, stored in `ticks`. The buffers are allocated
+    once so captures don't allocate memory. When the buffer is full, new samples overwrite the oldest ones.
+
+    Samples are filled by `ADE7816.capture()`.
+
+    Parameters:
+
+        n_samples (int): capacity of the buffer, in samples
+
+        n_signals (int): number of signals in each sample
+    """
+    def __init__(self, n_samples, n_signals=4):
+        self.n_samples = n_samples
+        self.n_signals = n_signals
+        self.data = array('i', [0] * (n_samples * n_signals))  # raw register values, sample by sample
+        self.ticks = array('i', [0] * n_samples)  # time.ticks_us() of each sample
+        self.head = 0  # index of the next sample to write
+        self.count = 0  # number of valid samples in the buffer
+        self.max_blackout_us = 0  # longest time the SPI port was held (and pin interrupts blocked) during the last capture
+
+    def clear(self):
+        """ Discard all the samples.
+        """
+        self.head = 0
+        self.count = 0
+
+    def index(self, i):
+        """ Return the buffer index of a sample.
+
+        Parameters:
+
+            i (int): sample number, 0 being the oldest sample in the buffer
+        """
+        return (self.head - self.count + i) % self.n_samples
+
+    def signal(self, k):
+        """ Return the values of a signal, from the oldest to the most recent sample.
+
+        Parameters:
+
+            k (int): signal number, in the order of the registers given to `ADE7816.capture()`
+
+        Returns:
+
+            array: raw register values. This allocates a new array.
+        """
+        data = self.data
+        n_signals = self.n_signals
+        return array('i', [data[self.index(i) * n_signals + k] for i in range(self.count)])
+
+    def timing(self):
+        """ Compute the achieved sample rate and the sampling jitter of the samples in the buffer.
+
+        The jitter is the largest deviation of a sample interval from the average interval.
+
+        Returns:
+
+            tuple: (sample rate in Hz (float), jitter in us (int)). (0, 0) if there are less than 2 samples.
+        """
+        n = self.count
+        if n < 2:
+            return (0, 0)
+        ticks = self.ticks
+        first = ticks[self.index(0)]
+        total = time.ticks_diff(ticks[self.index(n - 1)], first)
+        mean = total // (n - 1)
+        jitter = 0
+        t_prev = first
+        for i in range(1, n):
+            t = ticks[self.index(i)]
+            jitter = max(jitter, abs(time.ticks_diff(t, t_prev) - mean))
+            t_prev = t
+        return ((n - 1) * 1e6 / total if total else 0, jitter)